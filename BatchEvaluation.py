@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import pandas as pd
+from ClientRegistry import GetClient, GetClientConfig
+from PromptEvaluation import ScorePredictions
+from PromptTemplate import CompilePrompt
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Batch statuses after which a job will not change any more
+TerminalStatuses = {'completed', 'failed', 'expired', 'cancelled'}
+
+# Azure limits a batch input file to 100,000 requests
+MaxRequestsPerFile = 100000
+
+
+def BuildBatchRequests(Prompt: str, DataFrame: pd.DataFrame, FeatureColumns: List[str],
+                       Deployment: str) -> List[Dict[str, Any]]:
+    """
+    Render every row through the prompt as a batch chat completion request.
+
+    Args:
+        Prompt: The prompt template with placeholders for features
+        DataFrame: The dataframe to evaluate on
+        FeatureColumns: List of column names to use as features
+        Deployment: Batch deployment name placed in each request body
+
+    Returns:
+        List of batch request dictionaries; custom_id is the row position
+
+    Raises:
+        PromptTemplateError: If the prompt placeholders do not match FeatureColumns
+    """
+    Template = CompilePrompt(Prompt, FeatureColumns)
+    Requests = []
+    for Position, Variables in enumerate(DataFrame[FeatureColumns].to_dict('records')):
+        Requests.append({
+            'custom_id': f"row-{Position}",
+            'method': 'POST',
+            'url': '/chat/completions',
+            'body': {
+                'model': Deployment,
+                'messages': [{'role': 'user', 'content': Template.Render(Variables)}]
+            }
+        })
+    return Requests
+
+
+def WriteBatchFile(Requests: List[Dict[str, Any]], Path: str) -> None:
+    """
+    Write batch requests as JSONL.
+
+    Args:
+        Requests: Batch request dictionaries
+        Path: Output file path
+    """
+    with open(Path, 'w', encoding='utf-8') as File:
+        for Request in Requests:
+            File.write(json.dumps(Request, ensure_ascii=False) + "\n")
+
+
+def ParseBatchOutput(Lines: List[str]) -> Dict[str, str]:
+    """
+    Map batch output lines back to message content by custom_id.
+
+    Requests that failed inside the batch are mapped to an empty string.
+
+    Args:
+        Lines: JSONL lines of a batch output file
+
+    Returns:
+        Dictionary of custom_id to generated content
+    """
+    Outputs = {}
+    for Line in Lines:
+        if not Line.strip():
+            continue
+        Record = json.loads(Line)
+        Response = Record.get('response') or {}
+        if Response.get('status_code') != 200:
+            Outputs[Record['custom_id']] = ""
+            continue
+        Outputs[Record['custom_id']] = Response['body']['choices'][0]['message']['content'] or ""
+    return Outputs
+
+
+class AzureBatchBackend:
+    """Submits JSONL files to the Azure OpenAI Batch API using the shared client."""
+
+    def Submit(self, Path: str) -> str:
+        """Upload a batch input file and start a job; returns the batch id."""
+        Client = GetClient()
+        with open(Path, 'rb') as File:
+            InputFile = Client.files.create(file=File, purpose='batch')
+        Batch = Client.batches.create(
+            input_file_id=InputFile.id,
+            endpoint='/chat/completions',
+            completion_window='24h'
+        )
+        return Batch.id
+
+    def GetStatus(self, JobId: str) -> str:
+        """Return the current status of a batch job."""
+        return GetClient().batches.retrieve(JobId).status
+
+    def Download(self, JobId: str) -> List[str]:
+        """Return the output (and error) JSONL lines of a finished batch job."""
+        Client = GetClient()
+        Batch = Client.batches.retrieve(JobId)
+        Lines = []
+        for FileId in (Batch.output_file_id, Batch.error_file_id):
+            if FileId:
+                Lines.extend(Client.files.content(FileId).text.splitlines())
+        return Lines
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the batch endpoint.
+
+    Jobs are stored as directories; the first status poll answers every
+    request with the given responder and marks the job completed.
+    """
+
+    def __init__(self, Directory: str, Responder: Callable[[Dict[str, Any]], str]):
+        """
+        Args:
+            Directory: Directory holding one sub-directory per job
+            Responder: Function mapping a request body to the generated content
+        """
+        self.Directory = Directory
+        self.Responder = Responder
+        os.makedirs(Directory, exist_ok=True)
+
+    def _JobPath(self, JobId: str, Name: str) -> str:
+        return os.path.join(self.Directory, JobId, Name)
+
+    def Submit(self, Path: str) -> str:
+        JobId = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(os.path.join(self.Directory, JobId))
+        shutil.copyfile(Path, self._JobPath(JobId, 'input.jsonl'))
+        with open(self._JobPath(JobId, 'status'), 'w') as File:
+            File.write('validating')
+        return JobId
+
+    def GetStatus(self, JobId: str) -> str:
+        with open(self._JobPath(JobId, 'status')) as File:
+            Status = File.read().strip()
+        if Status in TerminalStatuses:
+            return Status
+
+        with open(self._JobPath(JobId, 'input.jsonl'), encoding='utf-8') as InputFile, \
+                open(self._JobPath(JobId, 'output.jsonl'), 'w', encoding='utf-8') as OutputFile:
+            for Line in InputFile:
+                Request = json.loads(Line)
+                Content = self.Responder(Request['body'])
+                OutputFile.write(json.dumps({
+                    'custom_id': Request['custom_id'],
+                    'response': {
+                        'status_code': 200,
+                        'body': {'choices': [{'message': {'role': 'assistant', 'content': Content}}]}
+                    }
+                }, ensure_ascii=False) + "\n")
+
+        with open(self._JobPath(JobId, 'status'), 'w') as File:
+            File.write('completed')
+        return 'completed'
+
+    def Download(self, JobId: str) -> List[str]:
+        with open(self._JobPath(JobId, 'output.jsonl'), encoding='utf-8') as File:
+            return File.read().splitlines()
+
+
+def EvaluatePromptBatch(
+    Prompt: str,
+    DataFrame: pd.DataFrame,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    Backend: Optional[Any] = None,
+    WorkingDirectory: str = '.batch_jobs',
+    PollInterval: float = 60.0,
+    Timeout: Optional[float] = None
+) -> Tuple[float, pd.DataFrame]:
+    """
+    Evaluate a prompt offline through the Batch API.
+
+    Rows are rendered into JSONL batch files (split at the per-file request
+    limit), submitted, polled until every job finishes and mapped back to
+    rows by custom_id. Rows missing from the output are scored as incorrect.
+
+    Args:
+        Prompt: The prompt template with placeholders for features
+        DataFrame: The dataframe to evaluate on
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        Backend: Batch backend (defaults to AzureBatchBackend)
+        WorkingDirectory: Directory for the generated JSONL input files
+        PollInterval: Seconds between status polls
+        Timeout: Optional maximum seconds to wait for completion
+
+    Returns:
+        Tuple containing:
+        - Accuracy score (float between 0 and 1)
+        - DataFrame with additional 'Prediction' and 'ExtractedLabel' columns
+    """
+    if Backend is None:
+        Backend = AzureBatchBackend()
+    os.makedirs(WorkingDirectory, exist_ok=True)
+
+    Config = GetClientConfig()
+    Requests = BuildBatchRequests(Prompt, DataFrame, FeatureColumns,
+                                  Config['BatchDeploymentName'] or Config['DeploymentName'])
+
+    # Submit one job per input file
+    JobIds = []
+    RunId = uuid.uuid4().hex
+    for Start in range(0, len(Requests), MaxRequestsPerFile):
+        Path = os.path.join(WorkingDirectory, f"{RunId}_{Start // MaxRequestsPerFile}.jsonl")
+        WriteBatchFile(Requests[Start:Start + MaxRequestsPerFile], Path)
+        JobIds.append(Backend.Submit(Path))
+    print(f"Submitted {len(Requests)} rows in {len(JobIds)} batch job(s)")
+
+    # Poll until every job reaches a terminal status
+    StartTime = time.time()
+    Pending = set(JobIds)
+    Statuses = {}
+    while Pending:
+        for JobId in list(Pending):
+            Statuses[JobId] = Backend.GetStatus(JobId)
+            if Statuses[JobId] in TerminalStatuses:
+                Pending.discard(JobId)
+        if not Pending:
+            break
+        if Timeout is not None and time.time() - StartTime > Timeout:
+            raise TimeoutError(f"Batch jobs still running after {Timeout} seconds: {sorted(Pending)}")
+        time.sleep(PollInterval)
+
+    # Collect outputs; expired jobs may still carry partial results
+    Outputs = {}
+    for JobId in JobIds:
+        if Statuses[JobId] in ('failed', 'cancelled'):
+            print(f"Warning: batch job {JobId} {Statuses[JobId]}")
+            continue
+        Outputs.update(ParseBatchOutput(Backend.Download(JobId)))
+
+    Predictions = [Outputs.get(Request['custom_id'], "") for Request in Requests]
+    MissingCount = sum(1 for Request in Requests if Request['custom_id'] not in Outputs)
+    if MissingCount:
+        print(f"Warning: {MissingCount}/{len(Requests)} rows have no batch output and are scored as incorrect")
+
+    return ScorePredictions(DataFrame, Predictions, LabelColumn)
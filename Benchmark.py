@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+from ClientRegistry import ConfigureClients, CloseClients
+from RequestScheduler import ResetRequestSchedulers
+from MockAzureServer import MockServerProcess
+from PromptEvaluation import EvaluatePrompt
+from PromptEvolution import ImprovePrompt
+from HybridPromptEvolution import HybridImprovePrompt
+from Telemetry import GetTelemetry
+from main import Main
+
+# Scenarios RunBenchmark can measure
+Scenarios = ('EvaluatePrompt', 'EvaluatePromptConstrained', 'EvaluatePromptReorder', 'ImprovePrompt',
+             'HybridImprovePrompt', 'Main')
+
+DefaultLabels = ('has_aspiration', 'no_aspiration')
+DefaultBaselineDirectory = os.path.join('benchmarks', 'baselines')
+
+BenchmarkPrompt = """Analyze the following talent statement and determine if it expresses career aspiration.
+
+Talent Statement: {text}
+
+Does this statement express career aspiration? Please respond with only: has_aspiration or no_aspiration."""
+
+_Vocabulary = (
+    "I want to lead a team grow my career learn new skills become manager stay in my current role "
+    "enjoy the work move to another department improve my technical expertise mentor others "
+    "take on more responsibility balance family commitments relocate explore data science"
+).split()
+
+
+def GenerateSyntheticDataset(RowCount: int, Labels: Sequence[str] = DefaultLabels, RandomState: int = 0) -> pd.DataFrame:
+    """
+    Build a synthetic text classification dataset.
+
+    Args:
+        RowCount: Number of rows
+        Labels: Labels assigned uniformly at random
+        RandomState: Seed for texts and labels
+
+    Returns:
+        DataFrame with 'text' and 'label' columns
+    """
+    Generator = np.random.default_rng(RandomState)
+    Lengths = Generator.integers(8, 40, size=RowCount)
+    Words = Generator.integers(0, len(_Vocabulary), size=int(Lengths.sum()))
+    Offsets = np.concatenate(([0], np.cumsum(Lengths)))
+    Texts = [" ".join(_Vocabulary[Word] for Word in Words[Offsets[Row]:Offsets[Row + 1]]) for Row in range(RowCount)]
+    return pd.DataFrame({
+        'text': Texts,
+        'label': np.asarray(Labels, dtype=object)[Generator.integers(0, len(Labels), size=RowCount)]
+    })
+
+
+@contextlib.contextmanager
+def UseMockServer(Server: MockServerProcess, **ClientOptions: Any) -> Iterator[None]:
+    """
+    Point the shared clients at a mock server and disable the response cache for the block.
+
+    LLM_CACHE_ENABLED is restored on exit.
+
+    Args:
+        Server: Running MockServerProcess
+        **ClientOptions: Further client configuration overrides, e.g. HedgingEnabled=True
+    """
+    ConfigureClients(Endpoint=Server.Url, ApiKey='mock', ApiVersion='2024-06-01', DeploymentName='mock-deployment',
+                     **ClientOptions)
+    ResetRequestSchedulers()
+    # Every request must reach the server for throughput to mean anything
+    Previous = os.environ.get('LLM_CACHE_ENABLED')
+    os.environ['LLM_CACHE_ENABLED'] = 'false'
+    try:
+        yield
+    finally:
+        if Previous is None:
+            os.environ.pop('LLM_CACHE_ENABLED', None)
+        else:
+            os.environ['LLM_CACHE_ENABLED'] = Previous
+
+
+def RunScenario(Scenario: str, DataFrame: pd.DataFrame, Server: MockServerProcess,
+                TrackMemory: bool = True) -> Dict[str, Any]:
+    """
+    Measure one scenario against the mock server.
+
+    Console output of the measured code is discarded. ImprovePrompt and
+    HybridImprovePrompt need evaluation results; those are produced before
+    the measurement starts and are not counted.
+
+    Args:
+        Scenario: One of Scenarios
+        DataFrame: Dataset with 'text' and 'label' columns
+        Server: Running MockServerProcess the clients point at
+        TrackMemory: Whether to measure peak Python memory of the client side with tracemalloc (slower)
+
+    Returns:
+        Dictionary with Scenario, Rows, Seconds, RowsPerSecond, LatencyP50/P95/P99,
+        Requests, Hedges, RateLimited, ServerErrors, PromptTokens, CachedTokens and PeakMemoryMB
+    """
+    if Scenario not in Scenarios:
+        raise ValueError(f"Scenario must be one of {Scenarios}, got {Scenario!r}")
+
+    with open(os.devnull, 'w') as DevNull, contextlib.redirect_stdout(DevNull):
+        # Prepare inputs of the improvement scenarios outside the measurement
+        if Scenario in ('ImprovePrompt', 'HybridImprovePrompt'):
+            BestAccuracy, BestResults = EvaluatePrompt(BenchmarkPrompt, DataFrame, ['text'], 'label')
+        if Scenario == 'HybridImprovePrompt':
+            CurrentPrompt = BenchmarkPrompt + "\nAnswer in lower case."
+            CurrentAccuracy, CurrentResults = EvaluatePrompt(CurrentPrompt, DataFrame, ['text'], 'label')
+
+        GetTelemetry().Clear()
+        Server.ResetStats()
+        if TrackMemory:
+            tracemalloc.start()
+        StartTime = time.perf_counter()
+
+        if Scenario == 'EvaluatePrompt':
+            EvaluatePrompt(BenchmarkPrompt, DataFrame, ['text'], 'label')
+        elif Scenario == 'EvaluatePromptConstrained':
+            EvaluatePrompt(BenchmarkPrompt, DataFrame, ['text'], 'label', ConstrainedOutput=True)
+        elif Scenario == 'EvaluatePromptReorder':
+            EvaluatePrompt(BenchmarkPrompt, DataFrame, ['text'], 'label', Layout='Reorder')
+        elif Scenario == 'ImprovePrompt':
+            ImprovePrompt(BenchmarkPrompt, BestAccuracy, BestResults, 'label')
+        elif Scenario == 'HybridImprovePrompt':
+            HybridImprovePrompt(BenchmarkPrompt, BestAccuracy, BestResults,
+                                CurrentPrompt, CurrentAccuracy, CurrentResults, 'label')
+        else:
+            with tempfile.TemporaryDirectory() as Directory:
+                Main(DataFrame, ['text'], 'label', BenchmarkPrompt, MaxIterations=2, AccuracyThreshold=1.0,
+                     OutputPath=os.path.join(Directory, 'BestPrompt.txt'))
+
+        Seconds = time.perf_counter() - StartTime
+        PeakMemory = 0
+        if TrackMemory:
+            PeakMemory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    Totals = GetTelemetry().GetTotals()
+    Stats = Server.Stats
+    return {
+        'Scenario': Scenario,
+        'Rows': len(DataFrame),
+        'Seconds': Seconds,
+        'RowsPerSecond': len(DataFrame) / Seconds if Seconds > 0 else 0.0,
+        'LatencyP50': Totals['LatencyP50'] if Totals['Calls'] else 0.0,
+        'LatencyP95': Totals['LatencyP95'] if Totals['Calls'] else 0.0,
+        'LatencyP99': Totals['LatencyP99'] if Totals['Calls'] else 0.0,
+        'Requests': Stats['Requests'],
+        'Hedges': Totals['Hedges'],
+        'RateLimited': Stats['RateLimited'],
+        'ServerErrors': Stats['ServerErrors'],
+        'PromptTokens': Stats['PromptTokens'],
+        'CachedTokens': Stats['CachedTokens'],
+        'PeakMemoryMB': PeakMemory / 2 ** 20
+    }
+
+
+def RunBenchmark(RowCounts: Sequence[int] = (1000,), ScenarioNames: Sequence[str] = ('EvaluatePrompt',),
+                 ServerOptions: Optional[Dict[str, Any]] = None, TrackMemory: bool = True,
+                 RandomState: int = 0, ClientOptions: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+    """
+    Run scenarios on synthetic datasets against a local mock server.
+
+    Args:
+        RowCounts: Dataset sizes to measure, e.g. (1000, 10000, 1000000)
+        ScenarioNames: Scenarios to run for every dataset size
+        ServerOptions: Keyword arguments for MockAzureServer (latency, error rates, ...)
+        TrackMemory: Whether to measure peak Python memory with tracemalloc
+        RandomState: Seed for datasets and the mock server
+        ClientOptions: Client configuration overrides, e.g. {'HedgingEnabled': True}
+
+    Returns:
+        DataFrame with one row per scenario and dataset size
+    """
+    Options = {'Labels': DefaultLabels, 'RandomState': RandomState, **(ServerOptions or {})}
+    Results = []
+    # The server runs in its own process so its memory is not counted as the client's
+    with MockServerProcess(**Options) as Server, UseMockServer(Server, **(ClientOptions or {})):
+        try:
+            for RowCount in RowCounts:
+                DataFrame = GenerateSyntheticDataset(RowCount, Options['Labels'], RandomState)
+                for Scenario in ScenarioNames:
+                    print(f"Running {Scenario} on {RowCount} rows")
+                    Result = RunScenario(Scenario, DataFrame, Server, TrackMemory)
+                    print(f"  {Result['RowsPerSecond']:.1f} rows/s, p95 {Result['LatencyP95']:.3f}s, "
+                          f"{Result['Requests']} requests, peak {Result['PeakMemoryMB']:.1f} MB")
+                    Results.append(Result)
+        finally:
+            CloseClients()
+    return pd.DataFrame(Results)
+
+
+def SaveBaseline(Results: pd.DataFrame, Name: str, Directory: str = DefaultBaselineDirectory) -> str:
+    """
+    Store benchmark results as a named baseline.
+
+    Args:
+        Results: Result of RunBenchmark
+        Name: Baseline name
+        Directory: Directory holding baseline files
+
+    Returns:
+        Path of the baseline file
+    """
+    os.makedirs(Directory, exist_ok=True)
+    Path = os.path.join(Directory, f"{Name}.json")
+    with open(Path, 'w', encoding='utf-8') as File:
+        json.dump({
+            'Name': Name,
+            'CreatedAt': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'Python': sys.version.split()[0],
+            'Platform': platform.platform(),
+            'Results': Results.to_dict('records')
+        }, File, indent=2)
+    return Path
+
+
+def CompareWithBaseline(Results: pd.DataFrame, Name: str, Directory: str = DefaultBaselineDirectory,
+                        Tolerance: float = 0.10) -> pd.DataFrame:
+    """
+    Compare benchmark results with a stored baseline.
+
+    A row is flagged as a regression when throughput dropped, or p95 latency
+    or peak memory grew, by more than Tolerance.
+
+    Args:
+        Results: Result of RunBenchmark
+        Name: Baseline name
+        Directory: Directory holding baseline files
+        Tolerance: Relative change tolerated before flagging a regression
+
+    Returns:
+        DataFrame indexed by Scenario and Rows with relative changes and a Regression column
+    """
+    with open(os.path.join(Directory, f"{Name}.json"), 'r', encoding='utf-8') as File:
+        Baseline = pd.DataFrame(json.load(File)['Results'])
+
+    Metrics = ['RowsPerSecond', 'LatencyP95', 'PeakMemoryMB', 'Requests']
+    Comparison = Results.set_index(['Scenario', 'Rows'])[Metrics].join(
+        Baseline.set_index(['Scenario', 'Rows'])[Metrics], rsuffix='Baseline', how='inner'
+    )
+    for Metric in Metrics:
+        Comparison[f"{Metric}Change"] = (
+            (Comparison[Metric] - Comparison[f"{Metric}Baseline"]) / Comparison[f"{Metric}Baseline"]
+        ).where(Comparison[f"{Metric}Baseline"] > 0, 0.0)
+
+    Comparison['Regression'] = (
+        (Comparison['RowsPerSecondChange'] < -Tolerance)
+        | (Comparison['LatencyP95Change'] > Tolerance)
+        | (Comparison['PeakMemoryMBChange'] > Tolerance)
+    )
+    return Comparison
+
+
+def ParseArguments(Arguments: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line options of the benchmark script."""
+    Parser = argparse.ArgumentParser(description="Benchmark evaluation and prompt improvement against a mock Azure OpenAI server.")
+    Parser.add_argument('--rows', type=int, nargs='+', default=[1000], help="Dataset sizes")
+    Parser.add_argument('--scenarios', nargs='+', default=['EvaluatePrompt'], choices=Scenarios)
+    Parser.add_argument('--latency-distribution', default='LogNormal', choices=('Constant', 'Uniform', 'LogNormal'))
+    Parser.add_argument('--latency-mean', type=float, default=0.05, help="Mean mock latency in seconds")
+    Parser.add_argument('--latency-sigma', type=float, default=0.5, help="Shape of the log-normal latency tail")
+    Parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Fraction of requests answered with 429")
+    Parser.add_argument('--server-error-rate', type=float, default=0.0, help="Fraction of requests answered with 5xx")
+    Parser.add_argument('--prompt-cache-min-tokens', type=int, default=None,
+                        help="Simulate the provider prompt cache for prefixes of at least this many tokens")
+    Parser.add_argument('--hedging', action='store_true', help="Duplicate slow evaluation requests")
+    Parser.add_argument('--no-memory', action='store_true', help="Skip tracemalloc peak memory tracking")
+    Parser.add_argument('--save-baseline', metavar='NAME', help="Store results as a named baseline")
+    Parser.add_argument('--compare', metavar='NAME', help="Compare results with a named baseline")
+    Parser.add_argument('--tolerance', type=float, default=0.10, help="Relative change flagged as a regression")
+    return Parser.parse_args(Arguments)
+
+
+if __name__ == "__main__":
+    Arguments = ParseArguments()
+    Results = RunBenchmark(
+        RowCounts=Arguments.rows,
+        ScenarioNames=Arguments.scenarios,
+        ServerOptions={
+            'LatencyDistribution': Arguments.latency_distribution,
+            'LatencyMean': Arguments.latency_mean,
+            'LatencySigma': Arguments.latency_sigma,
+            'RateLimitRate': Arguments.rate_limit_rate,
+            'ServerErrorRate': Arguments.server_error_rate,
+            'PromptCacheMinTokens': Arguments.prompt_cache_min_tokens
+        },
+        TrackMemory=not Arguments.no_memory,
+        ClientOptions={'HedgingEnabled': True} if Arguments.hedging else None
+    )
+    print(Results.to_string(index=False))
+
+    if Arguments.save_baseline:
+        print(f"Baseline saved to {SaveBaseline(Results, Arguments.save_baseline)}")
+
+    if Arguments.compare:
+        Comparison = CompareWithBaseline(Results, Arguments.compare, Tolerance=Arguments.tolerance)
+        print(Comparison.to_string())
+        if Comparison['Regression'].any():
+            print("Regression detected against baseline")
+            sys.exit(1)
@@ -0,0 +1,174 @@
+import os
+import asyncio
+import hashlib
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.feature_extraction.text import TfidfVectorizer
+from PromptEvaluation import EvaluatePromptAsync
+from PromptTemplate import DefaultPromptLayout
+from typing import Dict, List, Optional, Tuple
+
+# Strata larger than this are clustered with MiniBatchKMeans
+MiniBatchThreshold = 10000
+
+_CoresetCache: Dict[str, pd.DataFrame] = {}
+
+
+def GetDatasetFingerprint(DataFrame: pd.DataFrame, Columns: List[str]) -> str:
+    """
+    Hash the content and index of the given columns.
+
+    Args:
+        DataFrame: The dataframe to fingerprint
+        Columns: Columns included in the fingerprint
+
+    Returns:
+        Hex digest identifying the dataset
+    """
+    RowHashes = pd.util.hash_pandas_object(DataFrame[Columns], index=True).to_numpy()
+    return hashlib.sha256(RowHashes.tobytes()).hexdigest()
+
+
+def BuildCoreset(DataFrame: pd.DataFrame, FeatureColumns: List[str], LabelColumn: str,
+                 CoresetSize: int = 200, RandomState: int = 0,
+                 CacheDirectory: Optional[str] = '.coreset_cache') -> pd.DataFrame:
+    """
+    Pick a small, label-stratified set of representative rows.
+
+    Rows are embedded with TF-IDF over the feature columns. Each label gets
+    clusters in proportion to its share of the data; the row nearest each
+    k-means centroid represents its cluster and carries the cluster size as
+    'CoresetWeight'. The result is cached in memory and on disk per dataset.
+
+    Args:
+        DataFrame: The full dataset
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        CoresetSize: Approximate number of rows to select
+        RandomState: Seed for clustering
+        CacheDirectory: Directory for cached coresets, or None to skip disk caching
+
+    Returns:
+        Subset of DataFrame with an added 'CoresetWeight' column
+    """
+    Fingerprint = GetDatasetFingerprint(DataFrame, FeatureColumns + [LabelColumn])
+    CacheKey = f"{Fingerprint}_{CoresetSize}_{RandomState}"
+    if CacheKey in _CoresetCache:
+        return _CoresetCache[CacheKey]
+
+    CachePath = os.path.join(CacheDirectory, f"{CacheKey}.csv") if CacheDirectory else None
+    if CachePath and os.path.exists(CachePath):
+        Cached = pd.read_csv(CachePath)
+        Coreset = DataFrame.iloc[Cached['Position'].to_numpy()].copy()
+        Coreset['CoresetWeight'] = Cached['CoresetWeight'].to_numpy()
+        _CoresetCache[CacheKey] = Coreset
+        return Coreset
+
+    Texts = DataFrame[FeatureColumns].astype(str).agg(" ".join, axis=1)
+    Embeddings = TfidfVectorizer(max_features=20000, sublinear_tf=True).fit_transform(Texts)
+    Labels = DataFrame[LabelColumn].astype(str).to_numpy()
+
+    Positions = []
+    Weights = []
+    for Label in np.unique(Labels):
+        StratumPositions = np.flatnonzero(Labels == Label)
+        ClusterCount = int(min(len(StratumPositions), max(1, round(CoresetSize * len(StratumPositions) / len(Labels)))))
+        if ClusterCount == len(StratumPositions):
+            Positions.extend(StratumPositions.tolist())
+            Weights.extend([1] * len(StratumPositions))
+            continue
+
+        StratumEmbeddings = Embeddings[StratumPositions]
+        Clusterer = MiniBatchKMeans if len(StratumPositions) > MiniBatchThreshold else KMeans
+        Model = Clusterer(n_clusters=ClusterCount, random_state=RandomState, n_init=3).fit(StratumEmbeddings)
+        Distances = Model.transform(StratumEmbeddings)
+        for Cluster in range(ClusterCount):
+            Members = np.flatnonzero(Model.labels_ == Cluster)
+            if len(Members) == 0:
+                continue
+            Representative = Members[np.argmin(Distances[Members, Cluster])]
+            Positions.append(int(StratumPositions[Representative]))
+            Weights.append(len(Members))
+
+    Coreset = DataFrame.iloc[Positions].copy()
+    Coreset['CoresetWeight'] = Weights
+
+    if CachePath:
+        os.makedirs(CacheDirectory, exist_ok=True)
+        pd.DataFrame({'Position': Positions, 'CoresetWeight': Weights}).to_csv(CachePath, index=False)
+    _CoresetCache[CacheKey] = Coreset
+    return Coreset
+
+
+def GetWeightedAccuracy(ResultDataFrame: pd.DataFrame, LabelColumn: str) -> float:
+    """
+    Estimate full-set accuracy from coreset results using the cluster weights.
+
+    Args:
+        ResultDataFrame: Evaluation results on the coreset
+        LabelColumn: The column name containing true labels
+
+    Returns:
+        Weighted accuracy (float between 0 and 1)
+    """
+    Correct = (ResultDataFrame['ExtractedLabel'] == ResultDataFrame[LabelColumn].astype(str)).to_numpy()
+    Weights = ResultDataFrame['CoresetWeight'].to_numpy()
+    return float(np.dot(Correct, Weights) / Weights.sum())
+
+
+async def ScreenCandidatesAsync(Candidates: List[str], Coreset: pd.DataFrame, FeatureColumns: List[str],
+                                LabelColumn: str, UniqueLabels: List[str], Semaphore: asyncio.Semaphore,
+                                ConstrainedOutput: bool = False, Layout: str = DefaultPromptLayout) -> List[float]:
+    """
+    Score candidate prompts on the coreset.
+
+    Args:
+        Candidates: Candidate prompts
+        Coreset: Result of BuildCoreset
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        UniqueLabels: Labels of the full dataset
+        Semaphore: Shared concurrency budget
+        ConstrainedOutput: Request label-only answers, as the full evaluation does
+        Layout: Message layout, one of 'Single', 'Split' or 'Reorder'
+
+    Returns:
+        Estimated full-set accuracy for each candidate
+    """
+    Evaluations = await asyncio.gather(*(
+        EvaluatePromptAsync(Candidate, Coreset, FeatureColumns, LabelColumn,
+                            UniqueLabels=UniqueLabels, Semaphore=Semaphore,
+                            ConstrainedOutput=ConstrainedOutput, Layout=Layout)
+        for Candidate in Candidates
+    ))
+    return [GetWeightedAccuracy(Results, LabelColumn) for _, Results in Evaluations]
+
+
+class ScreeningTracker:
+    """Collects screening scores next to full-set accuracy to check how well screening ranks candidates."""
+
+    def __init__(self):
+        self.Pairs: List[Tuple[float, float]] = []
+
+    def Record(self, ScreeningAccuracy: float, FullAccuracy: float) -> None:
+        """Store the screening score and full-set accuracy of a promoted candidate."""
+        self.Pairs.append((ScreeningAccuracy, FullAccuracy))
+
+    def Report(self) -> Dict[str, Optional[float]]:
+        """
+        Summarize agreement between screening and full evaluation.
+
+        Returns:
+            Dictionary with Pairs, Pearson and Spearman correlation and MeanAbsoluteError
+        """
+        Report = {'Pairs': len(self.Pairs), 'Pearson': None, 'Spearman': None, 'MeanAbsoluteError': None}
+        if not self.Pairs:
+            return Report
+
+        Scores = pd.DataFrame(self.Pairs, columns=['Screening', 'Full'])
+        Report['MeanAbsoluteError'] = float((Scores['Screening'] - Scores['Full']).abs().mean())
+        if len(Scores) >= 3:
+            Report['Pearson'] = float(Scores['Screening'].corr(Scores['Full'], method='pearson'))
+            Report['Spearman'] = float(Scores['Screening'].corr(Scores['Full'], method='spearman'))
+        return Report
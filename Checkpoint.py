@@ -0,0 +1,247 @@
+import os
+import json
+import hashlib
+import threading
+import contextlib
+import contextvars
+import collections
+import pandas as pd
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# Prediction log consulted by evaluations running inside UsePredictionLog
+_ActivePredictionLog: contextvars.ContextVar = contextvars.ContextVar('ActivePredictionLog', default=None)
+
+
+def _Hash(Value: Any) -> str:
+    return hashlib.sha256(json.dumps(Value, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()[:32]
+
+
+def _Fsync(Path: str) -> None:
+    # Force a written file to stable storage before it replaces the previous version
+    with open(Path, 'rb+') as File:
+        os.fsync(File.fileno())
+
+
+class PredictionLog:
+    """
+    Append-only JSON Lines log of per-row predictions.
+
+    Each prediction is keyed by a prompt key and a hash of the row's feature
+    values, so it is found again on resume even if the dataframe index or
+    row order changed. The prompt key covers the prompt and the request
+    options (constrained output, layout, pack size), so a resume in another
+    mode does not reuse answers of the old one. Lines are flushed as soon as
+    a row completes; a line cut short by a crash is ignored.
+
+    Opening the log only collects the prompt keys it contains. The entries
+    of a logged prompt are loaded on its first lookup, and only the last
+    MaxLoadedPrompts prompts are kept in memory.
+    """
+
+    # Prompts whose logged entries are held in memory at once
+    MaxLoadedPrompts = 2
+
+    def __init__(self, Path: str):
+        """
+        Args:
+            Path: Path of the JSON Lines file
+        """
+        self.Path = Path
+        self._Loaded: collections.OrderedDict = collections.OrderedDict()
+        self._PromptKeys = set()
+        self._Lock = threading.Lock()
+
+        if os.path.exists(Path):
+            with open(Path, 'r', encoding='utf-8') as File:
+                for Line in File:
+                    try:
+                        self._PromptKeys.add(json.loads(Line)['Prompt'])
+                    except json.JSONDecodeError:
+                        continue
+        self._File = open(Path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def MakePromptKey(Prompt: str, **Options: Any) -> str:
+        """
+        Return the key of a prompt evaluated with the given request options.
+
+        Args:
+            Prompt: The prompt template
+            **Options: Options that change the requests, e.g. ConstrainedOutput, Layout or PackSize
+
+        Returns:
+            Hash of the prompt and options
+        """
+        return _Hash([Prompt, Options]) if Options else _Hash(Prompt)
+
+    def CountEntries(self) -> int:
+        """Return the number of logged predictions, reading the file without keeping it in memory."""
+        with self._Lock:
+            self._File.flush()
+            with open(self.Path, 'rb') as File:
+                return sum(1 for _ in File)
+
+    def _GetEntries(self, PromptKey: str) -> Dict[str, Tuple[Optional[str], Dict[str, float]]]:
+        # Entries of one prompt, read from the file on first use; the caller holds the lock
+        if PromptKey in self._Loaded:
+            self._Loaded.move_to_end(PromptKey)
+            return self._Loaded[PromptKey]
+        Entries = {}
+        # A prompt the log has never seen has nothing to read
+        if PromptKey in self._PromptKeys:
+            self._File.flush()
+            with open(self.Path, 'r', encoding='utf-8') as File:
+                for Line in File:
+                    # Skip other prompts without parsing their lines
+                    if PromptKey not in Line:
+                        continue
+                    try:
+                        Entry = json.loads(Line)
+                    except json.JSONDecodeError:
+                        continue
+                    if Entry['Prompt'] == PromptKey:
+                        Entries[Entry['Row']] = (Entry['Prediction'], Entry.get('Probabilities') or {})
+        self._Loaded[PromptKey] = Entries
+        while len(self._Loaded) > self.MaxLoadedPrompts:
+            self._Loaded.popitem(last=False)
+        return Entries
+
+    def Get(self, PromptKey: str, Variables: Dict[str, Any]) -> Optional[Tuple[Optional[str], Dict[str, float]]]:
+        """
+        Look up the logged prediction of a row.
+
+        Args:
+            PromptKey: Result of MakePromptKey
+            Variables: Feature values of the row
+
+        Returns:
+            Tuple of the raw output and the label probabilities (empty unless
+            constrained), or None if the row is not logged
+        """
+        with self._Lock:
+            return self._GetEntries(PromptKey).get(_Hash(Variables))
+
+    def Append(self, PromptKey: str, Variables: Dict[str, Any], Prediction: Optional[str],
+               Probabilities: Optional[Dict[str, float]] = None) -> None:
+        """
+        Log the prediction of one row and flush it to disk.
+
+        Args:
+            PromptKey: Result of MakePromptKey
+            Variables: Feature values of the row
+            Prediction: Raw model output
+            Probabilities: Optional label probabilities of a constrained request
+        """
+        RowKey = _Hash(Variables)
+        Entry = {'Prompt': PromptKey, 'Row': RowKey, 'Prediction': Prediction}
+        if Probabilities:
+            Entry['Probabilities'] = Probabilities
+        Line = json.dumps(Entry, ensure_ascii=False)
+        with self._Lock:
+            self._PromptKeys.add(PromptKey)
+            if PromptKey in self._Loaded:
+                self._Loaded[PromptKey][RowKey] = (Prediction, Probabilities or {})
+            self._File.write(Line + "\n")
+            self._File.flush()
+
+    def Close(self) -> None:
+        """Close the log file."""
+        with self._Lock:
+            self._File.close()
+
+
+@contextlib.contextmanager
+def UsePredictionLog(Log: Optional[PredictionLog]) -> Iterator[None]:
+    """
+    Serve and record row predictions of evaluations inside the block through Log.
+
+    Args:
+        Log: Prediction log, or None to leave evaluations unchanged
+    """
+    Token = _ActivePredictionLog.set(Log)
+    try:
+        yield
+    finally:
+        _ActivePredictionLog.reset(Token)
+
+
+def GetPredictionLog() -> Optional[PredictionLog]:
+    """Return the prediction log active in the current context, if any."""
+    return _ActivePredictionLog.get()
+
+
+class RunCheckpoint:
+    """
+    Durable state of one improvement run, kept in a local run directory.
+
+    The directory holds the loop state (state.json, replaced atomically),
+    result frames (Parquet) and the per-row prediction log
+    (predictions.jsonl). Result frames are written under new names and
+    only become part of the run once a saved state lists them in
+    'ResultFiles', so state and results are committed together.
+    """
+
+    def __init__(self, RunDirectory: str):
+        """
+        Args:
+            RunDirectory: Directory for the run's checkpoint files
+        """
+        self.RunDirectory = RunDirectory
+        os.makedirs(RunDirectory, exist_ok=True)
+        self.StatePath = os.path.join(RunDirectory, 'state.json')
+        self.PredictionLog = PredictionLog(os.path.join(RunDirectory, 'predictions.jsonl'))
+
+    def Load(self) -> Optional[Dict[str, Any]]:
+        """Return the saved loop state, or None if the run has no checkpoint yet."""
+        if not os.path.exists(self.StatePath):
+            return None
+        with open(self.StatePath, 'r', encoding='utf-8') as File:
+            return json.load(File)
+
+    def Save(self, State: Dict[str, Any]) -> None:
+        """
+        Write the loop state, replacing the previous checkpoint atomically.
+
+        Result files no longer listed in State['ResultFiles'] are removed
+        once the new state is in place.
+        """
+        TemporaryPath = self.StatePath + '.tmp'
+        with open(TemporaryPath, 'w', encoding='utf-8') as File:
+            json.dump(State, File, ensure_ascii=False, indent=2, default=str)
+            File.flush()
+            os.fsync(File.fileno())
+        os.replace(TemporaryPath, self.StatePath)
+
+        Referenced = set((State.get('ResultFiles') or {}).values())
+        for FileName in os.listdir(self.RunDirectory):
+            if FileName.startswith('Results-') and FileName.endswith('.parquet') and FileName not in Referenced:
+                os.remove(os.path.join(self.RunDirectory, FileName))
+
+    def SaveResults(self, Name: str, ResultDataFrame: pd.DataFrame) -> str:
+        """
+        Write a result frame to a file of its own, e.g. named after its iteration.
+
+        The file is durable on return but is only used after a resume once a
+        saved state lists it in 'ResultFiles'.
+
+        Args:
+            Name: Name of the result frame, unique within the committed state
+            ResultDataFrame: Evaluation results, including attrs metadata
+
+        Returns:
+            File name to record in the state
+        """
+        FileName = f"Results-{Name}.parquet"
+        Path = os.path.join(self.RunDirectory, FileName)
+        ResultDataFrame.to_parquet(Path + '.tmp')
+        _Fsync(Path + '.tmp')
+        os.replace(Path + '.tmp', Path)
+        return FileName
+
+    def LoadResults(self, FileName: str) -> pd.DataFrame:
+        """Return the result frame saved under a file name returned by SaveResults."""
+        return pd.read_parquet(os.path.join(self.RunDirectory, FileName))
+
+    def Close(self) -> None:
+        """Close the prediction log."""
+        self.PredictionLog.Close()
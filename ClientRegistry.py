@@ -0,0 +1,300 @@
+import os
+import atexit
+import asyncio
+import concurrent.futures
+import threading
+import contextvars
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from dotenv import load_dotenv
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+load_dotenv()
+
+T = TypeVar("T")
+
+# Process-wide state, created lazily and shared by every module that calls Azure OpenAI
+_Config: Optional[Dict[str, Any]] = None
+_Client: Optional[AzureOpenAI] = None
+_AsyncClients: Dict[asyncio.AbstractEventLoop, AsyncAzureOpenAI] = {}
+_RegistryLock = threading.RLock()
+
+# Callbacks run by CloseClients, e.g. to drop clients owned by other modules
+_CloseHooks: List[Callable[[], None]] = []
+
+# Background event loop shared by all synchronous wrappers around async LLM calls
+_EventLoop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def LoadClientConfig() -> Dict[str, Any]:
+    """
+    Read Azure OpenAI and HTTP pool configuration from the environment.
+
+    Returns:
+        Dictionary with connection, deployment, pool size and timeout settings
+    """
+    return {
+        'ApiKey': os.getenv("AZURE_OPENAI_API_KEY"),
+        'ApiVersion': os.getenv("AZURE_OPENAI_API_VERSION"),
+        'Endpoint': os.getenv("AZURE_OPENAI_ENDPOINT"),
+        'DeploymentName': os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+        'BatchDeploymentName': os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT_NAME"),
+        'MaxConnections': int(os.getenv("AZURE_OPENAI_MAX_CONNECTIONS", "100")),
+        'MaxKeepAliveConnections': int(os.getenv("AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20")),
+        'KeepAliveExpiry': float(os.getenv("AZURE_OPENAI_KEEPALIVE_EXPIRY", "60")),
+        'ConnectTimeout': float(os.getenv("AZURE_OPENAI_CONNECT_TIMEOUT", "10")),
+        'ReadTimeout': float(os.getenv("AZURE_OPENAI_READ_TIMEOUT", "120")),
+        # Retries are handled by the request scheduler, which honors Retry-After
+        'MaxRetries': int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "0")),
+        'RequestsPerMinute': _GetOptionalFloat("AZURE_OPENAI_REQUESTS_PER_MINUTE"),
+        'TokensPerMinute': _GetOptionalFloat("AZURE_OPENAI_TOKENS_PER_MINUTE"),
+        'SchedulerMaxRetries': int(os.getenv("AZURE_OPENAI_SCHEDULER_MAX_RETRIES", "6")),
+        'SchedulerMaxConcurrency': int(os.getenv("AZURE_OPENAI_SCHEDULER_MAX_CONCURRENCY", "64")),
+        # Optional pool of endpoints/deployments (JSON list or path to a JSON file)
+        'DeploymentPool': os.getenv("AZURE_OPENAI_DEPLOYMENT_POOL"),
+        'ImprovementBackend': os.getenv("AZURE_OPENAI_IMPROVEMENT_BACKEND"),
+        'BackendFailureThreshold': int(os.getenv("AZURE_OPENAI_BACKEND_FAILURE_THRESHOLD", "3")),
+        'BackendCooldown': float(os.getenv("AZURE_OPENAI_BACKEND_COOLDOWN", "30")),
+        # Opt-in duplicate requests for slow evaluation calls
+        'HedgingEnabled': os.getenv("AZURE_OPENAI_HEDGING_ENABLED", "false").lower() in ("1", "true", "yes"),
+        'HedgePercentile': float(os.getenv("AZURE_OPENAI_HEDGE_PERCENTILE", "0.95")),
+        'HedgeMaxExtraRate': float(os.getenv("AZURE_OPENAI_HEDGE_MAX_EXTRA_RATE", "0.05")),
+        'HedgeOtherBackend': os.getenv("AZURE_OPENAI_HEDGE_OTHER_BACKEND", "true").lower() in ("1", "true", "yes")
+    }
+
+
+def _GetOptionalFloat(Name: str) -> Optional[float]:
+    Value = os.getenv(Name)
+    return float(Value) if Value else None
+
+
+def GetClientConfig() -> Dict[str, Any]:
+    """
+    Return the client configuration, reading the environment only on first use.
+
+    Returns:
+        The cached configuration dictionary
+    """
+    global _Config
+    with _RegistryLock:
+        if _Config is None:
+            _Config = LoadClientConfig()
+        return _Config
+
+
+def ConfigureClients(**Overrides: Any) -> Dict[str, Any]:
+    """
+    Override configuration values and recreate the shared clients on next use.
+
+    Args:
+        **Overrides: Configuration keys to replace (same names as LoadClientConfig)
+
+    Returns:
+        The updated configuration dictionary
+    """
+    global _Config
+    CloseClients()
+    with _RegistryLock:
+        _Config = {**LoadClientConfig(), **Overrides}
+        return _Config
+
+
+def GetDeploymentName() -> str:
+    """Return the configured Azure OpenAI deployment name."""
+    return GetClientConfig()['DeploymentName']
+
+
+def _BuildLimits(Config: Dict[str, Any]) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=Config['MaxConnections'],
+        max_keepalive_connections=Config['MaxKeepAliveConnections'],
+        keepalive_expiry=Config['KeepAliveExpiry']
+    )
+
+
+def _BuildTimeout(Config: Dict[str, Any]) -> httpx.Timeout:
+    return httpx.Timeout(Config['ReadTimeout'], connect=Config['ConnectTimeout'])
+
+
+def GetClient() -> AzureOpenAI:
+    """
+    Return the shared synchronous Azure OpenAI client.
+
+    The client keeps its HTTP connections alive in a pool sized by the
+    configuration, so repeated calls reuse connections and TLS sessions.
+
+    Returns:
+        The process-wide AzureOpenAI client
+    """
+    global _Client
+    with _RegistryLock:
+        if _Client is None:
+            Config = GetClientConfig()
+            _Client = AzureOpenAI(
+                api_key=Config['ApiKey'],
+                api_version=Config['ApiVersion'],
+                azure_endpoint=Config['Endpoint'],
+                max_retries=Config['MaxRetries'],
+                timeout=_BuildTimeout(Config),
+                http_client=httpx.Client(limits=_BuildLimits(Config), timeout=_BuildTimeout(Config))
+            )
+        return _Client
+
+
+def GetAsyncClient() -> AsyncAzureOpenAI:
+    """
+    Return the shared async Azure OpenAI client for the running event loop.
+
+    Async connection pools are bound to the loop that opened them, so one
+    client is kept per event loop (normally just the background loop).
+
+    Returns:
+        The AsyncAzureOpenAI client for the current event loop
+    """
+    try:
+        Loop = asyncio.get_running_loop()
+    except RuntimeError:
+        Loop = GetEventLoop()
+
+    with _RegistryLock:
+        Client = _AsyncClients.get(Loop)
+        if Client is None:
+            Client = BuildAsyncClient(GetClientConfig())
+            _AsyncClients[Loop] = Client
+        return Client
+
+
+def BuildAsyncClient(Config: Dict[str, Any]) -> AsyncAzureOpenAI:
+    """
+    Create an async Azure OpenAI client with a pooled HTTP client.
+
+    Args:
+        Config: Configuration dictionary (same keys as LoadClientConfig)
+
+    Returns:
+        A new AsyncAzureOpenAI client; the caller owns and closes it
+    """
+    return AsyncAzureOpenAI(
+        api_key=Config['ApiKey'],
+        api_version=Config['ApiVersion'],
+        azure_endpoint=Config['Endpoint'],
+        max_retries=Config['MaxRetries'],
+        timeout=_BuildTimeout(Config),
+        http_client=httpx.AsyncClient(limits=_BuildLimits(Config), timeout=_BuildTimeout(Config))
+    )
+
+
+def CloseAsyncClient(Loop: asyncio.AbstractEventLoop, Client: AsyncAzureOpenAI) -> None:
+    """
+    Close an async client on the event loop it belongs to.
+
+    Args:
+        Loop: Event loop the client was used on
+        Client: Client to close
+    """
+    if Loop.is_closed():
+        return
+    if Loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(Client.close(), Loop).result(timeout=10)
+        except Exception as Error:
+            print(f"Warning: failed to close async client: {Error}")
+    else:
+        Loop.run_until_complete(Client.close())
+
+
+def RegisterCloseHook(Hook: Callable[[], None]) -> None:
+    """Run Hook whenever CloseClients is called (also at exit and on ConfigureClients)."""
+    with _RegistryLock:
+        _CloseHooks.append(Hook)
+
+
+def GetEventLoop() -> asyncio.AbstractEventLoop:
+    """
+    Return the background event loop used to run async LLM calls from synchronous code.
+
+    The loop lives in a daemon thread, so synchronous callers work the same way
+    whether or not an event loop is already running in the calling thread
+    (e.g. inside a notebook).
+
+    Returns:
+        The running background event loop
+    """
+    global _EventLoop
+    with _RegistryLock:
+        if _EventLoop is None or _EventLoop.is_closed():
+            _EventLoop = asyncio.new_event_loop()
+            threading.Thread(target=_EventLoop.run_forever, name="LLMEventLoop", daemon=True).start()
+        return _EventLoop
+
+
+def SubmitCoroutine(Coroutine: Awaitable[T]) -> concurrent.futures.Future:
+    """
+    Start a coroutine on the background event loop without waiting for it.
+
+    Context variables of the caller (e.g. telemetry tags) are carried over
+    to the coroutine.
+
+    Args:
+        Coroutine: The coroutine to run
+
+    Returns:
+        Future that receives the value returned by the coroutine
+    """
+    Loop = GetEventLoop()
+    try:
+        RunningLoop = asyncio.get_running_loop()
+    except RuntimeError:
+        RunningLoop = None
+    if RunningLoop is Loop:
+        raise RuntimeError("Coroutines cannot be submitted from the background event loop; await them instead")
+    CallerContext = contextvars.copy_context()
+
+    async def RunInCallerContext():
+        for Variable, Value in CallerContext.items():
+            Variable.set(Value)
+        return await Coroutine
+
+    return asyncio.run_coroutine_threadsafe(RunInCallerContext(), Loop)
+
+
+def RunCoroutine(Coroutine: Awaitable[T]) -> T:
+    """
+    Run a coroutine on the background event loop and wait for its result.
+
+    Context variables of the caller (e.g. telemetry tags) are carried over
+    to the coroutine.
+
+    Args:
+        Coroutine: The coroutine to run
+
+    Returns:
+        The value returned by the coroutine
+    """
+    return SubmitCoroutine(Coroutine).result()
+
+
+def CloseClients() -> None:
+    """
+    Close every shared client and release pooled connections.
+
+    Registered with atexit; safe to call more than once. Clients are created
+    again on next use.
+    """
+    global _Client
+    with _RegistryLock:
+        if _Client is not None:
+            _Client.close()
+            _Client = None
+
+        for Loop, Client in list(_AsyncClients.items()):
+            CloseAsyncClient(Loop, Client)
+        _AsyncClients.clear()
+        Hooks = list(_CloseHooks)
+
+    # Outside the registry lock, since hooks may take their own locks
+    for Hook in Hooks:
+        Hook()
+
+
+atexit.register(CloseClients)
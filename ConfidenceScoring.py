@@ -0,0 +1,241 @@
+import os
+import math
+import json
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, List, Optional, Sequence
+from LabelExtraction import NormalizeLabelText
+from OutputGeneration import CreateChatCompletionAsync
+from PromptTemplate import BuildRowMessages, DefaultPromptLayout
+
+# Alternatives returned per output token in constrained mode (Azure allows up to 20)
+DefaultTopLogprobs = int(os.getenv("CONSTRAINED_TOP_LOGPROBS", "5"))
+
+# Number of equal-width confidence bins in calibration reports
+DefaultCalibrationBins = int(os.getenv("CALIBRATION_BINS", "10"))
+
+# Characters ignored around a label token, e.g. quotes or markdown emphasis
+_TokenPunctuation = ' \t\n"\'`*.:'
+
+
+def GetConstrainedParameters(UniqueLabels: Sequence[str], TopLogprobs: int = DefaultTopLogprobs) -> Dict[str, Any]:
+    """
+    Return sampling parameters for a short, label-only classification answer.
+
+    max_tokens only leaves room for the longest label, generation stops at
+    the first line break, and the top logprobs of every output token are
+    requested for confidence scoring.
+
+    Args:
+        UniqueLabels: Possible label values
+        TopLogprobs: Alternatives returned per output token
+
+    Returns:
+        Parameters for CreateChatCompletionAsync
+    """
+    # Labels tokenize less efficiently than prose, so allow about two characters per token
+    MaxTokens = max(len(str(Label)) // 2 + 2 for Label in UniqueLabels)
+    return {
+        'max_tokens': MaxTokens,
+        'temperature': 0,
+        'stop': ["\n"],
+        'logprobs': True,
+        'top_logprobs': TopLogprobs
+    }
+
+
+def BuildConstrainedMessages(RowMessages: List[Dict[str, str]], UniqueLabels: Sequence[str]) -> List[Dict[str, str]]:
+    """
+    Add an instruction to answer with the label only to a row's messages.
+
+    The instruction goes first in the system message, so it stays part of
+    the static prefix shared by every row.
+
+    Args:
+        RowMessages: Messages of one row, as built by BuildRowMessages
+        UniqueLabels: Possible label values
+
+    Returns:
+        Chat messages for a constrained classification request
+    """
+    LabelList = ", ".join(str(Label) for Label in UniqueLabels)
+    Instruction = f"Answer with exactly one of these labels and nothing else: {LabelList}"
+    if RowMessages[0]['role'] == 'system':
+        return [{"role": "system", "content": f"{Instruction}\n\n{RowMessages[0]['content']}"}] + RowMessages[1:]
+    return [{"role": "system", "content": Instruction}] + RowMessages
+
+
+def ExtractLabelProbabilities(Logprobs: Optional[List[Dict[str, Any]]], UniqueLabels: Sequence[str],
+                              Output: str = "") -> Dict[str, float]:
+    """
+    Turn the top logprobs of the first label token into a distribution over labels.
+
+    Each alternative at the first content token counts toward the labels it
+    starts. An alternative shared by several labels (e.g. 'Not' for
+    'Not relevant' and 'Not sure') goes to the label in the actual output if
+    it is one of them, otherwise it is split evenly. Probability mass on
+    tokens that start no label is dropped and the rest renormalized.
+
+    Args:
+        Logprobs: Payload 'Logprobs' of a constrained request
+        UniqueLabels: Possible label values
+        Output: Generated text, used to resolve shared prefixes
+
+    Returns:
+        Probability per label summing to 1, or an empty dict if no alternative matches a label
+    """
+    if not Logprobs:
+        return {}
+
+    # Skip leading tokens that are only whitespace or quotes
+    Position = next((Index for Index, Item in enumerate(Logprobs) if Item['Token'].strip(_TokenPunctuation)), None)
+    if Position is None:
+        return {}
+    Alternatives = Logprobs[Position]['TopLogprobs'] or [
+        {'Token': Logprobs[Position]['Token'], 'Logprob': Logprobs[Position]['Logprob']}
+    ]
+
+    Labels = [str(Label) for Label in UniqueLabels]
+    NormalizedLabels = {Label: NormalizeLabelText(Label) for Label in Labels}
+    NormalizedOutput = NormalizeLabelText(Output or "")
+
+    Probabilities = dict.fromkeys(Labels, 0.0)
+    for Alternative in Alternatives:
+        Token = NormalizeLabelText(Alternative['Token'].strip(_TokenPunctuation))
+        if not Token:
+            continue
+        Matches = [Label for Label in Labels if NormalizedLabels[Label].startswith(Token)]
+        if not Matches:
+            continue
+        Chosen = [Label for Label in Matches if NormalizedOutput.startswith(NormalizedLabels[Label])]
+        Targets = Chosen[:1] or Matches
+        for Label in Targets:
+            Probabilities[Label] += math.exp(Alternative['Logprob']) / len(Targets)
+
+    Total = sum(Probabilities.values())
+    if Total <= 0:
+        return {}
+    return {Label: Probability / Total for Label, Probability in Probabilities.items()}
+
+
+async def GenerateLabelAsync(Prompt: str, Variables: Dict[str, Any], UniqueLabels: Sequence[str],
+                             TopLogprobs: int = DefaultTopLogprobs, Layout: str = DefaultPromptLayout) -> Dict[str, Any]:
+    """
+    Classify one row with a short, label-only answer and score the label probabilities.
+
+    Args:
+        Prompt: The prompt template with placeholders for features
+        Variables: Feature values of the row
+        UniqueLabels: Possible label values
+        TopLogprobs: Alternatives returned per output token
+        Layout: Message layout of the prompt (see BuildRowMessages)
+
+    Returns:
+        Dictionary with 'Content' (the raw answer) and 'Probabilities' (label -> probability, empty if unavailable)
+    """
+    Response = await CreateChatCompletionAsync(
+        Messages=BuildConstrainedMessages(BuildRowMessages(Prompt, Variables, Layout), UniqueLabels),
+        **GetConstrainedParameters(UniqueLabels, TopLogprobs)
+    )
+    Content = Response['Content'] or ""
+    return {
+        'Content': Content,
+        'Probabilities': ExtractLabelProbabilities(Response.get('Logprobs'), UniqueLabels, Content)
+    }
+
+
+def AttachConfidence(ResultDataFrame: pd.DataFrame, Probabilities: List[Dict[str, float]]) -> pd.DataFrame:
+    """
+    Add 'Confidence' and 'LabelProbabilities' columns to scored results.
+
+    Args:
+        ResultDataFrame: Scored results with an 'ExtractedLabel' column
+        Probabilities: Label distribution per row, in row order (empty when unavailable)
+
+    Returns:
+        The same DataFrame; 'Confidence' is the probability of the extracted
+        label (NaN without logprobs or label), 'LabelProbabilities' the full
+        distribution as JSON
+    """
+    ResultDataFrame['Confidence'] = [
+        Distribution.get(Label, 0.0) if Distribution and Label else np.nan
+        for Distribution, Label in zip(Probabilities, ResultDataFrame['ExtractedLabel'])
+    ]
+    ResultDataFrame['LabelProbabilities'] = [
+        json.dumps(Distribution, sort_keys=True) if Distribution else "" for Distribution in Probabilities
+    ]
+    return ResultDataFrame
+
+
+def ComputeCalibration(ResultDataFrame: pd.DataFrame, LabelColumn: str,
+                       Bins: int = DefaultCalibrationBins) -> Dict[str, Any]:
+    """
+    Compare stated confidence with observed accuracy.
+
+    Rows are grouped into equal-width confidence bins. The expected
+    calibration error (ECE) is the row-weighted mean gap between confidence
+    and accuracy over the bins; the maximum calibration error (MCE) is the
+    largest gap.
+
+    Args:
+        ResultDataFrame: Results with 'Confidence' and 'ExtractedLabel' columns
+        LabelColumn: The column name containing true labels
+        Bins: Number of confidence bins
+
+    Returns:
+        Dictionary containing:
+        - 'Bins': DataFrame with Lower, Upper, Rows, MeanConfidence, Accuracy and Gap per non-empty bin
+        - 'ECE', 'MCE': calibration errors (NaN without scored rows)
+        - 'Rows': rows with a confidence score
+        - 'MeanConfidence', 'Accuracy': over the scored rows
+    """
+    Scored = ResultDataFrame[ResultDataFrame['Confidence'].notna()] if 'Confidence' in ResultDataFrame.columns \
+        else ResultDataFrame.iloc[0:0]
+    if Scored.empty:
+        return {'Bins': pd.DataFrame(columns=['Lower', 'Upper', 'Rows', 'MeanConfidence', 'Accuracy', 'Gap']),
+                'ECE': np.nan, 'MCE': np.nan, 'Rows': 0, 'MeanConfidence': np.nan, 'Accuracy': np.nan}
+
+    Confidence = Scored['Confidence'].to_numpy(dtype=float)
+    Correct = (Scored['ExtractedLabel'].astype(str) == Scored[LabelColumn].astype(str)).to_numpy()
+
+    # Confidence 1.0 belongs to the last bin
+    BinIndex = np.minimum((Confidence * Bins).astype(int), Bins - 1)
+    Table = pd.DataFrame({'Bin': BinIndex, 'Confidence': Confidence, 'Correct': Correct}).groupby('Bin').agg(
+        Rows=('Correct', 'size'), MeanConfidence=('Confidence', 'mean'), Accuracy=('Correct', 'mean')
+    )
+    Table.insert(0, 'Lower', Table.index / Bins)
+    Table.insert(1, 'Upper', (Table.index + 1) / Bins)
+    Table['Gap'] = (Table['MeanConfidence'] - Table['Accuracy']).abs()
+    Table = Table.reset_index(drop=True)
+
+    return {
+        'Bins': Table,
+        'ECE': float((Table['Rows'] * Table['Gap']).sum() / len(Scored)),
+        'MCE': float(Table['Gap'].max()),
+        'Rows': len(Scored),
+        'MeanConfidence': float(Confidence.mean()),
+        'Accuracy': float(Correct.mean())
+    }
+
+
+def FormatCalibrationReport(Calibration: Dict[str, Any]) -> str:
+    """
+    Render a calibration result as a reliability table.
+
+    Args:
+        Calibration: Result of ComputeCalibration
+
+    Returns:
+        Multi-line report
+    """
+    if Calibration['Rows'] == 0:
+        return "Calibration: no confidence scores available"
+
+    Lines = [
+        f"Calibration over {Calibration['Rows']} rows: ECE {Calibration['ECE']:.3f}, MCE {Calibration['MCE']:.3f}, "
+        f"mean confidence {Calibration['MeanConfidence']:.2%}, accuracy {Calibration['Accuracy']:.2%}",
+        f"  {'Bin':<11} {'Rows':>6} {'Confidence':>11} {'Accuracy':>9}"
+    ]
+    for Row in Calibration['Bins'].itertuples(index=False):
+        Lines.append(f"  {Row.Lower:.1f}-{Row.Upper:.1f}    {Row.Rows:>6} {Row.MeanConfidence:>11.2%} {Row.Accuracy:>9.2%}")
+    return "\n".join(Lines)
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, Optional, Sequence
+from PredictionStore import PredictionStore
+
+
+class CorrectnessIndex:
+    """
+    Rows x prompts matrix of correct predictions, packed as bits.
+
+    Built from the correctness bitmaps of a PredictionStore, so it covers
+    every prompt evaluated in a run, including prompts whose raw outputs were
+    released. Each query is a few bitwise operations over packed rows and
+    returns dataset row ids.
+    """
+
+    def __init__(self, Store: PredictionStore, ResultIds: Optional[Sequence[str]] = None):
+        """
+        Args:
+            Store: Prediction store of the run
+            ResultIds: Prompts to index, in evaluation order (default: all prompts in the store)
+        """
+        self.Store = Store
+        self.ResultIds = list(ResultIds) if ResultIds is not None else list(Store.Entries)
+        self._Position = {ResultId: Position for Position, ResultId in enumerate(self.ResultIds)}
+        Width = (Store.RowCount + 7) // 8
+        Arrays = [Store.Entries[ResultId]['Arrays'] for ResultId in self.ResultIds]
+        self.Correct = np.array([Item['Correct'] for Item in Arrays], dtype=np.uint8).reshape(-1, Width)
+        self.Evaluated = np.array([Item['Evaluated'] for Item in Arrays], dtype=np.uint8).reshape(-1, Width)
+
+    def _Rows(self, Bits: np.ndarray) -> pd.Index:
+        return self.Store.RowIds[np.flatnonzero(np.unpackbits(Bits, count=self.Store.RowCount))]
+
+    def _Counts(self, Matrix: np.ndarray) -> np.ndarray:
+        # Per-row count of set bits over the indexed prompts
+        return np.unpackbits(Matrix, axis=1, count=self.Store.RowCount).sum(axis=0, dtype=np.int32)
+
+    def GetRegressedRows(self, FromId: str, ToId: str) -> pd.Index:
+        """Return the rows FromId classified correctly and ToId got wrong (rows both evaluated)."""
+        From, To = self._Position[FromId], self._Position[ToId]
+        return self._Rows(self.Correct[From] & ~self.Correct[To] & self.Evaluated[To])
+
+    def GetImprovedRows(self, FromId: str, ToId: str) -> pd.Index:
+        """Return the rows FromId got wrong and ToId classified correctly (rows both evaluated)."""
+        From, To = self._Position[FromId], self._Position[ToId]
+        return self._Rows(~self.Correct[From] & self.Evaluated[From] & self.Correct[To])
+
+    def GetAlwaysFailingRows(self, MinPrompts: int = 2) -> pd.Index:
+        """
+        Return the rows no indexed prompt has classified correctly.
+
+        Args:
+            MinPrompts: Prompts a row must have been evaluated by to count
+
+        Returns:
+            Row ids, often mislabeled or genuinely ambiguous examples
+        """
+        if not self.ResultIds:
+            return self.Store.RowIds[:0]
+        NeverCorrect = ~np.bitwise_or.reduce(self.Correct, axis=0)
+        Mask = np.unpackbits(NeverCorrect, count=self.Store.RowCount).astype(bool)
+        Mask &= self._Counts(self.Evaluated) >= MinPrompts
+        return self.Store.RowIds[Mask]
+
+    def GetFlipCounts(self) -> pd.Series:
+        """Return, per row, how often correctness changed between consecutive indexed prompts that both evaluated it."""
+        if len(self.ResultIds) < 2:
+            return pd.Series(0, index=self.Store.RowIds)
+        Flips = (self.Correct[:-1] ^ self.Correct[1:]) & self.Evaluated[:-1] & self.Evaluated[1:]
+        return pd.Series(self._Counts(Flips), index=self.Store.RowIds)
+
+    def GetFlippingRows(self, MinFlips: int = 2) -> pd.Index:
+        """Return the rows whose correctness changed at least MinFlips times across the indexed prompts."""
+        Counts = self.GetFlipCounts()
+        return Counts.index[Counts.to_numpy() >= MinFlips]
+
+    def Summarize(self) -> Dict[str, Any]:
+        """
+        Summarize row stability across the indexed prompts.
+
+        Returns:
+            Dictionary with Prompts, Rows, AlwaysCorrect, AlwaysFailing, Flipping
+            (rows that changed at least once) and MeanAccuracy
+        """
+        Evaluated = self._Counts(self.Evaluated)
+        Correct = self._Counts(self.Correct)
+        Seen = Evaluated > 0
+        return {
+            'Prompts': len(self.ResultIds),
+            'Rows': int(Seen.sum()),
+            'AlwaysCorrect': int((Seen & (Correct == Evaluated)).sum()),
+            'AlwaysFailing': int((Seen & (Correct == 0)).sum()),
+            'Flipping': int((self.GetFlipCounts() > 0).sum()),
+            'MeanAccuracy': float(Correct.sum() / Evaluated.sum()) if Evaluated.sum() else 0.0
+        }
+
+
+def FormatCorrectnessReport(Index: CorrectnessIndex, Examples: int = 3) -> str:
+    """
+    Format a short cross-iteration report.
+
+    Args:
+        Index: Correctness index of the run
+        Examples: Row ids shown per category
+
+    Returns:
+        Report lines
+    """
+    Summary = Index.Summarize()
+    AlwaysFailing = Index.GetAlwaysFailingRows()
+    Flipping = Index.GetFlippingRows()
+    return "\n".join([
+        f"Across {Summary['Prompts']} prompts and {Summary['Rows']} rows: {Summary['AlwaysCorrect']} always correct, "
+        f"{Summary['AlwaysFailing']} always wrong, {Summary['Flipping']} changed at least once",
+        f"  Always wrong (check the labels): {list(AlwaysFailing[:Examples])}",
+        f"  Unstable (flipped twice or more): {len(Flipping)} rows, e.g. {list(Flipping[:Examples])}"
+    ])
@@ -0,0 +1,508 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import pandas as pd
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from ClientRegistry import (
+    BuildAsyncClient, CloseAsyncClient, GetAsyncClient, GetClientConfig, RegisterCloseHook
+)
+from RequestHedging import HedgePolicy
+from RequestScheduler import GetRequestScheduler, GetRequestSchedulers, IsRetryable, RequestScheduler
+
+# Purposes a chat completion can be routed for
+Purposes = ('Evaluation', 'Improvement')
+
+# Weight of the newest observation in the latency and error rate averages
+SmoothingFactor = 0.2
+
+
+class Backend:
+    """
+    One endpoint/deployment pair with its own clients, quota budget and health.
+
+    Clients and schedulers are kept per event loop, like the shared ones in
+    ClientRegistry and RequestScheduler. The default backend (no pool
+    configured) uses exactly those shared objects.
+    """
+
+    def __init__(self, Name: str, Config: Dict[str, Any], Weight: float = 1.0, Model: Optional[str] = None,
+                 Evaluation: bool = True, IsDefault: bool = False):
+        """
+        Args:
+            Name: Backend name used in configuration, logs and telemetry
+            Config: Client configuration of this backend (same keys as LoadClientConfig)
+            Weight: Relative share of evaluation traffic at equal latency and budget
+            Model: Model identity used for response cache keys (default: the deployment name)
+            Evaluation: Whether the backend serves evaluation traffic
+            IsDefault: Use the shared client and scheduler of the single-deployment setup
+        """
+        self.Name = Name
+        self.Config = Config
+        self.DeploymentName = Config['DeploymentName']
+        self.Model = Model or Config['DeploymentName']
+        self.Weight = Weight
+        self.Evaluation = Evaluation
+        self.IsDefault = IsDefault
+
+        self.LatencyAverage: Optional[float] = None
+        self.ErrorRate = 0.0
+        self.ConsecutiveFailures = 0
+        self.CooldownUntil = 0.0
+        self.Ejections = 0
+        self.Stats = {'Requests': 0, 'Failures': 0}
+
+        self._AsyncClients: Dict[asyncio.AbstractEventLoop, Any] = {}
+        self._Schedulers: Dict[asyncio.AbstractEventLoop, RequestScheduler] = {}
+        self._Lock = threading.Lock()
+
+    def GetAsyncClient(self) -> Any:
+        """Return the async client of this backend for the running event loop."""
+        if self.IsDefault:
+            return GetAsyncClient()
+        Loop = asyncio.get_running_loop()
+        with self._Lock:
+            if Loop not in self._AsyncClients:
+                self._AsyncClients[Loop] = BuildAsyncClient(self.Config)
+            return self._AsyncClients[Loop]
+
+    def GetScheduler(self) -> RequestScheduler:
+        """Return the request scheduler enforcing this backend's quota for the running event loop."""
+        if self.IsDefault:
+            return GetRequestScheduler()
+        Loop = asyncio.get_running_loop()
+        with self._Lock:
+            if Loop not in self._Schedulers:
+                self._Schedulers[Loop] = RequestScheduler(
+                    RequestsPerMinute=self.Config['RequestsPerMinute'],
+                    TokensPerMinute=self.Config['TokensPerMinute'],
+                    MaxRetries=self.Config['SchedulerMaxRetries'],
+                    MaxConcurrency=self.Config['SchedulerMaxConcurrency']
+                )
+            return self._Schedulers[Loop]
+
+    def GetSchedulers(self) -> List[RequestScheduler]:
+        """Return the schedulers of this backend on every event loop that has used it."""
+        if self.IsDefault:
+            return GetRequestSchedulers()
+        with self._Lock:
+            return list(self._Schedulers.values())
+
+    def IsHealthy(self) -> bool:
+        """Return whether the backend is in rotation (not cooling down after failures)."""
+        return time.monotonic() >= self.CooldownUntil
+
+    def GetBudgetFraction(self) -> float:
+        """Return the remaining share of the backend's request and token budgets (0 when throttled)."""
+        Scheduler = self.GetScheduler()
+        if Scheduler.IsThrottled():
+            return 0.0
+        Fractions = [1.0]
+        for Bucket in (Scheduler.RequestBucket, Scheduler.TokenBucket):
+            if Bucket is not None:
+                Fractions.append(max(0.0, Bucket.GetAvailable() / Bucket.Capacity))
+        Fractions.append(max(0.0, 1 - Scheduler.InFlight / Scheduler.ConcurrencyLimit))
+        return min(Fractions)
+
+    def RecordSuccess(self, Latency: float) -> None:
+        """Update latency and error averages after a successful call."""
+        self.Stats['Requests'] += 1
+        self.LatencyAverage = Latency if self.LatencyAverage is None else (
+            SmoothingFactor * Latency + (1 - SmoothingFactor) * self.LatencyAverage
+        )
+        self.ErrorRate *= 1 - SmoothingFactor
+        self.ConsecutiveFailures = 0
+
+    def RecordFailure(self, FailureThreshold: int, Cooldown: float) -> None:
+        """
+        Update the error average after a failed call and eject the backend if it keeps failing.
+
+        Args:
+            FailureThreshold: Consecutive failures before the backend leaves rotation
+            Cooldown: Base seconds out of rotation; doubles with every further ejection
+        """
+        self.Stats['Requests'] += 1
+        self.Stats['Failures'] += 1
+        self.ErrorRate = SmoothingFactor + (1 - SmoothingFactor) * self.ErrorRate
+        self.ConsecutiveFailures += 1
+        if self.ConsecutiveFailures >= FailureThreshold:
+            Delay = min(Cooldown * 2 ** self.Ejections, Cooldown * 10)
+            self.CooldownUntil = time.monotonic() + Delay
+            self.Ejections += 1
+            self.ConsecutiveFailures = 0
+            print(f"Warning: backend {self.Name} taken out of rotation for {Delay:.0f}s after repeated failures")
+
+    def Close(self) -> None:
+        """Close the clients owned by this backend."""
+        with self._Lock:
+            for Loop, Client in list(self._AsyncClients.items()):
+                CloseAsyncClient(Loop, Client)
+            self._AsyncClients.clear()
+            self._Schedulers.clear()
+
+
+class DeploymentRouter:
+    """
+    Spreads chat completions over a pool of Azure OpenAI backends.
+
+    Evaluation calls go to a backend drawn with probability proportional to
+    its weight times its remaining budget, divided by its average latency and
+    discounted by its recent error rate. Backends that fail repeatedly are
+    taken out of rotation for a cooldown and return automatically afterwards.
+    Improvement calls can be pinned to one backend so prompts are always
+    written by the same model. With a HedgePolicy, slow evaluation calls get
+    a duplicate request and the first answer wins.
+    """
+
+    def __init__(self, Backends: Sequence[Backend], ImprovementBackend: Optional[str] = None,
+                 FailureThreshold: int = 3, Cooldown: float = 30.0, RandomState: Optional[int] = None,
+                 Hedging: Optional[HedgePolicy] = None):
+        """
+        Args:
+            Backends: Backends in the pool
+            ImprovementBackend: Name of the backend serving improvement calls (default: routed like evaluation)
+            FailureThreshold: Consecutive failures before a backend leaves rotation
+            Cooldown: Base seconds a failing backend stays out of rotation
+            RandomState: Seed for backend selection
+            Hedging: Optional policy for duplicating slow evaluation calls
+        """
+        if not Backends:
+            raise ValueError("DeploymentRouter needs at least one backend")
+        self.Backends = list(Backends)
+        self.BackendsByName = {Item.Name: Item for Item in self.Backends}
+        if ImprovementBackend is not None and ImprovementBackend not in self.BackendsByName:
+            raise ValueError(f"Unknown improvement backend {ImprovementBackend!r}, "
+                             f"expected one of {list(self.BackendsByName)}")
+        self.ImprovementBackend = ImprovementBackend
+        self.FailureThreshold = FailureThreshold
+        self.Cooldown = Cooldown
+        self.Hedging = Hedging
+        self._Random = random.Random(RandomState)
+
+    def GetScore(self, Item: Backend) -> float:
+        """Return the relative selection score of a backend."""
+        KnownLatencies = [Other.LatencyAverage for Other in self.Backends if Other.LatencyAverage is not None]
+        # Untried backends are assumed to be as fast as the average one
+        Latency = Item.LatencyAverage if Item.LatencyAverage is not None else (
+            sum(KnownLatencies) / len(KnownLatencies) if KnownLatencies else 1.0
+        )
+        return Item.Weight * (0.05 + Item.GetBudgetFraction()) * (1 - min(Item.ErrorRate, 0.95)) / max(Latency, 0.01)
+
+    def Select(self, Purpose: str = 'Evaluation', Exclude: Sequence[Backend] = ()) -> Backend:
+        """
+        Choose the backend for the next call.
+
+        Args:
+            Purpose: 'Evaluation' or 'Improvement'
+            Exclude: Backends not to choose (e.g. one that just failed)
+
+        Returns:
+            Selected backend
+        """
+        if Purpose not in Purposes:
+            raise ValueError(f"Purpose must be one of {Purposes}, got {Purpose!r}")
+        if Purpose == 'Improvement' and self.ImprovementBackend is not None:
+            return self.BackendsByName[self.ImprovementBackend]
+
+        Candidates = [Item for Item in self.Backends if Item.Evaluation and Item not in Exclude] or \
+            [Item for Item in self.Backends if Item.Evaluation] or self.Backends
+        Healthy = [Item for Item in Candidates if Item.IsHealthy()]
+        if not Healthy:
+            # Everything is cooling down: use the backend that returns first
+            return min(Candidates, key=lambda Item: Item.CooldownUntil)
+
+        Scores = [self.GetScore(Item) for Item in Healthy]
+        return self._Random.choices(Healthy, weights=Scores)[0]
+
+    async def Execute(self, Selected: Backend, Messages: List[Dict[str, Any]], Parameters: Dict[str, Any],
+                      EstimatedTokens: int, Purpose: str = 'Evaluation',
+                      CallStats: Optional[Dict[str, Any]] = None) -> Tuple[Any, Backend]:
+        """
+        Send a chat completion through the selected backend's scheduler.
+
+        A retryable failure that survives the backend's own retries is sent
+        once more to another healthy backend, unless the call is pinned.
+
+        With hedging enabled, an evaluation call whose request has been in
+        flight for the policy's delay is duplicated (on another backend if the
+        policy asks for it and the pool has one). Time spent queued for a
+        slot or quota does not count, and the policy learns from the service
+        time of completed requests only. The first successful answer is used
+        and the other request is cancelled. No hedge is sent while the rate
+        cap is reached, the hedge backend is throttled or out of budget, or
+        the hedge would queue behind the primary on the same backend.
+
+        Args:
+            Selected: Backend returned by Select
+            Messages: Chat messages to send
+            Parameters: Sampling parameters passed to the API
+            EstimatedTokens: Tokens the request is expected to consume
+            Purpose: 'Evaluation' or 'Improvement'
+            CallStats: Optional dictionary receiving 'Attempts', 'Throttled', 'AttemptSeconds',
+                'Hedged', 'HedgeWon' and 'HedgeSavedSeconds'
+
+        Returns:
+            Tuple of the API response and the backend that served it
+        """
+        if CallStats is None:
+            CallStats = {}
+        CallStats.update({'Attempts': 0, 'Throttled': 0, 'AttemptSeconds': 0.0,
+                          'Hedged': False, 'HedgeWon': False, 'HedgeSavedSeconds': 0.0})
+        Policy = self.Hedging if Purpose == 'Evaluation' else None
+        if Policy is None:
+            return await self._ExecuteWithFailover(Selected, Messages, Parameters, EstimatedTokens, Purpose, CallStats)
+
+        Delay = Policy.GetDelay()
+        Arms = {}
+        PrimaryStats = {'Attempts': 0, 'Throttled': 0, 'AttemptSeconds': 0.0}
+        Primary = asyncio.ensure_future(
+            self._ExecuteWithFailover(Selected, Messages, Parameters, EstimatedTokens, Purpose, PrimaryStats)
+        )
+        Arms[Primary] = PrimaryStats
+        try:
+            if Delay is not None and await _WaitInFlight(Primary, PrimaryStats, Delay):
+                HedgeBackend = self.Select(Purpose, Exclude=[Selected]) if Policy.UseOtherBackend else Selected
+                # A duplicate on the primary's own backend only helps if it is sent right away
+                Busy = HedgeBackend is Selected and not HedgeBackend.GetScheduler().HasFreeSlot()
+                if not Busy and HedgeBackend.IsHealthy() and HedgeBackend.GetBudgetFraction() > 0 \
+                        and Policy.TryAcquire():
+                    HedgeStats = {'Attempts': 0, 'Throttled': 0, 'AttemptSeconds': 0.0}
+                    Hedge = asyncio.ensure_future(self._ExecuteWithFailover(
+                        HedgeBackend, Messages, Parameters, EstimatedTokens, Purpose, HedgeStats
+                    ))
+                    Arms[Hedge] = HedgeStats
+
+            Winner = await _FirstSuccessful(list(Arms))
+        finally:
+            # Service time of the primary's request so far, read before cancelling it
+            PrimaryStarted = (PrimaryStats.get('Current') or {}).get('AttemptStarted')
+            PrimaryRunning = time.monotonic() - PrimaryStarted if PrimaryStarted is not None else 0.0
+            # Cancel the slower request and let its scheduler release the slot
+            Pending = [Arm for Arm in Arms if not Arm.done()]
+            for Arm in Pending:
+                Arm.cancel()
+            if Pending:
+                await asyncio.gather(*Pending, return_exceptions=True)
+            for Arm, Stats in Arms.items():
+                # A cancelled arm had a request in flight that its stats do not show yet
+                if Arm.cancelled():
+                    CallStats['Attempts'] += max(Stats['Attempts'], 1)
+                else:
+                    Arm.exception()
+                    CallStats['Attempts'] += Stats['Attempts']
+                CallStats['Throttled'] += Stats['Throttled']
+
+        # Learn only from requests that completed, never from one cut short by the other arm
+        for Arm, Stats in Arms.items():
+            if Arm.done() and not Arm.cancelled() and Arm.exception() is None:
+                Policy.RecordLatency(Stats['AttemptSeconds'])
+        CallStats['AttemptSeconds'] = Arms[Winner]['AttemptSeconds']
+        CallStats['Hedged'] = len(Arms) > 1
+        if Winner is not Primary:
+            Saved = Policy.EstimateSaving(PrimaryRunning)
+            Policy.RecordWin(Saved)
+            CallStats.update({'HedgeWon': True, 'HedgeSavedSeconds': Saved})
+        return Winner.result()
+
+    async def _ExecuteWithFailover(self, Selected: Backend, Messages: List[Dict[str, Any]],
+                                   Parameters: Dict[str, Any], EstimatedTokens: int, Purpose: str,
+                                   CallStats: Dict[str, Any]) -> Tuple[Any, Backend]:
+        CallStats.update({'Attempts': 0, 'Throttled': 0, 'AttemptSeconds': 0.0})
+        Pinned = Purpose == 'Improvement' and self.ImprovementBackend is not None
+
+        Tried = []
+        while True:
+            Tried.append(Selected)
+            # Exposed as 'Current' so a hedging caller can see when the request is actually sent
+            BackendStats = CallStats['Current'] = {}
+            StartTime = time.monotonic()
+            try:
+                Response = await Selected.GetScheduler().Execute(
+                    lambda: Selected.GetAsyncClient().chat.completions.create(
+                        model=Selected.DeploymentName,
+                        messages=Messages,
+                        **Parameters
+                    ),
+                    EstimatedTokens=EstimatedTokens,
+                    CallStats=BackendStats
+                )
+            except Exception as Error:
+                _MergeCallStats(CallStats, BackendStats)
+                if IsRetryable(Error):
+                    Selected.RecordFailure(self.FailureThreshold, self.Cooldown)
+                Alternatives = [Item for Item in self.Backends
+                                if Item not in Tried and Item.Evaluation and Item.IsHealthy()]
+                if Pinned or not IsRetryable(Error) or not Alternatives:
+                    raise
+                print(f"Warning: backend {Selected.Name} failed ({Error}), retrying on another backend")
+                Selected = self.Select(Purpose, Exclude=Tried)
+                continue
+
+            _MergeCallStats(CallStats, BackendStats)
+            Selected.RecordSuccess(BackendStats['AttemptSeconds'] or time.monotonic() - StartTime)
+            return Response, Selected
+
+    def GetStats(self) -> pd.DataFrame:
+        """
+        Return the live routing state of every backend.
+
+        Returns:
+            DataFrame indexed by backend name with Deployment, Weight, Healthy,
+            LatencyAverage, ErrorRate, Requests, Failures and Ejections
+        """
+        return pd.DataFrame([{
+            'Backend': Item.Name,
+            'Deployment': Item.DeploymentName,
+            'Weight': Item.Weight,
+            'Healthy': Item.IsHealthy(),
+            'LatencyAverage': Item.LatencyAverage,
+            'ErrorRate': Item.ErrorRate,
+            'Requests': Item.Stats['Requests'],
+            'Failures': Item.Stats['Failures'],
+            'Ejections': Item.Ejections
+        } for Item in self.Backends]).set_index('Backend')
+
+    def GetJobStats(self) -> pd.DataFrame:
+        """
+        Return how the request queues have served each job.
+
+        Returns:
+            DataFrame indexed by job name (None for calls outside a job) with
+            Requests, WaitSeconds and MeanWaitSeconds (time spent queued for an in-flight slot)
+        """
+        Totals: Dict[Optional[str], Dict[str, float]] = {}
+        for Item in self.Backends:
+            for Scheduler in Item.GetSchedulers():
+                for Job, Stats in list(Scheduler.JobStats.items()):
+                    Total = Totals.setdefault(Job, {'Requests': 0, 'WaitSeconds': 0.0})
+                    Total['Requests'] += Stats['Requests']
+                    Total['WaitSeconds'] += Stats['WaitSeconds']
+        Stats = pd.DataFrame([{'Job': Job, **Total} for Job, Total in Totals.items()],
+                             columns=['Job', 'Requests', 'WaitSeconds']).set_index('Job')
+        Stats['MeanWaitSeconds'] = (Stats['WaitSeconds'] / Stats['Requests']).where(Stats['Requests'] > 0, 0.0)
+        return Stats
+
+    def GetTokensPerMinute(self) -> Optional[float]:
+        """Return the combined token quota of the backends, or None if any backend has no token budget."""
+        Quotas = [Item.Config['TokensPerMinute'] for Item in self.Backends]
+        return None if not all(Quotas) else float(sum(Quotas))
+
+    def Close(self) -> None:
+        """Close the clients owned by the backends."""
+        for Item in self.Backends:
+            Item.Close()
+
+
+async def _WaitInFlight(Primary: asyncio.Future, PrimaryStats: Dict[str, Any], Delay: float) -> bool:
+    # Wait until the primary's request has been in flight for Delay seconds; False if it finishes first
+    while not Primary.done():
+        Started = (PrimaryStats.get('Current') or {}).get('AttemptStarted')
+        Remaining = Delay if Started is None else Started + Delay - time.monotonic()
+        if Started is not None and Remaining <= 0:
+            return True
+        await asyncio.wait({Primary}, timeout=max(Remaining, 0.01))
+    return False
+
+
+async def _FirstSuccessful(Arms: List[asyncio.Future]) -> asyncio.Future:
+    # Return the first arm that completes without error; raise the first error if all fail
+    Pending = set(Arms)
+    FirstError = None
+    while Pending:
+        Done, Pending = await asyncio.wait(Pending, return_when=asyncio.FIRST_COMPLETED)
+        for Arm in sorted(Done, key=Arms.index):
+            if Arm.exception() is None:
+                return Arm
+            FirstError = FirstError or Arm.exception()
+    raise FirstError
+
+
+def _MergeCallStats(Total: Dict[str, Any], Attempt: Dict[str, Any]) -> None:
+    Total['Attempts'] += Attempt.get('Attempts', 0)
+    Total['Throttled'] += Attempt.get('Throttled', 0)
+    Total['AttemptSeconds'] = Attempt.get('AttemptSeconds', Total['AttemptSeconds'])
+
+
+def LoadDeploymentPool(Config: Dict[str, Any]) -> List[Backend]:
+    """
+    Build the backends described by the DeploymentPool setting.
+
+    The pool is a JSON list (inline or in a file) of objects with 'Name',
+    'Endpoint', 'DeploymentName' and optionally 'ApiKey' or 'ApiKeyEnv',
+    'ApiVersion', 'Weight', 'Model', 'Evaluation', 'RequestsPerMinute',
+    'TokensPerMinute' and 'SchedulerMaxConcurrency'. Missing settings are
+    taken from the single-deployment configuration. Without a pool, the
+    single configured deployment is the only backend.
+
+    Args:
+        Config: Client configuration from GetClientConfig
+
+    Returns:
+        List of backends
+    """
+    Pool = Config.get('DeploymentPool')
+    if not Pool:
+        return [Backend('default', Config, IsDefault=True)]
+
+    if os.path.exists(Pool):
+        with open(Pool, 'r', encoding='utf-8') as File:
+            Entries = json.load(File)
+    else:
+        Entries = json.loads(Pool)
+
+    Backends = []
+    for Position, Entry in enumerate(Entries):
+        Entry = dict(Entry)
+        Name = Entry.pop('Name', f"backend-{Position}")
+        Weight = float(Entry.pop('Weight', 1.0))
+        Model = Entry.pop('Model', None)
+        Evaluation = bool(Entry.pop('Evaluation', True))
+        ApiKeyEnv = Entry.pop('ApiKeyEnv', None)
+        if ApiKeyEnv is not None:
+            Entry['ApiKey'] = os.getenv(ApiKeyEnv)
+        Backends.append(Backend(Name, {**Config, **Entry}, Weight=Weight, Model=Model, Evaluation=Evaluation))
+    return Backends
+
+
+_Router: Optional[DeploymentRouter] = None
+_RouterLock = threading.Lock()
+
+
+def GetDeploymentRouter() -> DeploymentRouter:
+    """
+    Return the process-wide deployment router, built from the client configuration.
+
+    Returns:
+        The shared DeploymentRouter
+    """
+    global _Router
+    Config = GetClientConfig()
+    with _RouterLock:
+        if _Router is None:
+            Hedging = HedgePolicy(
+                Percentile=Config['HedgePercentile'],
+                MaxExtraRate=Config['HedgeMaxExtraRate'],
+                UseOtherBackend=Config['HedgeOtherBackend']
+            ) if Config['HedgingEnabled'] else None
+            _Router = DeploymentRouter(
+                LoadDeploymentPool(Config),
+                ImprovementBackend=Config['ImprovementBackend'],
+                FailureThreshold=Config['BackendFailureThreshold'],
+                Cooldown=Config['BackendCooldown'],
+                Hedging=Hedging
+            )
+        return _Router
+
+
+def ResetDeploymentRouter() -> None:
+    """Close the router's clients so the next call rebuilds it from the current configuration."""
+    global _Router
+    with _RouterLock:
+        Router, _Router = _Router, None
+    if Router is not None:
+        Router.Close()
+
+
+RegisterCloseHook(ResetDeploymentRouter)
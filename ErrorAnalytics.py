@@ -0,0 +1,82 @@
+import pandas as pd
+from typing import Any, Dict
+
+
+def ComputeErrorAnalytics(ResultsDataFrame: pd.DataFrame, LabelColumn: str, TopPairs: int = 5,
+                          ExamplesPerPair: int = 3) -> Dict[str, Any]:
+    """
+    Compute confusion statistics for an evaluation result in one columnar pass.
+
+    Args:
+        ResultsDataFrame: DataFrame with evaluation results including ExtractedLabel column
+        LabelColumn: Name of the column containing true labels
+        TopPairs: Number of most frequent confusion pairs to return
+        ExamplesPerPair: Row indices kept as examples for each returned pair
+
+    Returns:
+        Dictionary containing:
+        - 'Total', 'Correct', 'Accuracy': overall counts
+        - 'ConfusionMatrix': DataFrame of true label (rows) by extracted label (columns)
+        - 'PerLabel': DataFrame indexed by true label with Total, Correct, Errors, ErrorRate, Accuracy
+        - 'ConfusionPairs': list of {'TrueLabel', 'PredictedLabel', 'Confusion', 'Count'}, most frequent first
+        - 'ExampleIndices': dict of confusion string to example row indices
+        - 'MisclassifiedIndices': index of all misclassified rows
+    """
+    TrueLabels = ResultsDataFrame[LabelColumn].astype(str).rename('TrueLabel')
+    PredictedLabels = ResultsDataFrame['ExtractedLabel'].astype(str).rename('PredictedLabel')
+    Correct = (TrueLabels == PredictedLabels).rename('Correct')
+
+    ConfusionMatrix = pd.crosstab(TrueLabels, PredictedLabels)
+
+    PerLabel = Correct.groupby(TrueLabels).agg(['size', 'sum']).rename(columns={'size': 'Total', 'sum': 'Correct'})
+    PerLabel['Correct'] = PerLabel['Correct'].astype(int)
+    PerLabel['Errors'] = PerLabel['Total'] - PerLabel['Correct']
+    PerLabel['ErrorRate'] = PerLabel['Errors'] / PerLabel['Total']
+    PerLabel['Accuracy'] = PerLabel['Correct'] / PerLabel['Total']
+
+    # Confusion pairs among misclassified rows, most frequent first
+    ErrorMask = ~Correct
+    Errors = pd.DataFrame({'TrueLabel': TrueLabels[ErrorMask], 'PredictedLabel': PredictedLabels[ErrorMask]})
+    PairCounts = Errors.groupby(['TrueLabel', 'PredictedLabel'], sort=False).size().sort_values(ascending=False, kind='stable')
+    ConfusionPairs = [
+        {'TrueLabel': TrueLabel, 'PredictedLabel': PredictedLabel,
+         'Confusion': f"{TrueLabel} -> {PredictedLabel}", 'Count': int(Count)}
+        for (TrueLabel, PredictedLabel), Count in PairCounts.head(TopPairs).items()
+    ]
+
+    # First few example rows of every pair, collected in one groupby
+    Examples = Errors.groupby(['TrueLabel', 'PredictedLabel'], sort=False).head(ExamplesPerPair)
+    ExampleIndices = {Pair['Confusion']: [] for Pair in ConfusionPairs}
+    for Index, TrueLabel, PredictedLabel in zip(Examples.index, Examples['TrueLabel'], Examples['PredictedLabel']):
+        Confusion = f"{TrueLabel} -> {PredictedLabel}"
+        if Confusion in ExampleIndices:
+            ExampleIndices[Confusion].append(Index)
+
+    Total = len(ResultsDataFrame)
+    CorrectCount = int(Correct.sum())
+    return {
+        'Total': Total,
+        'Correct': CorrectCount,
+        'Accuracy': CorrectCount / Total if Total > 0 else 0.0,
+        'ConfusionMatrix': ConfusionMatrix,
+        'PerLabel': PerLabel,
+        'ConfusionPairs': ConfusionPairs,
+        'ExampleIndices': ExampleIndices,
+        'MisclassifiedIndices': Errors.index
+    }
+
+
+def FormatPerLabelReport(Analytics: Dict[str, Any]) -> str:
+    """
+    Format per-label performance lines for console reports.
+
+    Args:
+        Analytics: Result of ComputeErrorAnalytics
+
+    Returns:
+        One '  Label: correct/total (accuracy)' line per label
+    """
+    return "\n".join(
+        f"  {Row.Index}: {Row.Correct}/{Row.Total} ({Row.Accuracy:.2%})"
+        for Row in Analytics['PerLabel'].itertuples()
+    )
@@ -0,0 +1,153 @@
+import os
+import re
+import pandas as pd
+from typing import Any, Dict, List, Optional
+
+# Token budget for misclassified examples sent to improvement calls
+DefaultErrorContextTokens = int(os.getenv("ERROR_CONTEXT_MAX_TOKENS", "1500"))
+
+# Columns added by evaluation that are not model inputs
+ResultColumns = ('Prediction', 'ExtractedLabel', 'Confidence', 'LabelProbabilities')
+
+
+def CountTokens(Text: str) -> int:
+    """Estimate the tokens of a text at roughly four characters per token, like EstimateTokens."""
+    return len(Text) // 4 + 1
+
+
+def TruncateText(Text: Any, MaxChars: int) -> str:
+    """
+    Shorten a field to at most MaxChars characters on a single line.
+
+    Args:
+        Text: Field value
+        MaxChars: Maximum characters kept
+
+    Returns:
+        The text with collapsed whitespace, cut with '...' if it was longer
+    """
+    Text = re.sub(r'\s+', ' ', str(Text)).strip()
+    return Text if len(Text) <= MaxChars else Text[:MaxChars - 3].rstrip() + "..."
+
+
+def _Signature(Text: str) -> str:
+    # Rows that differ only in case, punctuation, digits or spacing count as duplicates
+    return re.sub(r'[\W\d_]+', ' ', Text.casefold()).strip()
+
+
+def BuildErrorContext(
+    ResultsDataFrame: pd.DataFrame,
+    LabelColumn: str,
+    FeatureColumns: Optional[List[str]] = None,
+    MaxTokens: int = DefaultErrorContextTokens,
+    MaxFieldChars: int = 300,
+    MaxOutputChars: int = 80,
+    RandomState: int = 0
+) -> Dict[str, Any]:
+    """
+    Build a compact description of misclassified rows that fits a token budget.
+
+    Errors are grouped by confusion pair (true -> extracted label). Examples
+    are taken round-robin over the pairs, most frequent pair first, so every
+    pair is represented before any pair gets a second example. Within a pair
+    the examples are drawn at random instead of always the first rows, and
+    near-duplicates (same text up to case, punctuation, digits and spacing)
+    are shown once. Long fields are truncated. When the results carry a
+    logprob 'Confidence' column, the least confident errors of each pair
+    come first and their confidence is shown.
+
+    Args:
+        ResultsDataFrame: DataFrame with evaluation results including ExtractedLabel column
+        LabelColumn: Name of the column containing true labels
+        FeatureColumns: Input columns to show (default: every column except the label and result columns)
+        MaxTokens: Token budget of the returned text
+        MaxFieldChars: Characters kept per feature value
+        MaxOutputChars: Characters kept of the raw model output
+        RandomState: Seed for example sampling
+
+    Returns:
+        Dictionary containing:
+        - 'Text': the formatted error context
+        - 'Tokens': estimated tokens of Text
+        - 'ErrorCount': number of misclassified rows
+        - 'ExampleCount': number of examples included
+        - 'PairCount': number of confusion pairs listed
+    """
+    if FeatureColumns is None:
+        FeatureColumns = [Column for Column in ResultsDataFrame.columns
+                          if Column != LabelColumn and Column not in ResultColumns]
+
+    PredictedColumn = 'ExtractedLabel' if 'ExtractedLabel' in ResultsDataFrame.columns else 'Prediction'
+    TrueLabels = ResultsDataFrame[LabelColumn].astype(str)
+    Errors = ResultsDataFrame[ResultsDataFrame[PredictedColumn].astype(str) != TrueLabels]
+    if Errors.empty:
+        Text = "No misclassified examples."
+        return {'Text': Text, 'Tokens': CountTokens(Text), 'ErrorCount': 0, 'ExampleCount': 0, 'PairCount': 0}
+
+    # One compact line per error; the raw output is shown only when it is not just the label
+    Lines = pd.Series("", index=Errors.index)
+    for Column in FeatureColumns:
+        Lines += f"{Column}: " + Errors[Column].map(lambda Value: TruncateText(Value, MaxFieldChars)) + "; "
+    if 'Prediction' in Errors.columns and PredictedColumn != 'Prediction':
+        Outputs = Errors['Prediction'].fillna("").astype(str).str.strip()
+        Verbose = Outputs != Errors[PredictedColumn].astype(str)
+        Lines[Verbose] += "output: \"" + Outputs[Verbose].map(lambda Value: TruncateText(Value, MaxOutputChars)) + "\"; "
+    HasConfidence = 'Confidence' in Errors.columns and Errors['Confidence'].notna().any()
+    if HasConfidence:
+        Scored = Errors['Confidence'].notna()
+        Lines[Scored] += "confidence: " + Errors.loc[Scored, 'Confidence'].map(lambda Value: f"{Value:.2f}")
+    Lines = "  - " + Lines.str.rstrip("; ")
+
+    Candidates = pd.DataFrame({
+        'TrueLabel': TrueLabels[Errors.index],
+        'PredictedLabel': Errors[PredictedColumn].astype(str).replace("", "(no label)"),
+        'Line': Lines,
+        'Signature': (Errors[FeatureColumns].astype(str).agg(' '.join, axis=1) if FeatureColumns
+                      else Lines).map(_Signature)
+    })
+    Candidates = Candidates.sample(frac=1, random_state=RandomState)
+    Candidates = Candidates.drop_duplicates(['TrueLabel', 'PredictedLabel', 'Signature'])
+    if HasConfidence:
+        # Borderline errors first: they show where the prompt leaves the decision open
+        Candidates = Candidates.loc[Errors.loc[Candidates.index, 'Confidence'].sort_values(kind='stable').index]
+
+    PairCounts = Errors.groupby([TrueLabels[Errors.index], Errors[PredictedColumn].astype(str).replace("", "(no label)")]).size()
+    Pairs = PairCounts.sort_values(ascending=False, kind='stable').index.tolist()
+    Queues = {Pair: Group['Line'].tolist() for Pair, Group in Candidates.groupby(['TrueLabel', 'PredictedLabel'])}
+
+    # Pair headers first, as far as the budget allows
+    Selected = {}
+    UsedTokens = 0
+    for TrueLabel, PredictedLabel in Pairs:
+        Header = f"{TrueLabel} -> {PredictedLabel} ({PairCounts[(TrueLabel, PredictedLabel)]} errors):"
+        HeaderTokens = CountTokens(Header)
+        if UsedTokens + HeaderTokens > MaxTokens:
+            break
+        Selected[(TrueLabel, PredictedLabel)] = [Header]
+        UsedTokens += HeaderTokens
+
+    # Then examples round-robin over the pairs until nothing else fits
+    ExampleCount = 0
+    Added = True
+    while Added:
+        Added = False
+        for Pair in Selected:
+            Queue = Queues.get(Pair, [])
+            while Queue:
+                Line = Queue.pop(0)
+                LineTokens = CountTokens(Line)
+                if UsedTokens + LineTokens <= MaxTokens:
+                    Selected[Pair].append(Line)
+                    UsedTokens += LineTokens
+                    ExampleCount += 1
+                    Added = True
+                    break
+
+    Text = "\n".join(Line for Group in Selected.values() for Line in Group)
+    return {
+        'Text': Text,
+        'Tokens': CountTokens(Text),
+        'ErrorCount': len(Errors),
+        'ExampleCount': ExampleCount,
+        'PairCount': len(Selected)
+    }
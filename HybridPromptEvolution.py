@@ -1,12 +1,13 @@
 import pandas as pd
-from PromptEvolution import ImprovePrompt
-import openai
-import os
-import json
-from typing import Dict, List, Tuple
-from openai import AzureOpenAI
-
-def AnalyzeErrorPatterns(ResultsDataFrame: pd.DataFrame, LabelColumn: str) -> Dict[str, List[Dict]]:
+from PromptEvolution import ImprovePrompt, GetSamplingOptions
+from ClientRegistry import RunCoroutine
+from OutputGeneration import CreateChatCompletionAsync
+from ErrorAnalytics import ComputeErrorAnalytics
+from ErrorContext import BuildErrorContext, DefaultErrorContextTokens, ResultColumns, TruncateText
+from PromptTemplate import GetPlaceholders, RepairPromptAsync
+from typing import Any, Dict, List, Optional, Tuple
+
+def AnalyzeErrorPatterns(ResultsDataFrame: pd.DataFrame, LabelColumn: str) -> Dict[str, Any]:
     """
     Analyze error patterns from evaluation results.
     
@@ -15,50 +16,30 @@ def AnalyzeErrorPatterns(ResultsDataFrame: pd.DataFrame, LabelColumn: str) -> Di
         LabelColumn: Name of the column containing true labels
         
     Returns:
-        Dictionary containing error patterns categorized by type
+        Dictionary containing error patterns categorized by type, plus the
+        misclassified row indices and the full columnar analytics
     """
-    ErrorPatterns = {
-        'Misclassifications': [],
-        'PatternsByLabel': {},
-        'CommonErrors': []
-    }
-    
-    # Find all misclassified samples
-    Misclassified = ResultsDataFrame[ResultsDataFrame['ExtractedLabel'] != ResultsDataFrame[LabelColumn].astype(str)]
-    
-    # Analyze misclassifications
-    for _, Row in Misclassified.iterrows():
-        ErrorInfo = {
-            'Input': Row.to_dict(),
-            'TrueLabel': str(Row[LabelColumn]),
-            'PredictedLabel': Row['ExtractedLabel'],
-            'RawPrediction': Row['Prediction']
-        }
-        ErrorPatterns['Misclassifications'].append(ErrorInfo)
+    Analytics = ComputeErrorAnalytics(ResultsDataFrame, LabelColumn, TopPairs=5)
+    ConfusionMatrix = Analytics['ConfusionMatrix']
     
     # Group errors by true label
-    for Label in ResultsDataFrame[LabelColumn].unique():
-        LabelErrors = Misclassified[Misclassified[LabelColumn] == Label]
-        if len(LabelErrors) > 0:
-            ErrorPatterns['PatternsByLabel'][str(Label)] = {
-                'Count': len(LabelErrors),
-                'ErrorRate': len(LabelErrors) / len(ResultsDataFrame[ResultsDataFrame[LabelColumn] == Label]),
-                'CommonMisclassifiedAs': LabelErrors['ExtractedLabel'].value_counts().to_dict()
+    PatternsByLabel = {}
+    for Row in Analytics['PerLabel'].itertuples():
+        if Row.Errors > 0:
+            MisclassifiedAs = ConfusionMatrix.loc[Row.Index].drop(Row.Index, errors='ignore')
+            MisclassifiedAs = MisclassifiedAs[MisclassifiedAs > 0].sort_values(ascending=False)
+            PatternsByLabel[Row.Index] = {
+                'Count': int(Row.Errors),
+                'ErrorRate': float(Row.ErrorRate),
+                'CommonMisclassifiedAs': {Label: int(Count) for Label, Count in MisclassifiedAs.items()}
             }
     
-    # Find common error types
-    if len(Misclassified) > 0:
-        # Most confused label pairs
-        ConfusionPairs = {}
-        for _, Row in Misclassified.iterrows():
-            Pair = f"{Row[LabelColumn]} -> {Row['ExtractedLabel']}"
-            ConfusionPairs[Pair] = ConfusionPairs.get(Pair, 0) + 1
-        
-        # Sort by frequency
-        SortedPairs = sorted(ConfusionPairs.items(), key=lambda x: x[1], reverse=True)
-        ErrorPatterns['CommonErrors'] = [{'Confusion': Pair, 'Count': Count} for Pair, Count in SortedPairs[:5]]
-    
-    return ErrorPatterns
+    return {
+        'MisclassifiedIndices': Analytics['MisclassifiedIndices'],
+        'PatternsByLabel': PatternsByLabel,
+        'CommonErrors': [{'Confusion': Pair['Confusion'], 'Count': Pair['Count']} for Pair in Analytics['ConfusionPairs']],
+        'Analytics': Analytics
+    }
 
 
 def CombineErrorFeedback(BestErrorPatterns: Dict, CurrentErrorPatterns: Dict) -> str:
@@ -109,7 +90,7 @@ def CombineErrorFeedback(BestErrorPatterns: Dict, CurrentErrorPatterns: Dict) ->
 
 def HybridImprovePrompt(BestPrompt: str, BestAccuracy: float, BestResults: pd.DataFrame,
                         CurrentPrompt: str, CurrentAccuracy: float, CurrentResults: pd.DataFrame,
-                        LabelColumn: str) -> str:
+                        LabelColumn: str, Seed: Optional[int] = None) -> str:
     """
     Improve prompt using hybrid feedback from both best and current prompts.
     
@@ -121,10 +102,42 @@ def HybridImprovePrompt(BestPrompt: str, BestAccuracy: float, BestResults: pd.Da
         CurrentAccuracy: Accuracy of the current prompt
         CurrentResults: Evaluation results from the current prompt
         LabelColumn: Name of the column containing true labels
+        Seed: Optional sampling seed, used to draw a different improvement
         
     Returns:
         Improved prompt incorporating feedback from both attempts
     """
+    return RunCoroutine(HybridImprovePromptAsync(
+        BestPrompt, BestAccuracy, BestResults,
+        CurrentPrompt, CurrentAccuracy, CurrentResults,
+        LabelColumn, Seed
+    ))
+
+
+async def HybridImprovePromptAsync(BestPrompt: str, BestAccuracy: float, BestResults: pd.DataFrame,
+                                   CurrentPrompt: str, CurrentAccuracy: float, CurrentResults: pd.DataFrame,
+                                   LabelColumn: str, Seed: Optional[int] = None,
+                                   MaxContextTokens: int = DefaultErrorContextTokens // 2) -> str:
+    """
+    Async counterpart of HybridImprovePrompt.
+    
+    Args:
+        BestPrompt: The best performing prompt so far
+        BestAccuracy: Accuracy of the best prompt
+        BestResults: Evaluation results from the best prompt
+        CurrentPrompt: The current prompt that performed worse
+        CurrentAccuracy: Accuracy of the current prompt
+        CurrentResults: Evaluation results from the current prompt
+        LabelColumn: Name of the column containing true labels
+        Seed: Optional sampling seed, used to draw several different improvements
+        MaxContextTokens: Token budget for examples of the best prompt's persistent errors
+        
+    Returns:
+        Improved prompt incorporating feedback from both attempts, with the same placeholders as BestPrompt
+    
+    Raises:
+        PromptTemplateError: If the improved prompt cannot be repaired into a valid template
+    """
     # Analyze error patterns from both prompts
     BestErrorPatterns = AnalyzeErrorPatterns(BestResults, LabelColumn)
     CurrentErrorPatterns = AnalyzeErrorPatterns(CurrentResults, LabelColumn)
@@ -132,6 +145,13 @@ def HybridImprovePrompt(BestPrompt: str, BestAccuracy: float, BestResults: pd.Da
     # Combine feedback
     CombinedFeedback = CombineErrorFeedback(BestErrorPatterns, CurrentErrorPatterns)
     
+    # A few concrete examples of errors the best prompt still makes
+    ErrorContext = BuildErrorContext(BestResults, LabelColumn, MaxTokens=MaxContextTokens)
+    
+    # Rows the attempted prompt broke
+    FeatureColumns = [Column for Column in BestResults.columns if Column != LabelColumn and Column not in ResultColumns]
+    DegradationAnalysis = GetDetailedErrorAnalysis(BestResults, CurrentResults, LabelColumn, FeatureColumns)
+    
     # Create context for improvement
     ImprovementContext = f"""
 You need to improve a prompt for classification. Here's the context:
@@ -146,52 +166,54 @@ The attempted prompt performed worse than the best prompt. Here's the combined e
 
 {CombinedFeedback}
 
-Key insights:
-1. The best prompt still has persistent errors that need addressing
-2. The attempted prompt introduced new errors while trying to fix existing ones
-3. We need to maintain what works in the best prompt while carefully addressing its weaknesses
+{DegradationAnalysis or "The attempted prompt broke no examples the best prompt classified correctly."}
+
+Examples the best prompt still misclassifies (true label -> predicted label):
+{ErrorContext['Text']}
 
 Based on this analysis, improve the BEST prompt to:
 1. Address the persistent error patterns without breaking what already works
 2. Avoid the mistakes that made the attempted prompt perform worse
 3. Be more precise in distinguishing between commonly confused labels
+4. Keep the same variable placeholders as the best prompt, and use curly braces for nothing else
 
 Return only the improved prompt text.
 """
-    Client = AzureOpenAI(
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-    )
-    
-    Response = Client.chat.completions.create(
-        model = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-        messages=[
+    Response = await CreateChatCompletionAsync(
+        Messages=[
             {"role": "system", "content": "You are an expert in prompt engineering. Generate only the improved prompt without explanations."},
             {"role": "user", "content": ImprovementContext}
         ],
         temperature=0.7,
-        max_tokens=500
+        Purpose='Improvement',
+        max_tokens=500,
+        **GetSamplingOptions(Seed)
     )
     
-    ImprovedPrompt = Response.choices[0].message.content.strip()
+    ImprovedPrompt = Response['Content'].strip()
     
-    return ImprovedPrompt
+    return await RepairPromptAsync(ImprovedPrompt, GetPlaceholders(BestPrompt))
 
 
 def GetDetailedErrorAnalysis(BestResults: pd.DataFrame, CurrentResults: pd.DataFrame, 
-                             LabelColumn: str, FeatureColumns: List[str]) -> str:
+                             LabelColumn: str, FeatureColumns: List[str], MaxExamples: int = 3,
+                             MaxFieldChars: int = 300) -> str:
     """
     Provide detailed error analysis comparing best and current results.
     
+    For a whole run, CorrectnessIndex.GetRegressedRows answers the same
+    question for any two prompts from stored predictions.
+    
     Args:
         BestResults: Results from best prompt
         CurrentResults: Results from current prompt
         LabelColumn: Label column name
         FeatureColumns: List of feature columns
+        MaxExamples: Degraded rows shown as examples
+        MaxFieldChars: Characters kept per feature value
         
     Returns:
-        Detailed analysis string
+        Detailed analysis string, empty if no row degraded
     """
     Analysis = []
     
@@ -206,13 +228,13 @@ def GetDetailedErrorAnalysis(BestResults: pd.DataFrame, CurrentResults: pd.DataF
         Analysis.append(f"Found {len(DegradedSamples)} samples that degraded from correct to incorrect")
         
         # Show a few examples
-        for Idx in list(DegradedSamples)[:3]:
+        for Idx in list(DegradedSamples)[:MaxExamples]:
             BestRow = BestResults.loc[Idx]
             CurrentRow = CurrentResults.loc[Idx]
             
             Analysis.append(f"\nExample degradation:")
             for Col in FeatureColumns:
-                Analysis.append(f"  {Col}: {BestRow[Col]}")
+                Analysis.append(f"  {Col}: {TruncateText(BestRow[Col], MaxFieldChars)}")
             Analysis.append(f"  True label: {BestRow[LabelColumn]}")
             Analysis.append(f"  Best prompt predicted: {BestRow['ExtractedLabel']} ✓")
             Analysis.append(f"  Current prompt predicted: {CurrentRow['ExtractedLabel']} ✗")
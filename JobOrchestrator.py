@@ -0,0 +1,342 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+import contextvars
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+from sklearn.model_selection import train_test_split
+from ClientRegistry import CloseClients
+from DeploymentRouter import GetDeploymentRouter
+from PredictionStore import PredictionStore
+from StreamingEvaluation import ConvertExcelToParquet
+from Telemetry import GetTelemetry, UseJob
+from main import Main, TestBestPromptOnValidation
+
+# Fields every job of a manifest must set
+RequiredJobFields = ('Name', 'DataPath', 'FeatureColumns', 'LabelColumn')
+
+# Directory receiving each job's log, best prompt and run files unless the manifest says otherwise
+DefaultOutputDirectory = os.getenv("JOB_OUTPUT_DIRECTORY", "JobOutputs")
+
+# Seconds between progress reports
+DefaultProgressInterval = float(os.getenv("JOB_PROGRESS_INTERVAL", "30"))
+
+# Log file of the job whose code is printing; None prints to the console
+_JobLog: contextvars.ContextVar = contextvars.ContextVar('JobLog', default=None)
+
+
+class JobOutput:
+    """
+    Stand-in for sys.stdout that sends prints made inside a job to the job's log.
+
+    The target is read from a context variable, so prints from a job's async
+    tasks on the shared event loop land in the same log as its own thread's.
+    """
+
+    def __init__(self, Stream: TextIO):
+        """
+        Args:
+            Stream: Stream receiving prints made outside any job
+        """
+        self.Stream = Stream
+
+    def write(self, Text: str) -> int:
+        return (_JobLog.get() or self.Stream).write(Text)
+
+    def flush(self) -> None:
+        (_JobLog.get() or self.Stream).flush()
+
+    def __getattr__(self, Name: str) -> Any:
+        return getattr(self.Stream, Name)
+
+
+@contextlib.contextmanager
+def UseJobLog(File: TextIO) -> Iterator[None]:
+    """Send prints made inside the block to File while a JobOutput is installed."""
+    Token = _JobLog.set(File)
+    try:
+        yield
+    finally:
+        _JobLog.reset(Token)
+
+
+def LoadManifest(Path: str, OutputDirectory: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Load and check a job manifest.
+
+    The manifest is a JSON object with a 'Jobs' list and optional
+    'OutputDirectory' and 'MaxParallelJobs'. Each job sets Name, DataPath,
+    FeatureColumns and LabelColumn, a PromptTemplate or a TemplatePath, and
+    optionally MaxIterations, AccuracyThreshold, Priority, OutputPath,
+    ValidationSize, LabelMap and Options (extra keyword arguments of
+    main.Main). Relative DataPath and TemplatePath are resolved against the
+    manifest's directory.
+
+    Args:
+        Path: Path of the manifest file
+        OutputDirectory: Optional override of the manifest's OutputDirectory
+
+    Returns:
+        The manifest with templates read and job defaults filled in
+
+    Raises:
+        ValueError: If a job misses a required field, has no template,
+            a non-positive priority or a duplicate name
+    """
+    with open(Path, 'r', encoding='utf-8') as File:
+        Manifest = json.load(File)
+    BaseDirectory = os.path.dirname(os.path.abspath(Path))
+    OutputDirectory = OutputDirectory or Manifest.get('OutputDirectory', DefaultOutputDirectory)
+
+    Jobs = []
+    for Job in Manifest.get('Jobs', []):
+        Missing = [Field for Field in RequiredJobFields if Field not in Job]
+        if Missing:
+            raise ValueError(f"Job {Job.get('Name', len(Jobs))!r} is missing {', '.join(Missing)}")
+        Job = dict(Job)
+        if 'PromptTemplate' not in Job:
+            if 'TemplatePath' not in Job:
+                raise ValueError(f"Job {Job['Name']!r} needs a PromptTemplate or a TemplatePath")
+            with open(os.path.join(BaseDirectory, Job['TemplatePath']), 'r', encoding='utf-8') as File:
+                Job['PromptTemplate'] = File.read()
+        if Job.setdefault('Priority', 1.0) <= 0:
+            raise ValueError(f"Job {Job['Name']!r} needs a positive Priority, got {Job['Priority']}")
+        Job['DataPath'] = os.path.join(BaseDirectory, Job['DataPath'])
+        Job.setdefault('MaxIterations', 5)
+        Job.setdefault('AccuracyThreshold', 0.95)
+        Job.setdefault('OutputPath', os.path.join(OutputDirectory, Job['Name'], 'BestPrompt.txt'))
+        Job.setdefault('ValidationSize', 0.0)
+        Job.setdefault('Options', {})
+        Jobs.append(Job)
+
+    Names = [Job['Name'] for Job in Jobs]
+    Duplicates = sorted({Name for Name in Names if Names.count(Name) > 1})
+    if Duplicates:
+        raise ValueError(f"Job names must be unique, repeated: {', '.join(Duplicates)}")
+
+    return {
+        'Jobs': Jobs,
+        'OutputDirectory': OutputDirectory,
+        'MaxParallelJobs': Manifest.get('MaxParallelJobs')
+    }
+
+
+def LoadJobData(Job: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Read the feature and label columns of a job's dataset.
+
+    Excel workbooks are converted to Parquet once; Parquet and CSV files are
+    read directly. Rows without a label are dropped and LabelMap, if set,
+    renames label values.
+
+    Args:
+        Job: Job entry of a loaded manifest
+
+    Returns:
+        DataFrame with the feature columns and the label column
+    """
+    Columns = list(Job['FeatureColumns']) + [Job['LabelColumn']]
+    DataPath = Job['DataPath']
+    Extension = os.path.splitext(DataPath)[1].lower()
+    if Extension in ('.xlsx', '.xls'):
+        DataPath, Extension = ConvertExcelToParquet(DataPath), '.parquet'
+    if Extension == '.csv':
+        DataFrame = pd.read_csv(DataPath, usecols=Columns)
+    else:
+        DataFrame = pd.read_parquet(DataPath, columns=Columns)
+
+    DataFrame = DataFrame.dropna(subset=[Job['LabelColumn']])
+    if Job.get('LabelMap'):
+        DataFrame = DataFrame.replace({Job['LabelColumn']: Job['LabelMap']})
+    return DataFrame
+
+
+def RunJob(Job: Dict[str, Any], Status: Dict[str, Any]) -> None:
+    """
+    Run main.Main for one job, attributing its LLM calls to the job.
+
+    Args:
+        Job: Job entry of a loaded manifest
+        Status: Progress entry of the job, updated in place
+    """
+    Status.update({'State': 'Running', 'Started': time.time()})
+    DataFrame = LoadJobData(Job)
+    ValidationData = ValidationStore = None
+    if Job['ValidationSize']:
+        DataFrame, ValidationData = train_test_split(
+            DataFrame, test_size=Job['ValidationSize'], stratify=DataFrame[Job['LabelColumn']],
+            random_state=Job.get('RandomState', 0)
+        )
+        # Receives Main's background validation predictions for the report below
+        ValidationStore = PredictionStore(ValidationData, Job['FeatureColumns'], Job['LabelColumn'])
+
+    BestPrompt, BestAccuracy = Main(
+        DataFrame=DataFrame,
+        FeatureColumns=Job['FeatureColumns'],
+        LabelColumn=Job['LabelColumn'],
+        PromptTemplate=Job['PromptTemplate'],
+        MaxIterations=Job['MaxIterations'],
+        AccuracyThreshold=Job['AccuracyThreshold'],
+        OutputPath=Job['OutputPath'],
+        ValidationData=ValidationData,
+        ValidationStore=ValidationStore,
+        **Job['Options']
+    )
+    Status['BestAccuracy'] = BestAccuracy
+
+    # Main validated its best prompts in the background; the report reuses those predictions
+    if ValidationData is not None:
+        Status['ValidationAccuracy'], _ = TestBestPromptOnValidation(
+            BestPrompt=BestPrompt,
+            ValidationData=ValidationData,
+            FeatureColumns=Job['FeatureColumns'],
+            LabelColumn=Job['LabelColumn'],
+            ValidationStore=ValidationStore,
+            **{Key: Job['Options'][Key] for Key in ('ConstrainedOutput', 'Layout') if Key in Job['Options']}
+        )
+        ValidationStore.Close()
+
+
+def FormatProgress(Statuses: List[Dict[str, Any]]) -> str:
+    """
+    Format a progress report of the running jobs.
+
+    Args:
+        Statuses: Progress entries of the jobs
+
+    Returns:
+        One line per job plus the token quota used over the last minute
+    """
+    Telemetry = GetTelemetry()
+    Router = GetDeploymentRouter()
+    JobStats = Router.GetJobStats()
+    Totals = Telemetry.GetTotals()
+    TotalTokens = Totals['PromptTokens'] + Totals['CompletionTokens']
+
+    Lines = [f"Job progress at {time.strftime('%H:%M:%S')}:"]
+    for Status in Statuses:
+        Name = Status['Name']
+        JobTotals = Telemetry.GetTotals(Job=Name)
+        Line = f"  {Name} [{Status['State']}] priority {Status['Priority']:g}"
+        if JobTotals['Calls']:
+            JobTokens = JobTotals['PromptTokens'] + JobTotals['CompletionTokens']
+            Line += (f": iteration {JobTotals['LastIteration'] or 0}, {JobTotals['Calls']} calls, "
+                     f"{JobTokens} tokens ({JobTokens / TotalTokens if TotalTokens else 0:.0%} of all)")
+        if Name in JobStats.index:
+            Line += f", mean queue wait {JobStats.loc[Name, 'MeanWaitSeconds']:.2f}s"
+        if Status.get('BestAccuracy') is not None:
+            Line += f", best accuracy {Status['BestAccuracy']:.2%}"
+        if Status.get('Error'):
+            Line += f", error: {Status['Error']}"
+        Lines.append(Line)
+
+    Quota = Router.GetTokensPerMinute()
+    if Quota and Totals['Calls']:
+        RecentTokens = Telemetry.GetRecentTokens(60)
+        Lines.append(f"  Token quota used over the last minute: {RecentTokens / Quota:.0%} of {Quota:.0f} tokens/min")
+    return "\n".join(Lines)
+
+
+def RunJobs(Jobs: List[Dict[str, Any]], MaxParallelJobs: Optional[int] = None,
+            OutputDirectory: str = DefaultOutputDirectory,
+            ProgressInterval: float = DefaultProgressInterval) -> pd.DataFrame:
+    """
+    Run several prompt optimization jobs concurrently under one quota.
+
+    Every job runs main.Main in its own thread. All their LLM calls share the
+    process-wide event loop, request schedulers and response cache; the
+    schedulers hand out request slots in fair-share order weighted by job
+    priority, so the quota stays busy while any job has work and no job
+    waits behind another job's backlog. Each job prints to
+    <OutputDirectory>/<Name>/Job.log and writes its best prompt to its own
+    OutputPath; a progress report is printed every ProgressInterval seconds.
+
+    Args:
+        Jobs: Job entries of a loaded manifest
+        MaxParallelJobs: Jobs run at the same time (default: all)
+        OutputDirectory: Directory for job logs and the summary
+        ProgressInterval: Seconds between progress reports
+
+    Returns:
+        DataFrame with one row per job: State, Priority, BestAccuracy,
+        ValidationAccuracy, Seconds, OutputPath and Error
+    """
+    Statuses = [{'Name': Job['Name'], 'Priority': Job['Priority'], 'State': 'Queued', 'BestAccuracy': None,
+                 'ValidationAccuracy': None, 'Seconds': None, 'OutputPath': Job['OutputPath'], 'Error': None}
+                for Job in Jobs]
+
+    def RunLogged(Job, Status):
+        JobDirectory = os.path.join(OutputDirectory, Job['Name'])
+        os.makedirs(JobDirectory, exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(Job['OutputPath'])), exist_ok=True)
+        with open(os.path.join(JobDirectory, 'Job.log'), 'w', encoding='utf-8') as Log, \
+                UseJobLog(Log), UseJob(Job['Name'], Job['Priority']):
+            try:
+                RunJob(Job, Status)
+                Status['State'] = 'Done'
+            except Exception as Error:
+                Status.update({'State': 'Failed', 'Error': f"{type(Error).__name__}: {Error}"})
+                print(f"Job failed: {Status['Error']}")
+            finally:
+                Status['Seconds'] = time.time() - Status.get('Started', time.time())
+        print(f"Job {Job['Name']} {Status['State'].lower()} after {Status['Seconds']:.0f}s")
+
+    # Route job prints to their logs and start the progress reporter
+    OriginalStdout = sys.stdout
+    sys.stdout = JobOutput(OriginalStdout)
+    Finished = threading.Event()
+
+    def ReportProgress():
+        while not Finished.wait(ProgressInterval):
+            print(FormatProgress(Statuses))
+
+    Reporter = threading.Thread(target=ReportProgress, daemon=True)
+    Reporter.start()
+
+    # Run the jobs; each thread gets a fresh context so job tags do not leak between them
+    try:
+        with ThreadPoolExecutor(max_workers=MaxParallelJobs or max(1, len(Jobs))) as Executor:
+            Futures = [Executor.submit(contextvars.Context().run, RunLogged, Job, Status)
+                       for Job, Status in zip(Jobs, Statuses)]
+            for Future in Futures:
+                Future.result()
+    finally:
+        Finished.set()
+        Reporter.join()
+        sys.stdout = OriginalStdout
+
+    # Report and save the outcome of every job
+    print(FormatProgress(Statuses))
+    Summary = pd.DataFrame(Statuses).drop(columns=['Started'], errors='ignore').set_index('Name')
+    os.makedirs(OutputDirectory, exist_ok=True)
+    Summary.to_csv(os.path.join(OutputDirectory, 'JobSummary.csv'))
+    return Summary
+
+
+def ParseArguments(Arguments: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line options of the job orchestrator."""
+    Parser = argparse.ArgumentParser(description="Run the prompt optimization jobs of a manifest under one shared quota.")
+    Parser.add_argument('manifest', help="JSON manifest listing the jobs")
+    Parser.add_argument('--max-parallel-jobs', type=int, default=None, help="Jobs run at the same time (default: all)")
+    Parser.add_argument('--output-directory', default=None, help="Directory for job logs and the summary")
+    Parser.add_argument('--progress-interval', type=float, default=DefaultProgressInterval,
+                        help="Seconds between progress reports")
+    return Parser.parse_args(Arguments)
+
+
+if __name__ == "__main__":
+    Arguments = ParseArguments()
+    Manifest = LoadManifest(Arguments.manifest, Arguments.output_directory)
+    Summary = RunJobs(
+        Manifest['Jobs'],
+        MaxParallelJobs=Arguments.max_parallel_jobs or Manifest['MaxParallelJobs'],
+        OutputDirectory=Manifest['OutputDirectory'],
+        ProgressInterval=Arguments.progress_interval
+    )
+    print(Summary.to_string())
+    CloseClients()
@@ -0,0 +1,110 @@
+import re
+import functools
+import pandas as pd
+from typing import Dict, List, Sequence
+
+# How to resolve outputs that mention more than one distinct label
+MultipleLabelPolicies = ('First', 'Reject')
+
+
+def NormalizeLabelText(Text: str) -> str:
+    """Case-fold text and collapse whitespace so label mentions compare equal."""
+    return re.sub(r'\s+', ' ', Text.strip()).casefold()
+
+
+class LabelExtractor:
+    """
+    Label matcher compiled once per label set.
+
+    Labels are matched case-insensitively as whole words (multi-word labels
+    allow any whitespace between their words). At a given position the
+    longest label wins, so 'not relevant' is preferred over 'relevant'.
+
+    Outputs without any label map to an empty string. Outputs mentioning
+    several distinct labels map to the first one mentioned under the 'First'
+    policy and to an empty string under the 'Reject' policy.
+    """
+
+    def __init__(self, Labels: Sequence[str], MultipleLabelPolicy: str = 'First'):
+        """
+        Args:
+            Labels: Possible label values
+            MultipleLabelPolicy: 'First' or 'Reject'
+        """
+        if MultipleLabelPolicy not in MultipleLabelPolicies:
+            raise ValueError(f"MultipleLabelPolicy must be one of {MultipleLabelPolicies}, got {MultipleLabelPolicy!r}")
+
+        self.Labels = [str(Label) for Label in Labels]
+        self.MultipleLabelPolicy = MultipleLabelPolicy
+
+        # Case-folded lookup table; the first label wins if two labels differ only by case
+        self.Lookup: Dict[str, str] = {}
+        for Label in self.Labels:
+            self.Lookup.setdefault(NormalizeLabelText(Label), Label)
+
+        # Longest labels first so the alternation prefers the longest match at each position
+        Alternatives = [
+            r'\s+'.join(re.escape(Word) for Word in Label.split())
+            for Label in sorted(self.Labels, key=len, reverse=True)
+            if Label.strip()
+        ]
+        self.Pattern = re.compile(r'(?<!\w)(' + '|'.join(Alternatives) + r')(?!\w)', re.IGNORECASE) if Alternatives else None
+
+    def ExtractLabel(self, Output: str) -> str:
+        """
+        Extract the label from a single output.
+
+        Args:
+            Output: The GPT-generated output text
+
+        Returns:
+            Matched label or empty string
+        """
+        return self.ExtractLabels(pd.Series([Output])).iloc[0]
+
+    def ExtractLabels(self, Outputs: pd.Series) -> pd.Series:
+        """
+        Extract labels from a whole column of outputs at once.
+
+        Args:
+            Outputs: Series of GPT-generated output texts
+
+        Returns:
+            Series of matched labels (empty string when none), aligned with Outputs
+        """
+        Outputs = Outputs.fillna("").astype(str)
+        if self.Pattern is None:
+            return pd.Series("", index=Outputs.index, dtype=object)
+
+        if self.MultipleLabelPolicy == 'First':
+            Matches = Outputs.str.extract(self.Pattern.pattern, flags=re.IGNORECASE, expand=False)
+            return Matches.map(self._ToLabel, na_action='ignore').fillna("").astype(object)
+
+        AllMatches = Outputs.str.findall(self.Pattern.pattern, flags=re.IGNORECASE)
+        return AllMatches.map(self._ResolveUnique).astype(object)
+
+    def _ToLabel(self, MatchedText: str) -> str:
+        return self.Lookup.get(NormalizeLabelText(MatchedText), "")
+
+    def _ResolveUnique(self, MatchedTexts: List[str]) -> str:
+        Labels = {self._ToLabel(MatchedText) for MatchedText in MatchedTexts}
+        return Labels.pop() if len(Labels) == 1 else ""
+
+
+@functools.lru_cache(maxsize=128)
+def _GetLabelExtractor(Labels: tuple, MultipleLabelPolicy: str) -> LabelExtractor:
+    return LabelExtractor(Labels, MultipleLabelPolicy)
+
+
+def GetLabelExtractor(Labels: Sequence[str], MultipleLabelPolicy: str = 'First') -> LabelExtractor:
+    """
+    Return the compiled extractor for a label set, building it on first use.
+
+    Args:
+        Labels: Possible label values
+        MultipleLabelPolicy: 'First' or 'Reject'
+
+    Returns:
+        Shared LabelExtractor for these labels
+    """
+    return _GetLabelExtractor(tuple(str(Label) for Label in Labels), MultipleLabelPolicy)
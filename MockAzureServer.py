@@ -0,0 +1,409 @@
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+import collections
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence
+
+# Latency distributions supported by MockAzureServer
+LatencyDistributions = ('Constant', 'Uniform', 'LogNormal')
+
+
+def GetMockLabel(Content: str, Labels: Sequence[str]) -> str:
+    """
+    Return the label the mock server answers for a message, stable across runs.
+
+    Args:
+        Content: Text of the user message
+        Labels: Labels to choose from
+
+    Returns:
+        One of Labels, chosen by a hash of Content
+    """
+    Digest = hashlib.sha256(Content.encode('utf-8')).digest()
+    return Labels[int.from_bytes(Digest[:8], 'big') % len(Labels)]
+
+
+class MockAzureServer:
+    """
+    Local HTTP stand-in for the Azure OpenAI chat completions endpoint.
+
+    Serves POST /openai/deployments/<deployment>/chat/completions with:
+    - a deterministic label for classification requests (see GetMockLabel),
+      or a JSON array of labels for packed requests
+    - the original prompt plus a revision note for prompt improvement
+      requests, and a short canned analysis for error analysis requests
+    - latency drawn from a configurable distribution
+    - injected 429 (with retry-after-ms) and 500/503 responses
+    - token usage estimated from message length
+    - token logprobs when the request sets logprobs=True (see BuildLogprobs)
+    - an optional prompt prefix cache reporting cached_tokens (see MatchCachedPrefix)
+
+    Point the clients at it with ConfigureClients(Endpoint=Server.Url, ...).
+    """
+
+    def __init__(self, Labels: Sequence[str], LatencyDistribution: str = 'LogNormal', LatencyMean: float = 0.05,
+                 LatencySigma: float = 0.5, RateLimitRate: float = 0.0, ServerErrorRate: float = 0.0,
+                 RetryAfterMs: int = 100, Host: str = '127.0.0.1', Port: int = 0, RandomState: Optional[int] = None,
+                 PromptCacheMinTokens: Optional[int] = None, PromptCacheSize: int = 100000):
+        """
+        Args:
+            Labels: Labels returned for classification requests
+            LatencyDistribution: 'Constant', 'Uniform' (0 to twice the mean) or 'LogNormal'
+            LatencyMean: Mean response latency in seconds
+            LatencySigma: Shape of the log-normal distribution
+            RateLimitRate: Fraction of requests answered with 429
+            ServerErrorRate: Fraction of requests answered with 500 or 503
+            RetryAfterMs: retry-after-ms header sent with 429 responses
+            Host: Interface to listen on
+            Port: Port to listen on (0 picks a free port)
+            RandomState: Seed for latency and error injection
+            PromptCacheMinTokens: Shortest prompt prefix served from the simulated prompt cache
+                (Azure uses 1024); None disables the cache
+            PromptCacheSize: Prefix blocks kept in the simulated prompt cache before the
+                least recently used are evicted
+        """
+        if LatencyDistribution not in LatencyDistributions:
+            raise ValueError(f"LatencyDistribution must be one of {LatencyDistributions}, got {LatencyDistribution!r}")
+
+        self.Labels = [str(Label) for Label in Labels]
+        self.LatencyDistribution = LatencyDistribution
+        self.LatencyMean = LatencyMean
+        self.LatencySigma = LatencySigma
+        self.RateLimitRate = RateLimitRate
+        self.ServerErrorRate = ServerErrorRate
+        self.RetryAfterMs = RetryAfterMs
+        self.PromptCacheMinTokens = PromptCacheMinTokens
+        self.Stats = {'Requests': 0, 'RateLimited': 0, 'ServerErrors': 0, 'PromptTokens': 0, 'CompletionTokens': 0,
+                      'CachedTokens': 0}
+        self.PromptCacheSize = PromptCacheSize
+        self._CachedPrefixes: collections.OrderedDict = collections.OrderedDict()
+        self._Random = random.Random(RandomState)
+        self._Lock = threading.Lock()
+        self._Thread: Optional[threading.Thread] = None
+        self._Server = ThreadingHTTPServer((Host, Port), self._BuildHandler())
+        self._Server.daemon_threads = True
+
+    @property
+    def Url(self) -> str:
+        """Endpoint URL to configure as AZURE_OPENAI_ENDPOINT."""
+        Host, Port = self._Server.server_address[:2]
+        return f"http://{Host}:{Port}"
+
+    def Start(self) -> 'MockAzureServer':
+        """Serve requests on a background thread."""
+        self._Thread = threading.Thread(target=self._Server.serve_forever, name="MockAzureServer", daemon=True)
+        self._Thread.start()
+        return self
+
+    def Stop(self) -> None:
+        """Stop serving and close the socket."""
+        self._Server.shutdown()
+        self._Server.server_close()
+        if self._Thread is not None:
+            self._Thread.join()
+
+    def ResetStats(self) -> None:
+        """Zero the request counters."""
+        with self._Lock:
+            for Key in self.Stats:
+                self.Stats[Key] = 0
+
+    def __enter__(self) -> 'MockAzureServer':
+        return self.Start()
+
+    def __exit__(self, *ExceptionInfo: Any) -> None:
+        self.Stop()
+
+    def SampleLatency(self) -> float:
+        """Draw one response latency in seconds."""
+        with self._Lock:
+            if self.LatencyDistribution == 'Constant':
+                return self.LatencyMean
+            if self.LatencyDistribution == 'Uniform':
+                return self._Random.uniform(0, 2 * self.LatencyMean)
+            # Log-normal with the requested mean
+            Mu = math.log(self.LatencyMean) - self.LatencySigma ** 2 / 2
+            return self._Random.lognormvariate(Mu, self.LatencySigma)
+
+    def MatchCachedPrefix(self, Messages: List[Dict[str, Any]]) -> int:
+        """
+        Return the prompt tokens served from the simulated prefix cache and remember this prompt.
+
+        Like the Azure prompt cache, prefixes are matched from the start of the
+        prompt in blocks of 128 tokens once they reach PromptCacheMinTokens.
+        Tokens are estimated as four characters each. Only a 16-byte digest
+        of each prefix is kept, and at most PromptCacheSize of them.
+
+        Args:
+            Messages: Request messages
+
+        Returns:
+            Cached prompt tokens (0 when the cache is disabled or nothing matches)
+        """
+        if self.PromptCacheMinTokens is None:
+            return 0
+        Text = "".join(f"{Message.get('role')}:{Message.get('content', '')}\n" for Message in Messages)
+        Data = Text.encode('utf-8')
+        Digest = hashlib.blake2b(digest_size=16)
+        Cached = Start = 0
+        with self._Lock:
+            for End in range(self.PromptCacheMinTokens * 4, len(Data) + 1, 128 * 4):
+                # Chain the digest block by block instead of hashing every prefix from the start
+                Digest.update(Data[Start:End])
+                Start = End
+                Key = Digest.digest()
+                if Key in self._CachedPrefixes:
+                    self._CachedPrefixes.move_to_end(Key)
+                    Cached = End // 4
+                else:
+                    self._CachedPrefixes[Key] = None
+                    if len(self._CachedPrefixes) > self.PromptCacheSize:
+                        self._CachedPrefixes.popitem(last=False)
+        return Cached
+
+    def SampleFailure(self) -> Optional[int]:
+        """Return an injected error status for the next request, or None."""
+        with self._Lock:
+            Draw = self._Random.random()
+            if Draw < self.RateLimitRate:
+                self.Stats['RateLimited'] += 1
+                return 429
+            if Draw < self.RateLimitRate + self.ServerErrorRate:
+                self.Stats['ServerErrors'] += 1
+                return self._Random.choice((500, 503))
+            return None
+
+    def Respond(self, Messages: List[Dict[str, Any]]) -> str:
+        """
+        Build the reply text for a chat request.
+
+        Args:
+            Messages: Chat messages of the request
+
+        Returns:
+            Reply content
+        """
+        UserContent = next((str(Message.get('content', '')) for Message in reversed(Messages)
+                            if Message.get('role') == 'user'), '')
+        SystemContent = next((str(Message.get('content', '')) for Message in Messages
+                              if Message.get('role') == 'system'), '')
+
+        # Packed classification: JSON array of items in, JSON array of labels out
+        if 'JSON array' in SystemContent:
+            try:
+                Items = json.loads(UserContent)
+                return json.dumps([
+                    {'id': Item.get('id', Position), 'label': GetMockLabel(json.dumps(Item, sort_keys=True), self.Labels)}
+                    for Position, Item in enumerate(Items)
+                ])
+            except (json.JSONDecodeError, AttributeError):
+                pass
+
+        # Prompt improvement: return the prompt being improved with a revision note
+        if re.search(r'improved (version of the )?prompt', UserContent, re.IGNORECASE):
+            Match = re.search(r'(?:Original Prompt|BEST PROMPT[^\n]*):\n(.*?)\n\n(?:Current Accuracy|ATTEMPTED PROMPT)', UserContent, re.DOTALL)
+            Original = Match.group(1).strip() if Match else "Classify the input."
+            return f"{Original}\nAnswer with exactly one of: {', '.join(self.Labels)}."
+
+        # Error analysis
+        if 'Original Prompt' in UserContent or 'error' in SystemContent.lower():
+            return "Errors concentrate on ambiguous, short statements. Add explicit criteria for each label."
+
+        return GetMockLabel(UserContent, self.Labels)
+
+    def BuildLogprobs(self, Content: str, TopLogprobs: int) -> Dict[str, Any]:
+        """
+        Build a logprobs block for a reply, with the labels as alternatives of the first token.
+
+        Tokens are the words and separators of Content. The first token gets a
+        probability between 0.5 and 0.99, stable per reply; the first words of
+        the other labels share the rest.
+
+        Args:
+            Content: Reply content
+            TopLogprobs: Alternatives listed per token
+
+        Returns:
+            The 'logprobs' field of a chat completion choice
+        """
+        Tokens = re.findall(r'[A-Za-z0-9]+|[^A-Za-z0-9]', Content) or ['']
+        Digest = hashlib.sha256(Content.encode('utf-8')).digest()
+        Probability = 0.5 + 0.49 * Digest[0] / 255
+
+        # Alternatives: first words of the other labels, splitting the remaining mass
+        Others = []
+        for Label in self.Labels:
+            Word = (re.findall(r'[A-Za-z0-9]+', Label) or [Label])[0]
+            if Word != Tokens[0] and Word not in Others:
+                Others.append(Word)
+        Others = Others[:max(0, TopLogprobs - 1)]
+
+        TokenLogprobs = []
+        for Position, Token in enumerate(Tokens):
+            Logprob = math.log(Probability) if Position == 0 else 0.0
+            Top = [{'token': Token, 'logprob': Logprob, 'bytes': None}]
+            if Position == 0:
+                Top += [{'token': Word, 'logprob': math.log((1 - Probability) / len(Others)), 'bytes': None}
+                        for Word in Others]
+            TokenLogprobs.append({'token': Token, 'logprob': Logprob, 'bytes': None, 'top_logprobs': Top[:TopLogprobs]})
+        return {'content': TokenLogprobs}
+
+    def _BuildHandler(self) -> type:
+        Server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, Format: str, *Arguments: Any) -> None:
+                pass
+
+            def _Send(self, Status: int, Body: Dict[str, Any], Headers: Optional[Dict[str, str]] = None) -> None:
+                Payload = json.dumps(Body).encode('utf-8')
+                self.send_response(Status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(Payload)))
+                for Name, Value in (Headers or {}).items():
+                    self.send_header(Name, Value)
+                self.end_headers()
+                self.wfile.write(Payload)
+
+            def do_POST(self) -> None:
+                Length = int(self.headers.get('Content-Length', 0))
+                Request = json.loads(self.rfile.read(Length) or b'{}')
+                Match = re.match(r'/openai/deployments/([^/]+)/chat/completions', self.path)
+                if Match is None:
+                    self._Send(404, {'error': {'code': 'NotFound', 'message': f"Unknown path {self.path}"}})
+                    return
+
+                with Server._Lock:
+                    Server.Stats['Requests'] += 1
+                Messages = Request.get('messages', [])
+                PromptTokens = sum(len(str(Message.get('content', ''))) // 4 + 4 for Message in Messages) + 3
+                CachedTokens = min(PromptTokens, Server.MatchCachedPrefix(Messages))
+                # A cached prefix skips part of the prompt processing
+                time.sleep(Server.SampleLatency() * (1 - 0.5 * CachedTokens / PromptTokens))
+
+                Status = Server.SampleFailure()
+                if Status == 429:
+                    self._Send(429, {'error': {'code': '429', 'message': 'Rate limit exceeded (mock).'}},
+                               {'retry-after-ms': str(Server.RetryAfterMs)})
+                    return
+                if Status is not None:
+                    self._Send(Status, {'error': {'code': str(Status), 'message': 'Injected server error (mock).'}})
+                    return
+
+                Content = Server.Respond(Messages)
+                CompletionTokens = max(1, len(Content) // 4)
+                with Server._Lock:
+                    Server.Stats['PromptTokens'] += PromptTokens
+                    Server.Stats['CompletionTokens'] += CompletionTokens
+                    Server.Stats['CachedTokens'] += CachedTokens
+
+                Choice = {
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': Content},
+                    'finish_reason': 'stop'
+                }
+                if Request.get('logprobs'):
+                    Choice['logprobs'] = Server.BuildLogprobs(Content, int(Request.get('top_logprobs') or 1))
+
+                self._Send(200, {
+                    'id': f"chatcmpl-mock-{Server.Stats['Requests']}",
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': Match.group(1),
+                    'choices': [Choice],
+                    'usage': {
+                        'prompt_tokens': PromptTokens,
+                        'completion_tokens': CompletionTokens,
+                        'total_tokens': PromptTokens + CompletionTokens,
+                        'prompt_tokens_details': {'cached_tokens': CachedTokens}
+                    }
+                })
+
+        return Handler
+
+
+
+def _ServeMockServer(Options: Dict[str, Any], Connection: Any) -> None:
+    # Child process side of MockServerProcess: serve and answer Stats/ResetStats/Stop commands
+    with MockAzureServer(**Options) as Server:
+        Connection.send(Server.Url)
+        while True:
+            Command = Connection.recv()
+            if Command == 'Stats':
+                with Server._Lock:
+                    Connection.send(dict(Server.Stats))
+            elif Command == 'ResetStats':
+                Server.ResetStats()
+                Connection.send(None)
+            else:
+                break
+
+
+class MockServerProcess:
+    """
+    MockAzureServer running in a child process.
+
+    Keeps the server's threads and allocations out of the measuring process,
+    so tracemalloc and CPU time there only cover the client side. Offers the
+    Url, Stats and ResetStats of MockAzureServer.
+    """
+
+    def __init__(self, **Options: Any):
+        """
+        Args:
+            **Options: Keyword arguments for MockAzureServer
+        """
+        self.Options = Options
+        self.Url: Optional[str] = None
+        self._Process = None
+        self._Connection = None
+
+    @property
+    def Stats(self) -> Dict[str, int]:
+        """Snapshot of the server's request counters."""
+        self._Connection.send('Stats')
+        return self._Connection.recv()
+
+    def ResetStats(self) -> None:
+        """Zero the request counters."""
+        self._Connection.send('ResetStats')
+        self._Connection.recv()
+
+    def Start(self) -> 'MockServerProcess':
+        """Start the child process and wait until it serves requests."""
+        Context = multiprocessing.get_context('spawn')
+        self._Connection, ChildConnection = Context.Pipe()
+        self._Process = Context.Process(target=_ServeMockServer, args=(self.Options, ChildConnection),
+                                        name="MockAzureServer", daemon=True)
+        self._Process.start()
+        ChildConnection.close()
+        self.Url = self._Connection.recv()
+        return self
+
+    def Stop(self) -> None:
+        """Stop the server and wait for the child process to exit."""
+        if self._Process is None:
+            return
+        try:
+            self._Connection.send('Stop')
+        except (BrokenPipeError, OSError):
+            pass
+        self._Process.join(timeout=10)
+        if self._Process.is_alive():
+            self._Process.terminate()
+        self._Connection.close()
+        self._Process = None
+
+    def __enter__(self) -> 'MockServerProcess':
+        return self.Start()
+
+    def __exit__(self, *ExceptionInfo: Any) -> None:
+        self.Stop()
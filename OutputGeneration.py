@@ -1,9 +1,130 @@
-import os
-from openai import AzureOpenAI
-from dotenv import load_dotenv
-from typing import Any
+import time
+from ClientRegistry import RunCoroutine
+from DeploymentRouter import GetDeploymentRouter
+from PromptTemplate import BuildRowMessages, DefaultPromptLayout
+from ResponseCache import ResponseCache, GetResponseCache
+from RequestScheduler import EstimateTokens
+from Telemetry import GetTelemetry
+from typing import Any, Dict, List, Optional
+
+
+async def CreateChatCompletionAsync(Messages: List[Dict[str, str]], UseCache: bool = True,
+                                    Purpose: str = 'Evaluation', **Parameters: Any) -> Dict[str, Any]:
+    """
+    Send a chat completion request, serving identical requests from the response cache.
+
+    Every LLM call in the project goes through this function. Requests that
+    miss the cache are routed to a backend of the deployment pool and sent
+    through that backend's RequestScheduler.
+
+    Args:
+        Messages: Chat messages to send
+        UseCache: Whether to read from and write to the response cache
+        Purpose: 'Evaluation' or 'Improvement'; improvement calls can be pinned to one backend
+        **Parameters: Sampling parameters passed to the API (temperature, max_tokens, ...)
+
+    Returns:
+        Dictionary with 'Content' (the message text), 'Usage' (token usage, if reported) and
+        'Logprobs' (per output token: 'Token', 'Logprob' and 'TopLogprobs', if requested with logprobs=True)
+    """
+    Router = GetDeploymentRouter()
+    Backend = Router.Select(Purpose)
+    Cache = GetResponseCache() if UseCache else None
+    Telemetry = GetTelemetry()
+    StartTime = time.perf_counter()
+
+    # Cache entries are shared by backends serving the same model
+    if Cache is not None:
+        Cached = await Cache.GetAsync(ResponseCache.MakeKey(Backend.Model, Messages, Parameters))
+        if Cached is not None:
+            Telemetry.Record(Latency=time.perf_counter() - StartTime, CacheHit=True, Attempts=0, Backend=Backend.Name)
+            return Cached
+
+    # Send through the backend's scheduler, which enforces its quota budgets and retries
+    CallStats = {}
+    try:
+        Response, Backend = await Router.Execute(
+            Backend, Messages, Parameters,
+            EstimatedTokens=EstimateTokens(Messages, Parameters.get('max_tokens')),
+            Purpose=Purpose,
+            CallStats=CallStats
+        )
+    except Exception as Error:
+        Telemetry.Record(
+            Latency=time.perf_counter() - StartTime,
+            Attempts=CallStats.get('Attempts', 0),
+            Throttled=CallStats.get('Throttled', 0),
+            AttemptLatency=CallStats.get('AttemptSeconds'),
+            Error=type(Error).__name__,
+            Backend=Backend.Name
+        )
+        raise
+
+    Choice = Response.choices[0]
+    Payload = {
+        'Content': Choice.message.content,
+        'Usage': Response.usage.model_dump() if Response.usage is not None else None,
+        'Logprobs': GetTokenLogprobs(Choice)
+    }
+
+    Telemetry.Record(
+        Latency=time.perf_counter() - StartTime,
+        Usage=Payload['Usage'],
+        Attempts=CallStats['Attempts'],
+        Throttled=CallStats['Throttled'],
+        AttemptLatency=CallStats['AttemptSeconds'],
+        Hedged=CallStats['Hedged'],
+        HedgeWon=CallStats['HedgeWon'],
+        HedgeSavedSeconds=CallStats['HedgeSavedSeconds'],
+        Backend=Backend.Name
+    )
+
+    # Do not cache empty (e.g. content-filtered) responses
+    if Cache is not None and Payload['Content'] is not None:
+        await Cache.SetAsync(ResponseCache.MakeKey(Backend.Model, Messages, Parameters), Payload)
+
+    return Payload
+
+
+def GetTokenLogprobs(Choice: Any) -> Optional[List[Dict[str, Any]]]:
+    """
+    Convert the logprobs of a response choice into plain, cacheable dictionaries.
+
+    Args:
+        Choice: First choice of a chat completion response
+
+    Returns:
+        List with 'Token', 'Logprob' and 'TopLogprobs' per output token, or None if logprobs were not requested
+    """
+    Logprobs = getattr(Choice, 'logprobs', None)
+    if Logprobs is None or not Logprobs.content:
+        return None
+    return [
+        {
+            'Token': Item.token,
+            'Logprob': Item.logprob,
+            'TopLogprobs': [{'Token': Top.token, 'Logprob': Top.logprob} for Top in (Item.top_logprobs or [])]
+        }
+        for Item in Logprobs.content
+    ]
+
+
+def CreateChatCompletion(Messages: List[Dict[str, str]], UseCache: bool = True,
+                         Purpose: str = 'Evaluation', **Parameters: Any) -> Dict[str, Any]:
+    """
+    Synchronous wrapper around CreateChatCompletionAsync.
+
+    Args:
+        Messages: Chat messages to send
+        UseCache: Whether to read from and write to the response cache
+        Purpose: 'Evaluation' or 'Improvement'
+        **Parameters: Sampling parameters passed to the API
+
+    Returns:
+        Dictionary with 'Content' and 'Usage'
+    """
+    return RunCoroutine(CreateChatCompletionAsync(Messages, UseCache, Purpose, **Parameters))
 
-load_dotenv()
 
 def GenerateOutput(Prompt: str, **Variables: Any) -> str:
     """
@@ -16,22 +137,37 @@ def GenerateOutput(Prompt: str, **Variables: Any) -> str:
     Returns:
         The generated output from Azure OpenAI
     """
-    # Format the prompt with provided variables
-    FormattedPrompt = Prompt.format(**Variables)
-    
-    # Initialize Azure OpenAI client
-    Client = AzureOpenAI(
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-    )
-    
-    # Generate response
-    Response = Client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-        messages=[
-            {"role": "user", "content": FormattedPrompt}
-        ]
-    )
-    
-    return Response.choices[0].message.content
\ No newline at end of file
+    return RunCoroutine(GenerateOutputAsync(Prompt, **Variables))
+
+
+async def GenerateOutputAsync(Prompt: str, **Variables: Any) -> str:
+    """
+    Async counterpart of GenerateOutput.
+
+    Args:
+        Prompt: The prompt template with f-string placeholders
+        **Variables: All variables required for f-string formatting
+
+    Returns:
+        The generated output from Azure OpenAI
+    """
+    return await GenerateOutputForRowAsync(Prompt, Variables)
+
+
+async def GenerateOutputForRowAsync(Prompt: str, Variables: Dict[str, Any], Layout: str = DefaultPromptLayout) -> str:
+    """
+    Generate output for one row with a chosen message layout.
+
+    Args:
+        Prompt: The prompt template with placeholders for features
+        Variables: Feature values of the row
+        Layout: 'Single' sends one user message; 'Split' and 'Reorder' send the
+            static part of the prompt as a system message shared by every row
+
+    Returns:
+        The generated output from Azure OpenAI
+    """
+    # Render the row into messages, parsing the template only once
+    Response = await CreateChatCompletionAsync(Messages=BuildRowMessages(Prompt, Variables, Layout))
+
+    return Response['Content']
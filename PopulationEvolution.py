@@ -0,0 +1,271 @@
+import asyncio
+import pandas as pd
+from ClientRegistry import RunCoroutine
+from PromptEvaluation import EvaluatePromptAsync, DefaultMaxConcurrency
+from PromptEvolution import ImprovePromptAsync
+from HybridPromptEvolution import HybridImprovePromptAsync
+from PromptTemplate import DefaultPromptLayout, PromptTemplateError
+from CandidateScreening import BuildCoreset, ScreenCandidatesAsync, ScreeningTracker
+from PredictionStore import PredictionStore
+from typing import Any, Dict, List, Optional, Tuple
+
+
+async def GenerateCandidateAsync(Parent: Dict[str, Any], Best: Dict[str, Any], LabelColumn: str,
+                                 Seed: int, Store: PredictionStore) -> str:
+    """
+    Mutate a parent prompt into a new candidate.
+
+    The best member is improved from its own errors; any other parent is
+    improved with hybrid feedback against the best member.
+
+    Args:
+        Parent: Population member to mutate
+        Best: Best population member
+        LabelColumn: Name of the column containing true labels
+        Seed: Sampling seed that makes sibling candidates differ
+        Store: Prediction store holding the members' results
+
+    Returns:
+        The candidate prompt
+    """
+    if Parent is Best:
+        return await ImprovePromptAsync(
+            Prompt=Parent['Prompt'],
+            Accuracy=Parent['Accuracy'],
+            ResultsDataFrame=Store.GetResults(Parent['ResultId']),
+            LabelColumn=LabelColumn,
+            Seed=Seed
+        )
+    return await HybridImprovePromptAsync(
+        BestPrompt=Best['Prompt'],
+        BestAccuracy=Best['Accuracy'],
+        BestResults=Store.GetResults(Best['ResultId']),
+        CurrentPrompt=Parent['Prompt'],
+        CurrentAccuracy=Parent['Accuracy'],
+        CurrentResults=Store.GetResults(Parent['ResultId']),
+        LabelColumn=LabelColumn,
+        Seed=Seed
+    )
+
+
+async def EvolvePopulationAsync(
+    DataFrame: pd.DataFrame,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    PromptTemplate: str,
+    PopulationSize: int = 4,
+    ParentCount: int = 2,
+    MaxGenerations: int = 5,
+    AccuracyThreshold: float = 0.95,
+    MaxConcurrency: int = DefaultMaxConcurrency,
+    ScreeningSize: Optional[int] = None,
+    PromoteCount: int = 2,
+    Store: Optional[PredictionStore] = None,
+    ConstrainedOutput: bool = False,
+    Layout: str = DefaultPromptLayout
+) -> Tuple[str, float, List[Dict[str, Any]]]:
+    """
+    Evolve a population of prompts, generating and evaluating several candidates per generation.
+
+    Each generation mutates the top ParentCount members into PopulationSize
+    candidates concurrently, evaluates all candidates in parallel under one
+    shared concurrency budget and keeps the top ParentCount prompts seen so
+    far as the next parents. With ScreeningSize set, candidates are first
+    scored on a cached representative coreset and only the best
+    PromoteCount per generation are evaluated on the full dataset.
+
+    Results are kept in a PredictionStore; only the parents keep their
+    per-row predictions, so memory does not grow with the generations.
+
+    Args:
+        DataFrame: The dataframe to evaluate on
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        PromptTemplate: The initial prompt
+        PopulationSize: Candidates generated per generation
+        ParentCount: Members kept as parents between generations
+        MaxGenerations: Maximum number of generations
+        AccuracyThreshold: Stop once the best accuracy reaches this value
+        MaxConcurrency: Maximum concurrent evaluation requests across all candidates
+        ScreeningSize: Coreset size for screening candidates, or None to evaluate all in full
+        PromoteCount: Candidates per generation promoted from screening to full evaluation
+        Store: Optional prediction store for the results (default: an in-memory store over DataFrame)
+        ConstrainedOutput: Request label-only answers with logprobs and score their confidence
+        Layout: Message layout, one of 'Single', 'Split' or 'Reorder'
+
+    Returns:
+        Tuple of best prompt, best accuracy and the iteration history
+    """
+    if Store is None:
+        Store = PredictionStore(DataFrame, FeatureColumns, LabelColumn)
+    Semaphore = asyncio.Semaphore(MaxConcurrency)
+    UniqueLabels = [str(Label) for Label in DataFrame[LabelColumn].unique()]
+    Coreset = BuildCoreset(DataFrame, FeatureColumns, LabelColumn, ScreeningSize) if ScreeningSize else None
+    Tracker = ScreeningTracker()
+
+    Accuracy, Results = await EvaluatePromptAsync(
+        PromptTemplate, DataFrame, FeatureColumns, LabelColumn, MaxConcurrency, Semaphore=Semaphore,
+        ConstrainedOutput=ConstrainedOutput, Layout=Layout
+    )
+    Parents = [{'Prompt': PromptTemplate, 'Accuracy': Accuracy, 'ResultId': Store.Add(PromptTemplate, Results),
+                'Generation': 0}]
+    del Results
+    IterationHistory = [{
+        'Iteration': 0,
+        'Generation': 0,
+        'Candidate': 0,
+        'Parent': None,
+        'Accuracy': Accuracy,
+        'Prompt': PromptTemplate,
+        'ResultId': Parents[0]['ResultId']
+    }]
+    print(f"Generation 0 accuracy: {Accuracy:.2%}")
+
+    for Generation in range(1, MaxGenerations + 1):
+        Best = Parents[0]
+        if Best['Accuracy'] >= AccuracyThreshold:
+            print(f"\nTarget accuracy of {AccuracyThreshold:.2%} achieved!")
+            break
+
+        print(f"\n{'='*60}")
+        print(f"GENERATION {Generation}")
+        print(f"{'='*60}")
+        print(f"Best accuracy so far: {Best['Accuracy']:.2%}")
+
+        # Spread candidates round-robin over the parents and sample them concurrently
+        ParentIndices = [Index % len(Parents) for Index in range(PopulationSize)]
+        Candidates = await asyncio.gather(*(
+            GenerateCandidateAsync(Parents[ParentIndex], Best, LabelColumn,
+                                   Seed=Generation * PopulationSize + Index, Store=Store)
+            for Index, ParentIndex in enumerate(ParentIndices)
+        ), return_exceptions=True)
+
+        # Drop candidates that are not valid templates, other failures still abort the run
+        for Index, Candidate in enumerate(Candidates):
+            if isinstance(Candidate, PromptTemplateError):
+                print(f"Candidate {Index} dropped: not a valid template ({Candidate})")
+            elif isinstance(Candidate, BaseException):
+                raise Candidate
+
+        # Skip candidates identical to a prompt already in the population
+        KnownPrompts = {Parent['Prompt'] for Parent in Parents}
+        UniqueCandidates = []
+        for Index, Candidate in enumerate(Candidates):
+            if isinstance(Candidate, PromptTemplateError):
+                continue
+            if Candidate not in KnownPrompts:
+                KnownPrompts.add(Candidate)
+                UniqueCandidates.append((Index, ParentIndices[Index], Candidate))
+
+        # Screen candidates on the coreset and promote only the most promising ones
+        ScreeningScores = {}
+        if Coreset is not None and len(UniqueCandidates) > PromoteCount:
+            Scores = await ScreenCandidatesAsync(
+                [Candidate for _, _, Candidate in UniqueCandidates], Coreset,
+                FeatureColumns, LabelColumn, UniqueLabels, Semaphore, ConstrainedOutput, Layout
+            )
+            ScreeningScores = {Index: Score for (Index, _, _), Score in zip(UniqueCandidates, Scores)}
+            Ranked = sorted(UniqueCandidates, key=lambda Entry: ScreeningScores[Entry[0]], reverse=True)
+            for Index, ParentIndex, Candidate in Ranked[PromoteCount:]:
+                IterationHistory.append({
+                    'Iteration': Generation,
+                    'Generation': Generation,
+                    'Candidate': Index,
+                    'Parent': Parents[ParentIndex]['Prompt'],
+                    'Accuracy': None,
+                    'ScreeningAccuracy': ScreeningScores[Index],
+                    'Prompt': Candidate
+                })
+                print(f"  Candidate {Index} (parent {ParentIndex}): screened out at {ScreeningScores[Index]:.2%}")
+            UniqueCandidates = Ranked[:PromoteCount]
+
+        # Evaluate all candidates in parallel under the shared budget
+        Evaluations = await asyncio.gather(*(
+            EvaluatePromptAsync(Candidate, DataFrame, FeatureColumns, LabelColumn, MaxConcurrency, Semaphore=Semaphore,
+                                ConstrainedOutput=ConstrainedOutput, Layout=Layout)
+            for _, _, Candidate in UniqueCandidates
+        ))
+
+        Offspring = []
+        for (Index, ParentIndex, Candidate), (CandidateAccuracy, CandidateResults) in zip(UniqueCandidates, Evaluations):
+            if Index in ScreeningScores:
+                Tracker.Record(ScreeningScores[Index], CandidateAccuracy)
+            ResultId = Store.Add(Candidate, CandidateResults)
+            Offspring.append({
+                'Prompt': Candidate,
+                'Accuracy': CandidateAccuracy,
+                'ResultId': ResultId,
+                'Generation': Generation
+            })
+            IterationHistory.append({
+                'Iteration': Generation,
+                'Generation': Generation,
+                'Candidate': Index,
+                'Parent': Parents[ParentIndex]['Prompt'],
+                'Accuracy': CandidateAccuracy,
+                'ScreeningAccuracy': ScreeningScores.get(Index),
+                'Prompt': Candidate,
+                'ResultId': ResultId
+            })
+            print(f"  Candidate {Index} (parent {ParentIndex}): {CandidateAccuracy:.2%}")
+
+        # Keep the top prompts as the next parents (stable sort keeps older members on ties)
+        Parents = sorted(Parents + Offspring, key=lambda Member: Member['Accuracy'], reverse=True)[:ParentCount]
+        del Evaluations
+        Store.Retain(Parent['ResultId'] for Parent in Parents)
+        if Parents[0]['Accuracy'] > Best['Accuracy']:
+            print(f"\nNew best prompt found! Accuracy: {Parents[0]['Accuracy']:.2%}")
+
+    if Coreset is not None:
+        Report = Tracker.Report()
+        print(f"\nScreening on {len(Coreset)} coreset rows: {Report['Pairs']} promoted candidates, "
+              f"Spearman {Report['Spearman']}, Pearson {Report['Pearson']}, "
+              f"mean absolute error {Report['MeanAbsoluteError']}")
+
+    Best = Parents[0]
+    return Best['Prompt'], Best['Accuracy'], IterationHistory
+
+
+def EvolvePopulation(
+    DataFrame: pd.DataFrame,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    PromptTemplate: str,
+    PopulationSize: int = 4,
+    ParentCount: int = 2,
+    MaxGenerations: int = 5,
+    AccuracyThreshold: float = 0.95,
+    MaxConcurrency: int = DefaultMaxConcurrency,
+    ScreeningSize: Optional[int] = None,
+    PromoteCount: int = 2,
+    Store: Optional[PredictionStore] = None,
+    ConstrainedOutput: bool = False,
+    Layout: str = DefaultPromptLayout
+) -> Tuple[str, float, List[Dict[str, Any]]]:
+    """
+    Synchronous wrapper around EvolvePopulationAsync.
+
+    Args:
+        DataFrame: The dataframe to evaluate on
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        PromptTemplate: The initial prompt
+        PopulationSize: Candidates generated per generation
+        ParentCount: Members kept as parents between generations
+        MaxGenerations: Maximum number of generations
+        AccuracyThreshold: Stop once the best accuracy reaches this value
+        MaxConcurrency: Maximum concurrent evaluation requests across all candidates
+        ScreeningSize: Coreset size for screening candidates, or None to evaluate all in full
+        PromoteCount: Candidates per generation promoted from screening to full evaluation
+        Store: Optional prediction store for the results
+        ConstrainedOutput: Request label-only answers with logprobs and score their confidence
+        Layout: Message layout, one of 'Single', 'Split' or 'Reorder'
+
+    Returns:
+        Tuple of best prompt, best accuracy and the iteration history
+    """
+    return RunCoroutine(EvolvePopulationAsync(
+        DataFrame, FeatureColumns, LabelColumn, PromptTemplate,
+        PopulationSize, ParentCount, MaxGenerations, AccuracyThreshold, MaxConcurrency,
+        ScreeningSize, PromoteCount, Store, ConstrainedOutput, Layout
+    ))
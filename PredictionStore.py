@@ -0,0 +1,329 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+# Label code of rows without an extracted label, and of rows a prompt was not evaluated on
+NoLabelCode = -1
+NotEvaluatedCode = -2
+
+
+class PredictionStore:
+    """
+    Run-scoped store of the predictions of many prompts on one dataset.
+
+    The dataset's feature and label columns are held once. For each prompt
+    only compact per-row arrays are kept, aligned to the dataset rows by
+    their index (the stable row id):
+    - label codes (int16) into the store's label list
+    - bitmaps of evaluated and of correctly classified rows
+    - ids into a table of raw outputs shared by all prompts, so identical
+      outputs (e.g. bare labels) are stored once
+    - the logprob confidence (float32) and label distribution, when present
+
+    With a Directory, the arrays are written as .npy files and memory-mapped,
+    and with SpillText the output table is appended to a file there too, so
+    resident memory stays flat as prompts are added. Result frames are
+    materialized on demand by GetResults; their text columns reference the
+    stored strings instead of copying them.
+    """
+
+    def __init__(self, DataFrame: pd.DataFrame, FeatureColumns: List[str], LabelColumn: str,
+                 UniqueLabels: Optional[Sequence[str]] = None, Directory: Optional[str] = None,
+                 SpillText: bool = False):
+        """
+        Args:
+            DataFrame: Dataset the prompts are evaluated on; its index is the row id and must be unique
+            FeatureColumns: List of column names used as features
+            LabelColumn: The column name containing true labels
+            UniqueLabels: Possible labels; defaults to the labels present in DataFrame
+            Directory: Optional directory for memory-mapped arrays and spilled outputs
+            SpillText: Keep raw outputs in a file under Directory instead of in memory
+
+        Raises:
+            ValueError: If the index is not unique, or SpillText is set without a Directory
+        """
+        if not DataFrame.index.is_unique:
+            raise ValueError("PredictionStore needs a DataFrame with a unique index")
+        if SpillText and Directory is None:
+            raise ValueError("SpillText requires a Directory")
+
+        self.FeatureColumns = list(FeatureColumns)
+        self.LabelColumn = LabelColumn
+        self.Features = DataFrame[self.FeatureColumns + [LabelColumn]]
+        self.RowIds = DataFrame.index
+        self.RowCount = len(DataFrame)
+
+        TrueLabels = DataFrame[LabelColumn].astype(str)
+        self.Labels = [str(Label) for Label in (UniqueLabels if UniqueLabels is not None else TrueLabels.unique())]
+        self._AddLabels(TrueLabels.unique())
+        self.TrueCodes = self._Encode(TrueLabels)
+
+        self.Directory = Directory
+        self.SpillText = SpillText
+        if Directory is not None:
+            os.makedirs(Directory, exist_ok=True)
+
+        self.Entries: Dict[str, Dict[str, Any]] = {}
+        self._Texts: List[str] = []
+        self._TextIndex: Dict[Any, int] = {}
+        self._TextSpans: List[tuple] = []
+        self._TextFile = open(os.path.join(Directory, 'outputs.txt'), 'w+b') if SpillText else None
+        self._Lock = threading.Lock()
+
+    @staticmethod
+    def MakeId(Prompt: str) -> str:
+        """Return the id a prompt's predictions are stored under."""
+        return hashlib.sha256(Prompt.encode('utf-8')).hexdigest()[:16]
+
+    def _AddLabels(self, Labels: Iterable[str]) -> None:
+        for Label in Labels:
+            if Label and Label not in self.Labels:
+                self.Labels.append(Label)
+
+    def _Encode(self, Labels: pd.Series) -> np.ndarray:
+        # Empty strings and unknown values get NoLabelCode
+        return pd.Categorical(Labels, categories=self.Labels).codes.astype(np.int16)
+
+    def _Intern(self, Text: Optional[str]) -> int:
+        Text = Text or ""
+        Key = hashlib.blake2b(Text.encode('utf-8'), digest_size=16).digest() if self.SpillText else Text
+        TextId = self._TextIndex.get(Key)
+        if TextId is not None:
+            return TextId
+        if self.SpillText:
+            Encoded = Text.encode('utf-8')
+            self._TextFile.seek(0, os.SEEK_END)
+            self._TextSpans.append((self._TextFile.tell(), len(Encoded)))
+            self._TextFile.write(Encoded)
+            TextId = len(self._TextSpans) - 1
+        else:
+            self._Texts.append(Text)
+            TextId = len(self._Texts) - 1
+        self._TextIndex[Key] = TextId
+        return TextId
+
+    def _ReadTexts(self, TextIds: np.ndarray) -> np.ndarray:
+        # Decode each distinct output once; rows share the resulting string objects
+        Unique, Inverse = np.unique(TextIds, return_inverse=True)
+        Values = np.empty(len(Unique), dtype=object)
+        with self._Lock:
+            for Position, TextId in enumerate(Unique):
+                if TextId < 0:
+                    Values[Position] = ""
+                elif self.SpillText:
+                    Offset, Length = self._TextSpans[TextId]
+                    self._TextFile.seek(Offset)
+                    Values[Position] = self._TextFile.read(Length).decode('utf-8')
+                else:
+                    Values[Position] = self._Texts[TextId]
+        return Values[Inverse.reshape(-1)]
+
+    def _Persist(self, ResultId: str, Name: str, Array: np.ndarray) -> np.ndarray:
+        # Swap the in-memory array for a read-only memory map when a directory is configured
+        if self.Directory is None:
+            return Array
+        Path = os.path.join(self.Directory, f"{ResultId}.{Name}.npy")
+        np.save(Path, Array)
+        return np.load(Path, mmap_mode='r')
+
+    def Add(self, Prompt: str, ResultDataFrame: pd.DataFrame, ResultId: Optional[str] = None) -> str:
+        """
+        Store the predictions of one prompt.
+
+        Args:
+            Prompt: The prompt the results were produced with
+            ResultDataFrame: Evaluation results with 'Prediction' and 'ExtractedLabel'
+                columns, covering all or (for racing) some of the store's rows
+            ResultId: Id to store the results under (default: MakeId(Prompt)); replaces earlier
+                results unless those cover more rows, e.g. a full evaluation over a race that stopped early
+
+        Returns:
+            The result id
+
+        Raises:
+            KeyError: If the results contain rows that are not in the store's dataset
+        """
+        ResultId = ResultId or self.MakeId(Prompt)
+        Positions = self.RowIds.get_indexer(ResultDataFrame.index)
+        if (Positions < 0).any():
+            raise KeyError(f"{int((Positions < 0).sum())} result rows are not part of the stored dataset")
+        with self._Lock:
+            Existing = self.Entries.get(ResultId)
+        if Existing is not None and Existing['Rows'] > len(Positions):
+            return ResultId
+
+        Extracted = ResultDataFrame['ExtractedLabel'].fillna("").astype(str)
+        Evaluated = np.zeros(self.RowCount, dtype=bool)
+        Evaluated[Positions] = True
+        Codes = np.full(self.RowCount, NotEvaluatedCode, dtype=np.int16)
+        TextIds = np.full(self.RowCount, -1, dtype=np.int32)
+        with self._Lock:
+            self._AddLabels(Extracted.unique())
+            Codes[Positions] = self._Encode(Extracted)
+            TextIds[Positions] = [self._Intern(Text) for Text in ResultDataFrame['Prediction']]
+            ProbabilityIds = None
+            if 'LabelProbabilities' in ResultDataFrame.columns:
+                ProbabilityIds = np.full(self.RowCount, -1, dtype=np.int32)
+                ProbabilityIds[Positions] = [self._Intern(Text) for Text in ResultDataFrame['LabelProbabilities']]
+        Correct = Evaluated & (Codes == self.TrueCodes)
+
+        Arrays = {
+            'Codes': Codes,
+            'TextIds': TextIds,
+            'Evaluated': np.packbits(Evaluated),
+            'Correct': np.packbits(Correct)
+        }
+        if 'Confidence' in ResultDataFrame.columns:
+            Confidence = np.full(self.RowCount, np.nan, dtype=np.float32)
+            Confidence[Positions] = ResultDataFrame['Confidence'].to_numpy(dtype=np.float32)
+            Arrays['Confidence'] = Confidence
+        if ProbabilityIds is not None:
+            Arrays['ProbabilityIds'] = ProbabilityIds
+
+        EvaluatedCount = len(Positions)
+        Entry = {
+            'Prompt': Prompt,
+            'Rows': EvaluatedCount,
+            'Accuracy': int(Correct.sum()) / EvaluatedCount if EvaluatedCount else 0.0,
+            'Attrs': dict(ResultDataFrame.attrs),
+            'Arrays': {Name: self._Persist(ResultId, Name, Array) for Name, Array in Arrays.items()}
+        }
+        with self._Lock:
+            self.Entries[ResultId] = Entry
+        return ResultId
+
+    def __contains__(self, ResultId: str) -> bool:
+        return ResultId in self.Entries
+
+    def HasCompleteResults(self, ResultId: str) -> bool:
+        """Return whether a prompt was evaluated on every row and its per-row predictions were not released."""
+        Entry = self.Entries.get(ResultId)
+        return Entry is not None and Entry['Rows'] == self.RowCount and 'TextIds' in Entry['Arrays']
+
+    def _GetArray(self, ResultId: str, Name: str) -> np.ndarray:
+        Arrays = self.Entries[ResultId]['Arrays']
+        if Name not in Arrays:
+            raise KeyError(f"Predictions of {ResultId} were released; only label codes and bitmaps are kept")
+        return Arrays[Name]
+
+    def GetCorrect(self, ResultId: str) -> np.ndarray:
+        """Return a boolean array over all rows marking correct predictions (False where not evaluated)."""
+        return np.unpackbits(self._GetArray(ResultId, 'Correct'), count=self.RowCount).astype(bool)
+
+    def GetEvaluated(self, ResultId: str) -> np.ndarray:
+        """Return a boolean array over all rows marking the rows the prompt was evaluated on."""
+        return np.unpackbits(self._GetArray(ResultId, 'Evaluated'), count=self.RowCount).astype(bool)
+
+    def GetCodes(self, ResultId: str) -> np.ndarray:
+        """Return the extracted label codes over all rows (NoLabelCode, NotEvaluatedCode or an index into Labels)."""
+        return self._GetArray(ResultId, 'Codes')
+
+    def GetAccuracy(self, ResultId: str) -> float:
+        """Return the accuracy of a prompt on the rows it was evaluated on."""
+        return self.Entries[ResultId]['Accuracy']
+
+    def GetLabelFrame(self, ResultId: str) -> pd.DataFrame:
+        """
+        Return the true and extracted labels of the evaluated rows, without any text columns.
+
+        Args:
+            ResultId: Id returned by Add
+
+        Returns:
+            DataFrame indexed by row id with the label column and 'ExtractedLabel', enough for ComputeErrorAnalytics
+        """
+        Positions = np.flatnonzero(self.GetEvaluated(ResultId))
+        Labels = np.array(self.Labels + [""], dtype=object)
+        Codes = self._GetArray(ResultId, 'Codes')[Positions]
+        return pd.DataFrame({
+            self.LabelColumn: Labels[self.TrueCodes[Positions]],
+            'ExtractedLabel': Labels[Codes]
+        }, index=self.RowIds[Positions])
+
+    def GetResults(self, ResultId: str, Rows: Optional[np.ndarray] = None) -> pd.DataFrame:
+        """
+        Materialize the result frame of a prompt, as returned by EvaluatePrompt.
+
+        Args:
+            ResultId: Id returned by Add
+            Rows: Optional boolean mask over all rows restricting the result (e.g. misclassified rows)
+
+        Returns:
+            DataFrame of the evaluated rows with the feature and label columns,
+            'Prediction', 'ExtractedLabel' and, when stored, 'Confidence' and
+            'LabelProbabilities'; attrs as at Add
+
+        Raises:
+            KeyError: If the id is unknown or its predictions were released
+        """
+        Mask = self.GetEvaluated(ResultId)
+        if Rows is not None:
+            Mask &= Rows
+        Positions = np.flatnonzero(Mask)
+        Arrays = self.Entries[ResultId]['Arrays']
+
+        ResultDataFrame = self.Features.take(Positions)
+        ResultDataFrame['Prediction'] = self._ReadTexts(self._GetArray(ResultId, 'TextIds')[Positions])
+        # NoLabelCode indexes the trailing empty string
+        ResultDataFrame['ExtractedLabel'] = np.array(self.Labels + [""], dtype=object)[self._GetArray(ResultId, 'Codes')[Positions]]
+        if 'Confidence' in Arrays:
+            ResultDataFrame['Confidence'] = Arrays['Confidence'][Positions].astype(float)
+        if 'ProbabilityIds' in Arrays:
+            ResultDataFrame['LabelProbabilities'] = self._ReadTexts(Arrays['ProbabilityIds'][Positions])
+        ResultDataFrame.attrs = dict(self.Entries[ResultId]['Attrs'])
+        return ResultDataFrame
+
+    def Release(self, ResultIds: Iterable[str]) -> None:
+        """
+        Drop the per-row predictions of prompts that are no longer needed.
+
+        Their label codes, evaluated and correctness bitmaps and accuracy are
+        kept, so cross-prompt analytics and ensembles still work; GetResults
+        raises for them.
+        Outputs in the shared table are kept, since other prompts may use them.
+
+        Args:
+            ResultIds: Ids returned by Add
+        """
+        with self._Lock:
+            for ResultId in ResultIds:
+                Arrays = self.Entries[ResultId]['Arrays']
+                for Name in [Name for Name in Arrays if Name not in ('Codes', 'Evaluated', 'Correct')]:
+                    del Arrays[Name]
+                    if self.Directory is not None:
+                        Path = os.path.join(self.Directory, f"{ResultId}.{Name}.npy")
+                        if os.path.exists(Path):
+                            os.remove(Path)
+
+    def Retain(self, ResultIds: Iterable[str]) -> None:
+        """Release every stored prompt except the given ones."""
+        Keep = set(ResultIds)
+        self.Release([ResultId for ResultId in self.Entries if ResultId not in Keep])
+
+    def GetMemoryUsage(self) -> Dict[str, int]:
+        """
+        Return the bytes held in memory by the store.
+
+        Returns:
+            Dictionary with 'Features', 'Arrays' (per-prompt arrays not memory-mapped)
+            and 'Texts' (in-memory output table)
+        """
+        with self._Lock:
+            ArrayBytes = sum(
+                Array.nbytes for Entry in self.Entries.values() for Array in Entry['Arrays'].values()
+                if not isinstance(Array, np.memmap)
+            )
+            TextBytes = sum(len(Text) for Text in self._Texts)
+        return {
+            'Features': int(self.Features.memory_usage(deep=True).sum()),
+            'Arrays': ArrayBytes,
+            'Texts': TextBytes
+        }
+
+    def Close(self) -> None:
+        """Close the spilled output file."""
+        if self._TextFile is not None:
+            self._TextFile.close()
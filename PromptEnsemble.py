@@ -0,0 +1,201 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from PredictionStore import PredictionStore
+
+# Voting schemes of ScoreEnsemble
+EnsembleMethods = ('Majority', 'Weighted')
+
+# Prompts combined by the ensemble reported at the end of a run
+DefaultEnsembleSize = int(os.getenv("ENSEMBLE_SIZE", "3"))
+
+
+def SelectEnsembleMembers(Store: PredictionStore, Size: int = DefaultEnsembleSize) -> List[str]:
+    """
+    Pick the most accurate prompts evaluated on every row of the store.
+
+    Args:
+        Store: Prediction store of the run
+        Size: Maximum number of members
+
+    Returns:
+        Result ids, most accurate first (racing evaluations that stopped early are skipped)
+    """
+    Complete = [ResultId for ResultId, Entry in Store.Entries.items() if Entry['Rows'] == Store.RowCount]
+    return sorted(Complete, key=Store.GetAccuracy, reverse=True)[:Size]
+
+
+def GetVoteWeights(Accuracies: Sequence[float], LabelCount: int, Method: str = 'Weighted') -> np.ndarray:
+    """
+    Return one vote weight per member.
+
+    'Majority' gives every member one vote. 'Weighted' uses the multi-class
+    log-odds of each member's accuracy, log((K - 1) * a / (1 - a)) for K
+    labels, so a member no better than chance gets no weight.
+
+    Args:
+        Accuracies: Accuracy of each member
+        LabelCount: Number of labels
+        Method: One of EnsembleMethods
+
+    Returns:
+        Array of non-negative weights
+    """
+    if Method not in EnsembleMethods:
+        raise ValueError(f"Method must be one of {EnsembleMethods}, got {Method!r}")
+    if Method == 'Majority':
+        return np.ones(len(Accuracies))
+    Accuracy = np.clip(np.asarray(Accuracies, dtype=float), 0.01, 0.99)
+    return np.maximum(0.0, np.log(max(1, LabelCount - 1) * Accuracy / (1 - Accuracy)))
+
+
+def VoteLabels(Codes: np.ndarray, Weights: np.ndarray, LabelCount: int) -> np.ndarray:
+    """
+    Combine per-member label codes into one code per row.
+
+    Args:
+        Codes: Members x rows array of label codes (negative codes do not vote)
+        Weights: Vote weight per member
+        LabelCount: Number of labels
+
+    Returns:
+        Winning label code per row, -1 where no member voted; ties go to the earlier member
+    """
+    MemberCount, RowCount = Codes.shape
+    Scores = np.zeros((LabelCount, RowCount))
+    for Member in range(MemberCount):
+        Valid = np.flatnonzero(Codes[Member] >= 0)
+        # A vanishing bonus by rank breaks ties in favour of the better member
+        Scores[Codes[Member][Valid], Valid] += Weights[Member] + 1e-9 * (MemberCount - Member)
+    Winners = Scores.argmax(axis=0).astype(np.int16)
+    Winners[Scores.max(axis=0) <= 0] = -1
+    return Winners
+
+
+def ScoreEnsemble(Store: PredictionStore, ResultIds: Sequence[str], Method: str = 'Weighted',
+                  Weights: Optional[Sequence[float]] = None) -> Dict[str, Any]:
+    """
+    Score a vote over several prompts from their stored predictions, without LLM calls.
+
+    Args:
+        Store: Prediction store holding the members' label codes
+        ResultIds: Member result ids, best first
+        Method: One of EnsembleMethods; ignored when Weights is given
+        Weights: Optional fixed vote weights, e.g. learned on training data and reused on validation
+
+    Returns:
+        Dictionary containing:
+        - 'Members', 'Weights', 'Method'
+        - 'Accuracy': ensemble accuracy on the rows every member was evaluated on
+        - 'Rows': number of those rows
+        - 'MemberAccuracies': accuracy of each member on the same rows
+        - 'Gain': ensemble accuracy minus the best member accuracy
+        - 'Predictions': Series of ensemble labels indexed by row id
+    """
+    Codes = np.stack([Store.GetCodes(ResultId) for ResultId in ResultIds])
+    Rows = (Codes != -2).all(axis=0)
+    Codes = Codes[:, Rows]
+    TrueCodes = Store.TrueCodes[Rows]
+
+    MemberAccuracies = (Codes == TrueCodes).mean(axis=1) if Rows.any() else np.zeros(len(ResultIds))
+    if Weights is None:
+        Weights = GetVoteWeights([Store.GetAccuracy(ResultId) for ResultId in ResultIds], len(Store.Labels), Method)
+    else:
+        Method = 'Fixed'
+    Weights = np.asarray(Weights, dtype=float)
+
+    Winners = VoteLabels(Codes, Weights, len(Store.Labels))
+    Accuracy = float((Winners == TrueCodes).mean()) if Rows.any() else 0.0
+    Labels = np.array(Store.Labels + [""], dtype=object)
+    return {
+        'Members': list(ResultIds),
+        'Weights': Weights.tolist(),
+        'Method': Method,
+        'Accuracy': Accuracy,
+        'Rows': int(Rows.sum()),
+        'MemberAccuracies': MemberAccuracies.tolist(),
+        'Gain': Accuracy - float(MemberAccuracies.max()) if len(MemberAccuracies) else 0.0,
+        'Predictions': pd.Series(Labels[Winners], index=Store.RowIds[Rows], name='EnsembleLabel')
+    }
+
+
+def FormatEnsembleReport(Result: Dict[str, Any], Title: str = "Ensemble") -> str:
+    """
+    Format an ensemble score.
+
+    Args:
+        Result: Result of ScoreEnsemble
+        Title: Leading label of the report
+
+    Returns:
+        One summary line plus one line per member
+    """
+    Lines = [f"{Title} of {len(Result['Members'])} prompts ({Result['Method'].lower()} vote): "
+             f"{Result['Accuracy']:.2%} on {Result['Rows']} rows ({Result['Gain']:+.2%} vs best member)"]
+    for Position, (ResultId, Weight, Accuracy) in enumerate(zip(Result['Members'], Result['Weights'],
+                                                               Result['MemberAccuracies'])):
+        Lines.append(f"  Member {Position + 1} [{ResultId}]: accuracy {Accuracy:.2%}, weight {Weight:.2f}")
+    return "\n".join(Lines)
+
+
+def GetEnsemblePath(OutputPath: str) -> str:
+    """Return where the ensemble is saved next to the best prompt file."""
+    return os.path.splitext(OutputPath)[0] + 'Ensemble.json'
+
+
+def SaveEnsemble(Path: str, Prompts: Sequence[str], Result: Dict[str, Any]) -> None:
+    """
+    Save the member prompts and vote weights of an ensemble.
+
+    Args:
+        Path: JSON file to write
+        Prompts: Member prompts, in the order of Result['Members']
+        Result: Result of ScoreEnsemble
+    """
+    with open(Path, 'w', encoding='utf-8') as File:
+        json.dump({
+            'Prompts': list(Prompts),
+            'Weights': Result['Weights'],
+            'Method': Result['Method'],
+            'TrainingAccuracy': Result['Accuracy']
+        }, File, ensure_ascii=False, indent=2)
+
+
+def LoadEnsemble(Path: str) -> Dict[str, Any]:
+    """Load an ensemble written by SaveEnsemble."""
+    with open(Path, 'r', encoding='utf-8') as File:
+        return json.load(File)
+
+
+def EvaluateEnsemble(Ensemble: Dict[str, Any], Store: PredictionStore) -> Optional[Tuple[float, Dict[str, Any]]]:
+    """
+    Score a saved ensemble from stored predictions, e.g. on the validation split, without LLM calls.
+
+    Members without predictions on every row of Store are skipped with a
+    warning; the others vote with their saved weights.
+
+    Args:
+        Ensemble: Result of LoadEnsemble
+        Store: Prediction store over the dataset to score on, e.g. the validation
+            store filled by Main's background validation
+
+    Returns:
+        Tuple of the ensemble accuracy and the ScoreEnsemble result, or None
+        when no member has stored predictions
+    """
+    Members, Weights = [], []
+    for Prompt, Weight in zip(Ensemble['Prompts'], Ensemble['Weights']):
+        ResultId = PredictionStore.MakeId(Prompt)
+        if ResultId in Store and Store.Entries[ResultId]['Rows'] == Store.RowCount:
+            Members.append(ResultId)
+            Weights.append(Weight)
+    Skipped = len(Ensemble['Prompts']) - len(Members)
+    if Skipped:
+        print(f"Warning: {Skipped}/{len(Ensemble['Prompts'])} ensemble members have no stored predictions "
+              f"on every row and are left out of the vote")
+    if not Members:
+        return None
+    Result = ScoreEnsemble(Store, Members, Weights=Weights)
+    return Result['Accuracy'], Result
@@ -1,12 +1,25 @@
+import os
+import time
+import asyncio
 import pandas as pd
-import re
-from typing import List, Tuple
-from OutputGeneration import GenerateOutput
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple
+from Checkpoint import GetPredictionLog, PredictionLog, UsePredictionLog
+from ConfidenceScoring import AttachConfidence, GenerateLabelAsync
+from ClientRegistry import RunCoroutine
+from LabelExtraction import GetLabelExtractor
+from OutputGeneration import CreateChatCompletionAsync, GenerateOutputForRowAsync
+from PromptTemplate import CheckPromptLayout, CompilePrompt, DefaultPromptLayout
+from RequestPacking import BuildPackedMessages, ParsePackedResponse
+from RequestScheduler import EstimateTokens
+from Telemetry import SummarizeUsage, TrackUsage
+
+# Maximum number of in-flight LLM requests per evaluation
+DefaultMaxConcurrency = int(os.getenv("EVALUATION_MAX_CONCURRENCY", "8"))
 
 
 def ExtractLabelFromOutput(Output: str, UniqueLabels: List[str]) -> str:
     """
-    Extract a label from GPT output using regex matching.
+    Extract a label from GPT output using the compiled extractor for the label set.
     
     Args:
         Output: The GPT-generated output text
@@ -15,30 +28,325 @@ def ExtractLabelFromOutput(Output: str, UniqueLabels: List[str]) -> str:
     Returns:
         Matched label or empty string if no match found
     """
-    # Escape special regex characters in labels
-    EscapedLabels = [re.escape(str(Label)) for Label in UniqueLabels]
+    return GetLabelExtractor(UniqueLabels).ExtractLabel(Output)
+
+
+def ScorePredictions(
+    DataFrame: pd.DataFrame,
+    Predictions: List[str],
+    LabelColumn: str,
+    UniqueLabels: Optional[List[str]] = None
+) -> Tuple[float, pd.DataFrame]:
+    """
+    Attach raw predictions to a copy of the dataframe, extract labels and compute accuracy.
+    
+    Args:
+        DataFrame: The dataframe the predictions were generated for
+        Predictions: Raw model outputs, in the same order as the dataframe rows
+        LabelColumn: The column name containing true labels
+        UniqueLabels: Labels to extract; defaults to the labels present in DataFrame
+    
+    Returns:
+        Tuple containing:
+        - Accuracy score (float between 0 and 1)
+        - DataFrame with additional 'Prediction' and 'ExtractedLabel' columns
+    """
+    # Get unique labels from the label column
+    if UniqueLabels is None:
+        UniqueLabels = DataFrame[LabelColumn].unique().tolist()
+    UniqueLabels = [str(Label) for Label in UniqueLabels]
+    
+    # Add predictions to dataframe
+    ResultDataFrame = DataFrame.copy()
+    ResultDataFrame['Prediction'] = [(Prediction or "").strip() for Prediction in Predictions]
+    
+    return RescorePredictions(ResultDataFrame, LabelColumn, UniqueLabels)
+
+
+def RescorePredictions(
+    ResultDataFrame: pd.DataFrame,
+    LabelColumn: str,
+    UniqueLabels: Optional[List[str]] = None,
+    MultipleLabelPolicy: str = 'First'
+) -> Tuple[float, pd.DataFrame]:
+    """
+    Re-extract labels from existing predictions and recompute accuracy, without any LLM calls.
+    
+    Args:
+        ResultDataFrame: DataFrame with a 'Prediction' column; 'ExtractedLabel' is (re)written in place
+        LabelColumn: The column name containing true labels
+        UniqueLabels: Labels to extract; defaults to the labels present in ResultDataFrame
+        MultipleLabelPolicy: How to resolve outputs naming several labels ('First' or 'Reject')
+    
+    Returns:
+        Tuple containing:
+        - Accuracy score (float between 0 and 1)
+        - The same DataFrame with an updated 'ExtractedLabel' column
+    """
+    if UniqueLabels is None:
+        UniqueLabels = ResultDataFrame[LabelColumn].unique().tolist()
+    
+    # Extract labels for the whole column at once
+    Extractor = GetLabelExtractor(UniqueLabels, MultipleLabelPolicy)
+    ResultDataFrame['ExtractedLabel'] = Extractor.ExtractLabels(ResultDataFrame['Prediction']).to_numpy()
     
-    # Create pattern that matches any of the labels (case-insensitive)
-    Pattern = r'\b(' + '|'.join(EscapedLabels) + r')\b'
+    # Calculate accuracy using extracted labels
+    CorrectPredictions = int((
+        ResultDataFrame['ExtractedLabel'] == ResultDataFrame[LabelColumn].astype(str)
+    ).sum())
+    Accuracy = CorrectPredictions / len(ResultDataFrame)
     
-    # Search for the pattern in the output
-    Match = re.search(Pattern, Output, re.IGNORECASE)
+    return Accuracy, ResultDataFrame
+
+
+async def RunBoundedAsync(Function: Callable[[Any], Awaitable[Any]], Items: Sequence[Any], Workers: int) -> List[Any]:
+    """
+    Await Function for every item with at most Workers calls pending at once.
     
-    if Match:
-        # Find which original label matches (case-insensitive)
-        MatchedText = Match.group(1)
-        for Label in UniqueLabels:
-            if str(Label).lower() == MatchedText.lower():
-                return str(Label)
+    Unlike one gather over all items, only Workers coroutines exist at any
+    time, so memory does not grow with the number of rows.
     
-    return ""
+    Args:
+        Function: Coroutine function called with one item
+        Items: Items to process
+        Workers: Number of concurrent calls
+    
+    Returns:
+        Results in item order; a call that raised leaves its exception in place of the result
+    """
+    Results: List[Any] = [None] * len(Items)
+    Positions = iter(range(len(Items)))
+    
+    async def Worker():
+        for Position in Positions:
+            try:
+                Results[Position] = await Function(Items[Position])
+            except Exception as Error:
+                Results[Position] = Error
+    
+    await asyncio.gather(*(Worker() for _ in range(max(1, min(Workers, len(Items))))))
+    return Results
+
+
+async def EvaluatePromptAsync(
+    Prompt: str,
+    DataFrame: pd.DataFrame,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    MaxConcurrency: int = DefaultMaxConcurrency,
+    UniqueLabels: Optional[List[str]] = None,
+    Semaphore: Optional[asyncio.Semaphore] = None,
+    ConstrainedOutput: bool = False,
+    Layout: str = DefaultPromptLayout
+) -> Tuple[float, pd.DataFrame]:
+    """
+    Evaluate a prompt with concurrent LLM requests.
+    
+    At most MaxConcurrency rows are in flight at once; predictions keep
+    the order of the input rows. Passing a Semaphore also shares one
+    concurrency budget between several evaluations. Inside UsePredictionLog,
+    rows already in the log are not requested again and new predictions are
+    logged as they complete.
+    
+    With ConstrainedOutput, each row is answered with the label only (capped
+    max_tokens, stop at the first line break) and the top logprobs of the
+    answer give a probability per label.
+    
+    With Layout 'Split' or 'Reorder', the static part of the prompt is sent
+    as a system message that is identical for every row, so the provider can
+    serve it from its prompt cache.
+    
+    Args:
+        Prompt: The prompt template with placeholders for features
+        DataFrame: The dataframe to evaluate on
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        MaxConcurrency: Maximum number of concurrent requests
+        UniqueLabels: Labels to extract; defaults to the labels present in DataFrame
+        Semaphore: Optional semaphore shared with other evaluations
+        ConstrainedOutput: Request label-only answers with logprobs and score their confidence
+        Layout: Message layout, one of 'Single', 'Split' or 'Reorder'
+    
+    Returns:
+        Tuple containing:
+        - Accuracy score (float between 0 and 1)
+        - DataFrame with additional 'Prediction' and 'ExtractedLabel' columns, plus
+          'Confidence' and 'LabelProbabilities' with ConstrainedOutput; attrs hold
+          the token usage of the evaluation (see Telemetry.SummarizeUsage)
+    
+    Raises:
+        PromptTemplateError: If the prompt placeholders do not match FeatureColumns
+    """
+    # Reject a malformed template before any request is sent
+    CompilePrompt(Prompt, FeatureColumns)
+    CheckPromptLayout(Prompt, Layout)
+    if Semaphore is None:
+        Semaphore = asyncio.Semaphore(MaxConcurrency)
+    if UniqueLabels is None:
+        UniqueLabels = DataFrame[LabelColumn].unique().tolist()
+    UniqueLabels = [str(Label) for Label in UniqueLabels]
+    Log = GetPredictionLog()
+    LogKey = PredictionLog.MakePromptKey(Prompt, ConstrainedOutput=ConstrainedOutput, Layout=Layout)
+    
+    async def GenerateRow(Variables):
+        Logged = Log.Get(LogKey, Variables) if Log is not None else None
+        if Logged is not None:
+            return Logged
+        async with Semaphore:
+            if ConstrainedOutput:
+                Result = await GenerateLabelAsync(Prompt, Variables, UniqueLabels, Layout=Layout)
+                Prediction, Probabilities = Result['Content'], Result['Probabilities']
+            else:
+                Prediction, Probabilities = await GenerateOutputForRowAsync(Prompt, Variables, Layout), {}
+        if Log is not None:
+            Log.Append(LogKey, Variables, Prediction, Probabilities)
+        return Prediction, Probabilities
+    
+    # Create variables dicts for the prompt, one per row
+    RowVariables = DataFrame[FeatureColumns].to_dict('records')
+    
+    # Generate predictions for all rows with a fixed number of workers, in input order
+    with TrackUsage() as Usage:
+        Results = await RunBoundedAsync(GenerateRow, RowVariables, MaxConcurrency)
+    
+    # Keep the completed predictions when some rows fail after all retries
+    Failures = [Result for Result in Results if isinstance(Result, Exception)]
+    if Failures:
+        if len(Failures) == len(Results):
+            raise Failures[0]
+        print(f"Warning: {len(Failures)}/{len(Results)} rows failed after retries and are scored as incorrect "
+              f"(first error: {Failures[0]})")
+        Results = [("", {}) if isinstance(Result, Exception) else Result for Result in Results]
+    
+    Accuracy, ResultDataFrame = ScorePredictions(
+        DataFrame, [Prediction for Prediction, _ in Results], LabelColumn, UniqueLabels
+    )
+    if ConstrainedOutput:
+        AttachConfidence(ResultDataFrame, [Probabilities for _, Probabilities in Results])
+    ResultDataFrame.attrs.update(SummarizeUsage(Usage))
+    
+    return Accuracy, ResultDataFrame
+
+
+async def EvaluatePromptPackedAsync(
+    Prompt: str,
+    DataFrame: pd.DataFrame,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    PackSize: int = 10,
+    MaxConcurrency: int = DefaultMaxConcurrency,
+    UniqueLabels: Optional[List[str]] = None,
+    Semaphore: Optional[asyncio.Semaphore] = None
+) -> Tuple[float, pd.DataFrame]:
+    """
+    Evaluate a prompt by classifying PackSize rows per LLM request.
+    
+    Each request returns a JSON array of labels. Packs whose array is
+    malformed or has the wrong length, and rows whose entry is not a valid
+    label, are re-run with regular per-row requests. Rows found in an active
+    prediction log are not packed again.
+    
+    Args:
+        Prompt: The prompt template with placeholders for features
+        DataFrame: The dataframe to evaluate on
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        PackSize: Rows per request
+        MaxConcurrency: Maximum number of concurrent requests
+        UniqueLabels: Labels to extract; defaults to the labels present in DataFrame
+        Semaphore: Optional semaphore shared with other evaluations
+    
+    Returns:
+        Tuple containing:
+        - Accuracy score (float between 0 and 1)
+        - DataFrame with additional 'Prediction' and 'ExtractedLabel' columns;
+          attrs hold 'PackSize', 'PackedRequests', 'FallbackRows' and the token usage
+    
+    Raises:
+        PromptTemplateError: If the prompt placeholders do not match FeatureColumns
+    """
+    CompilePrompt(Prompt, FeatureColumns)
+    if UniqueLabels is None:
+        UniqueLabels = DataFrame[LabelColumn].unique().tolist()
+    UniqueLabels = [str(Label) for Label in UniqueLabels]
+    if Semaphore is None:
+        Semaphore = asyncio.Semaphore(MaxConcurrency)
+    
+    RowVariables = DataFrame[FeatureColumns].to_dict('records')
+    Log = GetPredictionLog()
+    LogKey = PredictionLog.MakePromptKey(Prompt, PackSize=PackSize)
+    
+    # Only pack rows the prediction log cannot answer
+    Predictions = [None] * len(RowVariables)
+    PendingPositions = []
+    for Position, Variables in enumerate(RowVariables):
+        Logged = Log.Get(LogKey, Variables) if Log is not None else None
+        if Logged is not None:
+            Predictions[Position] = Logged[0] or None
+        else:
+            PendingPositions.append(Position)
+    Packs = [PendingPositions[Start:Start + PackSize] for Start in range(0, len(PendingPositions), PackSize)]
+    
+    async def ClassifyPack(PackPositions):
+        PackVariables = [RowVariables[Position] for Position in PackPositions]
+        async with Semaphore:
+            try:
+                Response = await CreateChatCompletionAsync(
+                    Messages=BuildPackedMessages(Prompt, PackVariables, UniqueLabels)
+                )
+            except Exception as Error:
+                print(f"Warning: packed request failed, falling back to per-row requests ({Error})")
+                return [None] * len(PackVariables)
+        Labels = ParsePackedResponse(Response['Content'], len(PackVariables), UniqueLabels)
+        if Labels is None:
+            return [None] * len(PackVariables)
+        # Log valid labels now; rows left for the fallback are logged once it answers them
+        if Log is not None:
+            for Variables, Label in zip(PackVariables, Labels):
+                if Label:
+                    Log.Append(LogKey, Variables, Label)
+        return [Label or None for Label in Labels]
+    
+    with TrackUsage() as Usage:
+        PackResults = await RunBoundedAsync(ClassifyPack, Packs, MaxConcurrency)
+        for PackPositions, Labels in zip(Packs, PackResults):
+            for Position, Label in zip(PackPositions, Labels):
+                Predictions[Position] = Label
+        
+        # Fall back to per-row requests for rows the packed responses did not cover
+        FallbackPositions = [Position for Position, Prediction in enumerate(Predictions) if Prediction is None]
+        if FallbackPositions:
+            # Fallback rows are logged under the packed key so a packed resume finds them
+            with UsePredictionLog(None):
+                _, FallbackResults = await EvaluatePromptAsync(
+                    Prompt, DataFrame.iloc[FallbackPositions], FeatureColumns, LabelColumn,
+                    MaxConcurrency, UniqueLabels=UniqueLabels, Semaphore=Semaphore
+                )
+            for Position, Prediction in zip(FallbackPositions, FallbackResults['Prediction']):
+                Predictions[Position] = Prediction
+                if Log is not None:
+                    Log.Append(LogKey, RowVariables[Position], Prediction)
+    
+    Accuracy, ResultDataFrame = ScorePredictions(DataFrame, Predictions, LabelColumn, UniqueLabels)
+    ResultDataFrame.attrs.update({
+        'PackSize': PackSize,
+        'PackedRequests': len(Packs),
+        'FallbackRows': len(FallbackPositions),
+        **SummarizeUsage(Usage)
+    })
+    
+    return Accuracy, ResultDataFrame
 
 
 def EvaluatePrompt(
     Prompt: str, 
     DataFrame: pd.DataFrame, 
     FeatureColumns: List[str], 
-    LabelColumn: str
+    LabelColumn: str,
+    MaxConcurrency: int = DefaultMaxConcurrency,
+    PackSize: int = 1,
+    ConstrainedOutput: bool = False,
+    Layout: str = DefaultPromptLayout
 ) -> Tuple[float, pd.DataFrame]:
     """
     Evaluate a prompt by using it to predict labels and calculating accuracy.
@@ -48,41 +356,111 @@ def EvaluatePrompt(
         DataFrame: The dataframe to evaluate on
         FeatureColumns: List of column names to use as features
         LabelColumn: The column name containing true labels
+        MaxConcurrency: Maximum number of concurrent requests
+        PackSize: Rows classified per request; values above 1 use packed requests
+        ConstrainedOutput: Request label-only answers with logprobs and score their confidence
+        Layout: Message layout of per-row requests, one of 'Single', 'Split' or 'Reorder'
     
     Returns:
         Tuple containing:
         - Accuracy score (float between 0 and 1)
         - DataFrame with additional 'Prediction' column
     """
-    # Get unique labels from the label column
-    UniqueLabels = DataFrame[LabelColumn].unique().tolist()
-    UniqueLabels = [str(Label) for Label in UniqueLabels]
+    if PackSize > 1:
+        # Packed responses are JSON arrays, so their logprobs do not map to single labels
+        if ConstrainedOutput:
+            print("Warning: ConstrainedOutput is ignored for packed requests (PackSize > 1)")
+        # Packed requests carry their own instructions around the row block, so there is no per-row layout
+        if Layout != 'Single':
+            print(f"Warning: Layout {Layout!r} is ignored for packed requests (PackSize > 1)")
+        return RunCoroutine(
+            EvaluatePromptPackedAsync(Prompt, DataFrame, FeatureColumns, LabelColumn, PackSize, MaxConcurrency)
+        )
+    return RunCoroutine(
+        EvaluatePromptAsync(Prompt, DataFrame, FeatureColumns, LabelColumn, MaxConcurrency,
+                            ConstrainedOutput=ConstrainedOutput, Layout=Layout)
+    )
+
+
+def ComparePackingParity(
+    Prompt: str,
+    DataFrame: pd.DataFrame,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    PackSizes: Sequence[int] = (5, 10, 20),
+    SampleSize: int = 200,
+    RandomState: int = 0
+) -> pd.DataFrame:
+    """
+    Compare packed evaluation against per-row evaluation on a sample.
     
-    Predictions = []
-    ExtractedLabels = []
+    Responses already in the response cache are served locally, so Seconds
+    is only comparable between runs with the same cache state. Requests and
+    PromptTokens are computed from the requests themselves; PromptTokens of
+    packed modes excludes per-row fallbacks, which are counted in Requests.
     
-    # Generate predictions for each row
-    for _, Row in DataFrame.iterrows():
-        # Create variables dict for the prompt
-        Variables = {Col: Row[Col] for Col in FeatureColumns}
-        
-        # Generate prediction using the prompt
-        Prediction = GenerateOutput(Prompt, **Variables)
-        Predictions.append(Prediction.strip())
-        
-        # Extract label from prediction
-        ExtractedLabel = ExtractLabelFromOutput(Prediction, UniqueLabels)
-        ExtractedLabels.append(ExtractedLabel)
+    Args:
+        Prompt: The prompt template with placeholders for features
+        DataFrame: The dataframe to sample from
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        PackSizes: Pack sizes to compare with unpacked mode
+        SampleSize: Rows sampled for the comparison
+        RandomState: Seed for the sample
     
-    # Add predictions to dataframe
-    ResultDataFrame = DataFrame.copy()
-    ResultDataFrame['Prediction'] = Predictions
-    ResultDataFrame['ExtractedLabel'] = ExtractedLabels
+    Returns:
+        DataFrame with one row per pack size (1 = unpacked) and columns
+        Accuracy, AgreementWithUnpacked, Requests, FallbackRows, PromptTokens and Seconds
+    """
+    Sample = DataFrame.sample(n=min(SampleSize, len(DataFrame)), random_state=RandomState)
+    UniqueLabels = [str(Label) for Label in DataFrame[LabelColumn].unique()]
+    RowVariables = Sample[FeatureColumns].to_dict('records')
+    Template = CompilePrompt(Prompt, FeatureColumns)
     
-    # Calculate accuracy using extracted labels
-    CorrectPredictions = sum(
-        ResultDataFrame['ExtractedLabel'] == ResultDataFrame[LabelColumn].astype(str)
-    )
-    Accuracy = CorrectPredictions / len(ResultDataFrame)
+    async def Compare():
+        Report = []
+        
+        StartTime = time.perf_counter()
+        BaselineAccuracy, BaselineResults = await EvaluatePromptAsync(
+            Prompt, Sample, FeatureColumns, LabelColumn, UniqueLabels=UniqueLabels
+        )
+        Report.append({
+            'PackSize': 1,
+            'Accuracy': BaselineAccuracy,
+            'AgreementWithUnpacked': 1.0,
+            'Requests': len(Sample),
+            'FallbackRows': 0,
+            'PromptTokens': sum(
+                EstimateTokens([{"role": "user", "content": Template.Render(Variables)}], MaxTokens=0)
+                for Variables in RowVariables
+            ),
+            'Seconds': time.perf_counter() - StartTime
+        })
+        
+        for PackSize in PackSizes:
+            StartTime = time.perf_counter()
+            PackedAccuracy, PackedResults = await EvaluatePromptPackedAsync(
+                Prompt, Sample, FeatureColumns, LabelColumn, PackSize, UniqueLabels=UniqueLabels
+            )
+            Seconds = time.perf_counter() - StartTime
+            
+            FallbackRows = PackedResults.attrs['FallbackRows']
+            PackedTokens = sum(
+                EstimateTokens(BuildPackedMessages(Prompt, RowVariables[Start:Start + PackSize], UniqueLabels), MaxTokens=0)
+                for Start in range(0, len(RowVariables), PackSize)
+            )
+            Report.append({
+                'PackSize': PackSize,
+                'Accuracy': PackedAccuracy,
+                'AgreementWithUnpacked': float(
+                    (PackedResults['ExtractedLabel'].to_numpy() == BaselineResults['ExtractedLabel'].to_numpy()).mean()
+                ),
+                'Requests': PackedResults.attrs['PackedRequests'] + FallbackRows,
+                'FallbackRows': FallbackRows,
+                'PromptTokens': PackedTokens,
+                'Seconds': Seconds
+            })
+        
+        return pd.DataFrame(Report).set_index('PackSize')
     
-    return Accuracy, ResultDataFrame
\ No newline at end of file
+    return RunCoroutine(Compare())
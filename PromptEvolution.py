@@ -1,17 +1,33 @@
-import os
 import pandas as pd
-from openai import AzureOpenAI
-from dotenv import load_dotenv
-from typing import Optional
+from ClientRegistry import RunCoroutine
+from OutputGeneration import CreateChatCompletionAsync
+from ErrorContext import BuildErrorContext, DefaultErrorContextTokens, ResultColumns
+from PromptTemplate import GetPlaceholders, RepairPromptAsync
+from typing import Any, Dict, Optional
 
-load_dotenv()
+
+def GetSamplingOptions(Seed: Optional[int]) -> Dict[str, Any]:
+    """
+    Return extra sampling parameters for an improvement request.
+    
+    Passing a seed asks for a distinct sample and gives the request its own
+    response cache entry, so several candidates can be drawn from one parent.
+    
+    Args:
+        Seed: Optional sampling seed
+    
+    Returns:
+        Dictionary of extra chat completion parameters
+    """
+    return {'seed': Seed} if Seed is not None else {}
 
 
 def ImprovePrompt(
     Prompt: str,
     Accuracy: float,
     ResultsDataFrame: pd.DataFrame,
-    LabelColumn: Optional[str] = None
+    LabelColumn: Optional[str] = None,
+    Seed: Optional[int] = None
 ) -> str:
     """
     Analyze error patterns in model predictions and improve the prompt accordingly.
@@ -21,17 +37,39 @@ def ImprovePrompt(
         Accuracy: The accuracy score achieved (between 0 and 1)
         ResultsDataFrame: DataFrame containing ground truth and predictions
         LabelColumn: Optional name of the label column (if not provided, will look for common names)
+        Seed: Optional sampling seed, used to draw a different improvement
     
     Returns:
         An improved version of the prompt
     """
-    # Initialize Azure OpenAI client
-    Client = AzureOpenAI(
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-    )
+    return RunCoroutine(ImprovePromptAsync(Prompt, Accuracy, ResultsDataFrame, LabelColumn, Seed))
+
+
+async def ImprovePromptAsync(
+    Prompt: str,
+    Accuracy: float,
+    ResultsDataFrame: pd.DataFrame,
+    LabelColumn: Optional[str] = None,
+    Seed: Optional[int] = None,
+    MaxContextTokens: int = DefaultErrorContextTokens
+) -> str:
+    """
+    Async counterpart of ImprovePrompt.
+    
+    Args:
+        Prompt: The original prompt that was used
+        Accuracy: The accuracy score achieved (between 0 and 1)
+        ResultsDataFrame: DataFrame containing ground truth and predictions
+        LabelColumn: Optional name of the label column (if not provided, will look for common names)
+        Seed: Optional sampling seed, used to draw several different improvements
+        MaxContextTokens: Token budget for the misclassified examples in the analysis request
     
+    Returns:
+        An improved version of the prompt, with the same placeholders as Prompt
+    
+    Raises:
+        PromptTemplateError: If the improved prompt cannot be repaired into a valid template
+    """
     # Identify label column if not provided
     if LabelColumn is None:
         PossibleLabelColumns = [col for col in ResultsDataFrame.columns 
@@ -39,14 +77,14 @@ def ImprovePrompt(
         if PossibleLabelColumns:
             LabelColumn = PossibleLabelColumns[0]
         else:
-            # Assume it's any column that's not 'Prediction'
+            # Assume it's any column that's not a result column
             LabelColumn = [col for col in ResultsDataFrame.columns 
-                          if col != 'Prediction'][0]
+                          if col not in ResultColumns][0]
     
-    # Filter incorrect predictions for analysis
-    IncorrectPredictions = ResultsDataFrame[
-        ResultsDataFrame['Prediction'] != ResultsDataFrame[LabelColumn].astype(str)
-    ]
+    # Diverse, deduplicated misclassified examples within the token budget
+    ErrorContext = BuildErrorContext(ResultsDataFrame, LabelColumn, MaxTokens=MaxContextTokens)
+    print(f"Error context: {ErrorContext['ExampleCount']}/{ErrorContext['ErrorCount']} errors shown "
+          f"across {ErrorContext['PairCount']} confusion pairs, ~{ErrorContext['Tokens']} tokens")
     
     # Prepare error analysis prompt
     ErrorAnalysisPrompt = f"""Analyze the following incorrect predictions and identify error patterns:
@@ -56,8 +94,8 @@ Original Prompt Used:
 
 Accuracy Achieved: {Accuracy:.2%}
 
-Sample of Incorrect Predictions (showing up to 20):
-{IncorrectPredictions.head(20).to_string()}
+Misclassified examples ({ErrorContext['ExampleCount']} of {ErrorContext['ErrorCount']}), grouped as true label -> predicted label:
+{ErrorContext['Text']}
 
 Please analyze:
 1. What are the common patterns in the errors?
@@ -68,16 +106,18 @@ Please analyze:
 Provide a concise analysis focusing on actionable insights."""
 
     # Get error pattern analysis
-    ErrorAnalysisResponse = Client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-        messages=[
+    ErrorAnalysisResponse = await CreateChatCompletionAsync(
+        Messages=[
             {"role": "system", "content": "You are an expert in analyzing machine learning errors and improving prompts."},
             {"role": "user", "content": ErrorAnalysisPrompt}
         ],
-        temperature=0.7
+        temperature=0.7,
+        Purpose='Improvement',
+        max_tokens=400,
+        **GetSamplingOptions(Seed)
     )
     
-    ErrorAnalysis = ErrorAnalysisResponse.choices[0].message.content
+    ErrorAnalysis = ErrorAnalysisResponse['Content']
     
     # Prepare prompt improvement request
     ImprovementPrompt = f"""Based on the error analysis below, improve the original prompt to reduce these errors:
@@ -93,7 +133,7 @@ Error Analysis:
 Please provide an improved version of the prompt that:
 1. Addresses the identified error patterns
 2. Provides clearer instructions to reduce misclassifications
-3. Maintains the same variable placeholders as the original
+3. Maintains the same variable placeholders as the original, and uses curly braces for nothing else
 4. Is more specific about edge cases or ambiguous situations
 5. Ensures the model outputs ONLY the label without any additional text or explanations
    - Add explicit instructions like "Output only the label:" or "Return only one word:"
@@ -113,15 +153,17 @@ Please provide an improved version of the prompt that:
 Return ONLY the improved prompt text, without any explanation or additional commentary."""
 
     # Get improved prompt
-    ImprovementResponse = Client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-        messages=[
+    ImprovementResponse = await CreateChatCompletionAsync(
+        Messages=[
             {"role": "system", "content": "You are an expert prompt engineer focused on improving classification accuracy."},
             {"role": "user", "content": ImprovementPrompt}
         ],
-        temperature=0.7
+        temperature=0.7,
+        Purpose='Improvement',
+        **GetSamplingOptions(Seed)
     )
     
-    ImprovedPrompt = ImprovementResponse.choices[0].message.content.strip()
+    ImprovedPrompt = ImprovementResponse['Content'].strip()
     
-    return ImprovedPrompt
\ No newline at end of file
+    # Keep the placeholders of the original so the new prompt renders with the same columns
+    return await RepairPromptAsync(ImprovedPrompt, GetPlaceholders(Prompt))
\ No newline at end of file
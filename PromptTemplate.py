@@ -0,0 +1,346 @@
+import os
+import re
+import string
+import functools
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# How a rendered prompt is laid out in chat messages (see BuildRowMessages)
+PromptLayouts = ('Single', 'Split', 'Reorder')
+DefaultPromptLayout = os.getenv("PROMPT_LAYOUT", "Single")
+
+# Warn when less than this share of a template's static text comes before the first placeholder
+MinPrefixShare = 0.5
+
+# Placeholder tokens: escaped braces, or a named field with optional conversion and format spec
+_TokenPattern = re.compile(r'(\{\{|\}\}|\{[A-Za-z_]\w*(?:![rsa])?(?::[^{}]*)?\})')
+_PlaceholderName = re.compile(r'\{([A-Za-z_]\w*)')
+
+
+class PromptTemplateError(ValueError):
+    """A prompt template cannot be rendered with the available feature columns."""
+
+    def __init__(self, Message: str, Missing: Sequence[str] = (), Unknown: Sequence[str] = ()):
+        super().__init__(Message)
+        self.Missing = list(Missing)
+        self.Unknown = list(Unknown)
+
+
+class CompiledTemplate:
+    """
+    Prompt template parsed once and rendered many times.
+
+    Rendering gives the same text as str.format with keyword arguments,
+    without parsing the template for every row.
+    """
+
+    def __init__(self, Template: str):
+        """
+        Args:
+            Template: Prompt template with {name} placeholders
+
+        Raises:
+            PromptTemplateError: If the braces cannot be parsed or a placeholder is not a plain name
+        """
+        self.Template = Template
+        self.Segments: List[Tuple[str, Optional[str], str, Optional[str]]] = []
+        try:
+            for Literal, FieldName, FormatSpec, Conversion in string.Formatter().parse(Template):
+                if FieldName is not None and not re.fullmatch(r'[A-Za-z_]\w*', FieldName):
+                    raise PromptTemplateError(f"Placeholder {{{FieldName}}} is not a feature name", Unknown=[FieldName])
+                self.Segments.append((Literal, FieldName, FormatSpec or "", Conversion))
+        except ValueError as Error:
+            if isinstance(Error, PromptTemplateError):
+                raise
+            raise PromptTemplateError(f"Prompt template has unbalanced braces: {Error}") from Error
+
+        self.Placeholders = list(dict.fromkeys(Name for _, Name, _, _ in self.Segments if Name is not None))
+        self._Simple = all(not Spec and Conversion is None for _, _, Spec, Conversion in self.Segments)
+
+    def Render(self, Variables: Dict[str, Any]) -> str:
+        """
+        Fill the placeholders with row values.
+
+        Args:
+            Variables: Values by placeholder name
+
+        Returns:
+            The rendered prompt
+        """
+        if self._Simple:
+            return "".join(
+                Literal + (str(Variables[Name]) if Name is not None else "")
+                for Literal, Name, _, _ in self.Segments
+            )
+
+        Parts = []
+        for Literal, Name, Spec, Conversion in self.Segments:
+            Parts.append(Literal)
+            if Name is not None:
+                Value = Variables[Name]
+                if Conversion == 'r':
+                    Value = repr(Value)
+                elif Conversion == 's':
+                    Value = str(Value)
+                elif Conversion == 'a':
+                    Value = ascii(Value)
+                Parts.append(format(Value, Spec))
+        return "".join(Parts)
+
+    def GetStaticParts(self) -> Tuple[str, str]:
+        """
+        Return the literal text before the first placeholder and after the last one.
+
+        Returns:
+            Tuple of (leading text, trailing text); the whole template is leading text without placeholders
+        """
+        Named = [Position for Position, (_, Name, _, _) in enumerate(self.Segments) if Name is not None]
+        if not Named:
+            return "".join(Literal for Literal, _, _, _ in self.Segments), ""
+        Leading = self.Segments[Named[0]][0]
+        Trailing = "".join(Literal for Literal, _, _, _ in self.Segments[Named[-1] + 1:])
+        return Leading, Trailing
+
+    def GetPrefixShare(self) -> float:
+        """Return the share of the template's literal text that comes before the first placeholder."""
+        Static = sum(len(Literal) for Literal, _, _, _ in self.Segments)
+        return len(self.GetStaticParts()[0]) / Static if Static else 1.0
+
+    def Validate(self, FeatureColumns: Sequence[str]) -> None:
+        """
+        Check that the template uses every feature column and nothing else.
+
+        Args:
+            FeatureColumns: Columns that will be passed as variables
+
+        Raises:
+            PromptTemplateError: If a placeholder is unknown or a feature column is never shown
+        """
+        Unknown = [Name for Name in self.Placeholders if Name not in FeatureColumns]
+        Missing = [Column for Column in FeatureColumns if Column not in self.Placeholders]
+        if Unknown or Missing:
+            Problems = []
+            if Missing:
+                Problems.append(f"missing placeholders {['{' + Column + '}' for Column in Missing]}")
+            if Unknown:
+                Problems.append(f"unknown placeholders {['{' + Name + '}' for Name in Unknown]}")
+            raise PromptTemplateError(f"Prompt template has {' and '.join(Problems)}", Missing, Unknown)
+
+
+@functools.lru_cache(maxsize=256)
+def GetCompiledTemplate(Template: str) -> CompiledTemplate:
+    """
+    Return the compiled form of a template, parsing it only on first use.
+
+    Args:
+        Template: Prompt template with {name} placeholders
+
+    Returns:
+        Shared CompiledTemplate
+    """
+    return CompiledTemplate(Template)
+
+
+def GetPlaceholders(Template: str) -> List[str]:
+    """Return the placeholder names a template uses, in order of first appearance."""
+    return GetCompiledTemplate(Template).Placeholders
+
+
+def _EscapeLiteral(Text: str) -> str:
+    return Text.replace('{', '{{').replace('}', '}}')
+
+
+@functools.lru_cache(maxsize=256)
+def GetPromptLayout(Template: str, Layout: str = DefaultPromptLayout) -> Tuple[str, CompiledTemplate]:
+    """
+    Split a template into a static prefix and a per-row template.
+
+    - 'Single': no prefix; the whole prompt is rendered per row
+    - 'Split': the text before the first placeholder is the prefix, the rest is rendered per row
+    - 'Reorder': like 'Split', and the text after the last placeholder (typically
+      instructions and few-shot examples placed after the input) moves into the
+      prefix as well, ahead of the row
+
+    The prefix is identical for every row, so the provider's prompt cache can
+    reuse it.
+
+    Args:
+        Template: Prompt template with {name} placeholders
+        Layout: One of PromptLayouts
+
+    Returns:
+        Tuple of (prefix text, compiled per-row template)
+    """
+    if Layout not in PromptLayouts:
+        raise ValueError(f"Layout must be one of {PromptLayouts}, got {Layout!r}")
+    Compiled = GetCompiledTemplate(Template)
+    if Layout == 'Single' or not Compiled.Placeholders:
+        return "", Compiled
+
+    Leading, Trailing = Compiled.GetStaticParts()
+    Segments = Compiled.Segments
+    Named = [Position for Position, (_, Name, _, _) in enumerate(Segments) if Name is not None]
+    Last = Named[-1] if Layout == 'Reorder' else len(Segments) - 1
+
+    # Rebuild the per-row part as a template source, starting at the first placeholder
+    Parts = []
+    for Position in range(Named[0], Last + 1):
+        Literal, Name, Spec, Conversion = Segments[Position]
+        if Position != Named[0]:
+            Parts.append(_EscapeLiteral(Literal))
+        if Name is not None:
+            Parts.append('{' + Name + ('!' + Conversion if Conversion else '') + (':' + Spec if Spec else '') + '}')
+
+    Prefix = Leading.strip()
+    if Layout == 'Reorder' and Trailing.strip():
+        Prefix = (Prefix + "\n\n" + Trailing.strip()).strip()
+    return Prefix, GetCompiledTemplate("".join(Parts))
+
+
+_WarnedTemplates = set()
+
+
+def CheckPromptLayout(Template: str, Layout: str = DefaultPromptLayout) -> Optional[str]:
+    """
+    Warn once per template when row values come before most of the instructions.
+
+    Such templates leave only a short static prefix, so the provider's prompt
+    cache rarely applies. Only the 'Split' layout is checked: 'Single' has no
+    shared prefix and 'Reorder' already moves trailing instructions ahead of
+    the row.
+
+    Args:
+        Template: Prompt template with {name} placeholders
+        Layout: Layout the template will be sent with
+
+    Returns:
+        The warning text if one applies, else None
+    """
+    Compiled = GetCompiledTemplate(Template)
+    if Layout != 'Split' or not Compiled.Placeholders:
+        return None
+    Share = Compiled.GetPrefixShare()
+    if Share >= MinPrefixShare:
+        return None
+    Warning = (f"Warning: only {Share:.0%} of the prompt's static text precedes the first placeholder, "
+               f"so the shared prefix is short and the prompt cache rarely applies; "
+               f"move instructions and examples before the input or use Layout='Reorder'")
+    if Template not in _WarnedTemplates:
+        _WarnedTemplates.add(Template)
+        print(Warning)
+    return Warning
+
+
+def BuildRowMessages(Template: str, Variables: Dict[str, Any], Layout: str = DefaultPromptLayout) -> List[Dict[str, str]]:
+    """
+    Render one row into chat messages with a cache-friendly static prefix.
+
+    Args:
+        Template: Prompt template with {name} placeholders
+        Variables: Feature values of the row
+        Layout: One of PromptLayouts (see GetPromptLayout)
+
+    Returns:
+        A system message with the static prefix (omitted when empty) and a user message with the row part
+    """
+    Prefix, RowTemplate = GetPromptLayout(Template, Layout)
+    Messages = [{"role": "system", "content": Prefix}] if Prefix else []
+    Messages.append({"role": "user", "content": RowTemplate.Render(Variables)})
+    return Messages
+
+
+def EscapeStrayBraces(Template: str, AllowedNames: Sequence[str]) -> str:
+    """
+    Double every brace that is not part of an allowed placeholder.
+
+    Literal braces such as JSON in few-shot examples, and placeholders for
+    names that are not allowed, become literal text. Braces that are already
+    escaped are left alone.
+
+    Args:
+        Template: Prompt template
+        AllowedNames: Placeholder names to keep
+
+    Returns:
+        Template that renders its literal braces unchanged
+    """
+    Parts = []
+    for Position, Part in enumerate(_TokenPattern.split(Template)):
+        if Position % 2 == 1:
+            if Part in ('{{', '}}'):
+                Parts.append(Part)
+                continue
+            if _PlaceholderName.match(Part).group(1) in AllowedNames:
+                Parts.append(Part)
+                continue
+        Parts.append(Part.replace('{', '{{').replace('}', '}}'))
+    return "".join(Parts)
+
+
+def CompilePrompt(Template: str, FeatureColumns: Sequence[str], EscapeBraces: bool = False) -> CompiledTemplate:
+    """
+    Parse a prompt once and check it against the feature columns before any LLM call.
+
+    Args:
+        Template: Prompt template with {name} placeholders
+        FeatureColumns: Columns that will be passed as variables
+        EscapeBraces: Escape stray braces first instead of rejecting them
+
+    Returns:
+        CompiledTemplate of the (possibly escaped) template
+
+    Raises:
+        PromptTemplateError: If the template cannot be rendered with exactly these columns
+    """
+    if EscapeBraces:
+        Template = EscapeStrayBraces(Template, FeatureColumns)
+    Compiled = GetCompiledTemplate(Template)
+    Compiled.Validate(FeatureColumns)
+    return Compiled
+
+
+async def RepairPromptAsync(Template: str, FeatureColumns: Sequence[str]) -> str:
+    """
+    Make a generated prompt renderable with the feature columns.
+
+    Stray braces are escaped locally. If placeholders are still missing, the
+    model is asked once to put them back; the result is checked again.
+
+    Args:
+        Template: Generated prompt template
+        FeatureColumns: Placeholder names the prompt must use
+
+    Returns:
+        A template that passes CompilePrompt
+
+    Raises:
+        PromptTemplateError: If the prompt still cannot be rendered after the repair request
+    """
+    from OutputGeneration import CreateChatCompletionAsync
+
+    Escaped = EscapeStrayBraces(Template, FeatureColumns)
+    try:
+        CompilePrompt(Escaped, FeatureColumns)
+        return Escaped
+    except PromptTemplateError as Error:
+        Problem = str(Error)
+
+    print(f"Prompt template rejected ({Problem}), requesting a repair")
+    Placeholders = ", ".join('{' + Column + '}' for Column in FeatureColumns)
+    Response = await CreateChatCompletionAsync(
+        Messages=[
+            {"role": "system", "content": "You fix prompt templates. Return only the corrected template."},
+            {"role": "user", "content": f"""The prompt template below is invalid: {Problem}.
+
+Rewrite it so that it contains each of these placeholders exactly where the input should appear: {Placeholders}.
+Keep every other part of the prompt unchanged. Do not use any other text in curly braces.
+
+TEMPLATE:
+{Template}"""}
+        ],
+        temperature=0,
+        Purpose='Improvement'
+    )
+
+    Repaired = EscapeStrayBraces((Response['Content'] or "").strip(), FeatureColumns)
+    CompilePrompt(Repaired, FeatureColumns)
+    return Repaired
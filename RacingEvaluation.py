@@ -0,0 +1,216 @@
+import math
+import numpy as np
+import pandas as pd
+from ClientRegistry import RunCoroutine
+from PromptEvaluation import EvaluatePromptAsync, DefaultMaxConcurrency
+from PromptTemplate import DefaultPromptLayout
+from Telemetry import SummarizeUsage, TrackUsage
+from typing import Dict, List, Optional, Tuple
+
+
+def GetStratifiedOrder(DataFrame: pd.DataFrame, LabelColumn: str, RandomState: Optional[int] = None) -> np.ndarray:
+    """
+    Return row positions in a random order that keeps label proportions in every prefix.
+
+    Each label's rows are shuffled and spread evenly over the sequence, so the
+    first n rows are close to a stratified sample of size n.
+
+    Args:
+        DataFrame: The dataframe to order
+        LabelColumn: The column name containing true labels
+        RandomState: Optional seed for reproducible orders
+
+    Returns:
+        Array of row positions
+    """
+    Generator = np.random.default_rng(RandomState)
+    Labels = DataFrame[LabelColumn].astype(str).to_numpy()
+    SortKeys = np.empty(len(Labels))
+    for Label in np.unique(Labels):
+        Positions = np.flatnonzero(Labels == Label)
+        Generator.shuffle(Positions)
+        # Rank within the label, jittered and scaled to [0, 1)
+        SortKeys[Positions] = (np.arange(len(Positions)) + Generator.random(len(Positions))) / len(Positions)
+    return np.argsort(SortKeys, kind='stable')
+
+
+def GetAccuracyBounds(CorrectCount: int, EvaluatedCount: int, TotalCount: int,
+                      Delta: float) -> Tuple[float, float]:
+    """
+    Bound the full-set accuracy from the rows evaluated so far.
+
+    Uses the Hoeffding-Serfling bound for sampling without replacement on the
+    unevaluated remainder; evaluated rows contribute their exact outcome.
+
+    Args:
+        CorrectCount: Correct predictions among evaluated rows
+        EvaluatedCount: Rows evaluated so far
+        TotalCount: Rows in the full dataset
+        Delta: Allowed failure probability for this bound
+
+    Returns:
+        Tuple of (lower, upper) bounds on full-set accuracy
+    """
+    Remaining = TotalCount - EvaluatedCount
+    if EvaluatedCount == 0:
+        return 0.0, 1.0
+    if Remaining == 0:
+        Accuracy = CorrectCount / TotalCount
+        return Accuracy, Accuracy
+
+    SampleAccuracy = CorrectCount / EvaluatedCount
+    Margin = math.sqrt((1 - (EvaluatedCount - 1) / TotalCount) * math.log(2 / Delta) / (2 * EvaluatedCount))
+    Lower = (CorrectCount + Remaining * max(0.0, SampleAccuracy - Margin)) / TotalCount
+    Upper = (CorrectCount + Remaining * min(1.0, SampleAccuracy + Margin)) / TotalCount
+    return Lower, Upper
+
+
+async def EvaluatePromptRacingAsync(
+    Prompt: str,
+    DataFrame: pd.DataFrame,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    TargetAccuracy: float,
+    Confidence: float = 0.95,
+    BatchSize: int = 50,
+    MinSamples: int = 100,
+    MaxConcurrency: int = DefaultMaxConcurrency,
+    RandomState: Optional[int] = None,
+    ConstrainedOutput: bool = False,
+    Layout: str = DefaultPromptLayout
+) -> Tuple[float, pd.DataFrame]:
+    """
+    Evaluate a prompt in stratified batches, stopping once it clearly loses against a target.
+
+    After each batch the full-set accuracy is bounded; evaluation stops when
+    the upper bound cannot exceed TargetAccuracy (the candidate is worse).
+    A candidate that looks better is always evaluated in full, so the
+    accuracy it is promoted with is never a sample estimate. The confidence
+    is split across all planned checks.
+
+    Args:
+        Prompt: The prompt template with placeholders for features
+        DataFrame: The dataframe to evaluate on
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        TargetAccuracy: Accuracy the candidate has to beat (usually BestAccuracy)
+        Confidence: Probability that an early decision is correct
+        BatchSize: Rows evaluated between checks
+        MinSamples: Rows evaluated before any early decision
+        MaxConcurrency: Maximum number of concurrent requests
+        RandomState: Optional seed for the evaluation order
+        ConstrainedOutput: Request label-only answers with logprobs and score their confidence
+        Layout: Message layout, one of 'Single', 'Split' or 'Reorder'
+
+    Returns:
+        Tuple containing:
+        - Accuracy on the evaluated rows (an upper-bounded estimate if stopped early as worse)
+        - DataFrame of the evaluated rows with 'Prediction' and 'ExtractedLabel' columns;
+          attrs hold 'IsPartial', 'Decision', 'EvaluatedRows', 'TotalRows', 'AccuracyBounds'
+          and the token usage of the evaluated batches
+    """
+    TotalCount = len(DataFrame)
+    UniqueLabels = [str(Label) for Label in DataFrame[LabelColumn].unique()]
+    Order = GetStratifiedOrder(DataFrame, LabelColumn, RandomState)
+    PlannedChecks = max(1, math.ceil(TotalCount / BatchSize))
+    Delta = (1 - Confidence) / PlannedChecks
+
+    ResultFrames = []
+    EvaluatedPositions = []
+    CorrectCount = 0
+    Decision = 'Complete'
+    Bounds = (0.0, 1.0)
+
+    with TrackUsage() as Usage:
+        for Start in range(0, TotalCount, BatchSize):
+            Positions = Order[Start:Start + BatchSize]
+            _, BatchResults = await EvaluatePromptAsync(
+                Prompt, DataFrame.iloc[Positions], FeatureColumns, LabelColumn, MaxConcurrency, UniqueLabels,
+                ConstrainedOutput=ConstrainedOutput, Layout=Layout
+            )
+            ResultFrames.append(BatchResults)
+            EvaluatedPositions.extend(Positions.tolist())
+            CorrectCount += int((BatchResults['ExtractedLabel'] == BatchResults[LabelColumn].astype(str)).sum())
+
+            EvaluatedCount = len(EvaluatedPositions)
+            Bounds = GetAccuracyBounds(CorrectCount, EvaluatedCount, TotalCount, Delta)
+            if EvaluatedCount >= TotalCount or EvaluatedCount < MinSamples:
+                continue
+            if Bounds[1] <= TargetAccuracy:
+                Decision = 'Worse'
+                break
+
+    # Restore the original row order of the evaluated subset
+    ResultDataFrame = pd.concat(ResultFrames)
+    ResultDataFrame = ResultDataFrame.iloc[np.argsort(EvaluatedPositions, kind='stable')]
+
+    EvaluatedCount = len(ResultDataFrame)
+    Accuracy = CorrectCount / EvaluatedCount
+    ResultDataFrame.attrs.update({
+        'IsPartial': EvaluatedCount < TotalCount,
+        'Decision': Decision,
+        'EvaluatedRows': EvaluatedCount,
+        'TotalRows': TotalCount,
+        'AccuracyBounds': Bounds,
+        **SummarizeUsage(Usage)
+    })
+
+    return Accuracy, ResultDataFrame
+
+
+def EvaluatePromptRacing(
+    Prompt: str,
+    DataFrame: pd.DataFrame,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    TargetAccuracy: float,
+    Confidence: float = 0.95,
+    BatchSize: int = 50,
+    MinSamples: int = 100,
+    MaxConcurrency: int = DefaultMaxConcurrency,
+    RandomState: Optional[int] = None,
+    ConstrainedOutput: bool = False,
+    Layout: str = DefaultPromptLayout
+) -> Tuple[float, pd.DataFrame]:
+    """
+    Synchronous wrapper around EvaluatePromptRacingAsync.
+
+    Args:
+        Prompt: The prompt template with placeholders for features
+        DataFrame: The dataframe to evaluate on
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        TargetAccuracy: Accuracy the candidate has to beat (usually BestAccuracy)
+        Confidence: Probability that an early decision is correct
+        BatchSize: Rows evaluated between checks
+        MinSamples: Rows evaluated before any early decision
+        MaxConcurrency: Maximum number of concurrent requests
+        RandomState: Optional seed for the evaluation order
+        ConstrainedOutput: Request label-only answers with logprobs and score their confidence
+        Layout: Message layout, one of 'Single', 'Split' or 'Reorder'
+
+    Returns:
+        Tuple of accuracy and the (possibly partial) result dataframe
+    """
+    return RunCoroutine(EvaluatePromptRacingAsync(
+        Prompt, DataFrame, FeatureColumns, LabelColumn, TargetAccuracy,
+        Confidence, BatchSize, MinSamples, MaxConcurrency, RandomState, ConstrainedOutput, Layout
+    ))
+
+
+def DescribeRacingResult(ResultDataFrame: pd.DataFrame) -> Dict[str, object]:
+    """
+    Return the racing metadata of a result dataframe.
+
+    Args:
+        ResultDataFrame: Result of EvaluatePromptRacing or EvaluatePrompt
+
+    Returns:
+        Dictionary with 'IsPartial', 'Decision', 'EvaluatedRows' and 'TotalRows'
+    """
+    return {
+        'IsPartial': ResultDataFrame.attrs.get('IsPartial', False),
+        'Decision': ResultDataFrame.attrs.get('Decision', 'Complete'),
+        'EvaluatedRows': ResultDataFrame.attrs.get('EvaluatedRows', len(ResultDataFrame)),
+        'TotalRows': ResultDataFrame.attrs.get('TotalRows', len(ResultDataFrame))
+    }
@@ -0,0 +1,96 @@
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+
+class HedgePolicy:
+    """
+    Decides when a slow request gets a duplicate and limits how many duplicates are sent.
+
+    The hedge delay is a percentile of recent request service times (queueing
+    for slots and quota excluded), so it follows
+    the deployment as it speeds up or slows down. Hedges are only allowed
+    while they stay below MaxExtraRate of all calls, which bounds the extra
+    spend. Time saved by a winning hedge is estimated from the recent
+    latencies longer than the time the primary had already run.
+    """
+
+    def __init__(self, Percentile: float = 0.95, MaxExtraRate: float = 0.05, MinDelay: float = 0.05,
+                 WindowSize: int = 500, MinSamples: int = 50, UseOtherBackend: bool = True):
+        """
+        Args:
+            Percentile: Latency percentile after which a request is hedged
+            MaxExtraRate: Maximum hedges as a fraction of calls
+            MinDelay: Lower bound for the hedge delay in seconds
+            WindowSize: Recent latencies kept for the percentile
+            MinSamples: Latencies observed before hedging starts
+            UseOtherBackend: Send the duplicate to another backend of the pool when there is one
+        """
+        if not 0 < Percentile < 1:
+            raise ValueError(f"Percentile must be between 0 and 1, got {Percentile}")
+        self.Percentile = Percentile
+        self.MaxExtraRate = MaxExtraRate
+        self.MinDelay = MinDelay
+        self.MinSamples = MinSamples
+        self.UseOtherBackend = UseOtherBackend
+        self.Latencies: deque = deque(maxlen=WindowSize)
+        self.Stats = {'Calls': 0, 'Hedges': 0, 'HedgeWins': 0, 'SkippedByRate': 0, 'SavedSeconds': 0.0}
+        self._Lock = threading.Lock()
+
+    def RecordLatency(self, Latency: float) -> None:
+        """Add the service time of a completed request (without queueing) to the window."""
+        with self._Lock:
+            self.Stats['Calls'] += 1
+            self.Latencies.append(Latency)
+
+    def GetDelay(self) -> Optional[float]:
+        """Return seconds to wait before hedging, or None while too few latencies are known."""
+        with self._Lock:
+            if len(self.Latencies) < self.MinSamples:
+                return None
+            Ordered = sorted(self.Latencies)
+        Index = min(len(Ordered) - 1, int(self.Percentile * len(Ordered)))
+        return max(self.MinDelay, Ordered[Index])
+
+    def TryAcquire(self) -> bool:
+        """Reserve one hedge if the extra request rate allows it."""
+        with self._Lock:
+            if self.Stats['Hedges'] + 1 > self.MaxExtraRate * max(self.Stats['Calls'], self.MinSamples):
+                self.Stats['SkippedByRate'] += 1
+                return False
+            self.Stats['Hedges'] += 1
+            return True
+
+    def EstimateSaving(self, Elapsed: float) -> float:
+        """
+        Estimate how much longer the primary would have run when a hedge wins.
+
+        Args:
+            Elapsed: Seconds the primary had run when the hedge answered
+
+        Returns:
+            Mean remaining time of recent calls slower than Elapsed (0 if none were)
+        """
+        with self._Lock:
+            Slower = [Latency for Latency in self.Latencies if Latency > Elapsed]
+        return sum(Slower) / len(Slower) - Elapsed if Slower else 0.0
+
+    def RecordWin(self, Saved: float) -> None:
+        """Count a hedge that answered before the primary."""
+        with self._Lock:
+            self.Stats['HedgeWins'] += 1
+            self.Stats['SavedSeconds'] += Saved
+
+    def GetStats(self) -> Dict[str, Any]:
+        """
+        Return hedging counters.
+
+        Returns:
+            Dictionary with Calls, Hedges, HedgeRate, HedgeWins, SkippedByRate,
+            SavedSeconds and the current Delay
+        """
+        with self._Lock:
+            Stats = dict(self.Stats)
+        Stats['HedgeRate'] = Stats['Hedges'] / Stats['Calls'] if Stats['Calls'] else 0.0
+        Stats['Delay'] = self.GetDelay()
+        return Stats
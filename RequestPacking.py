@@ -0,0 +1,73 @@
+import re
+import json
+from LabelExtraction import GetLabelExtractor
+from typing import Any, Dict, List, Optional
+
+
+def BuildPackedMessages(Prompt: str, RowVariables: List[Dict[str, Any]], UniqueLabels: List[str]) -> List[Dict[str, str]]:
+    """
+    Build one chat request that classifies several rows.
+
+    The instruction block is sent once as a system message that is identical
+    for every pack; the rows go into the user message as a JSON array.
+
+    Args:
+        Prompt: The prompt template with placeholders for features
+        RowVariables: Feature values of each row in the pack
+        UniqueLabels: Valid labels
+
+    Returns:
+        Chat messages for the packed request
+    """
+    SystemMessage = f"""You will classify several items in one response. Apply the instructions below to each item independently. Placeholders in braces, such as {{text}}, refer to the item field with the same name.
+
+INSTRUCTIONS:
+{Prompt}
+
+Return ONLY a JSON array with exactly one object per input item, in the same order as the input, each of the form {{"id": <item id>, "label": <label>}}. Each label must be exactly one of: {json.dumps(UniqueLabels, ensure_ascii=False)}."""
+
+    Items = [{'id': Position, **Variables} for Position, Variables in enumerate(RowVariables)]
+    return [
+        {"role": "system", "content": SystemMessage},
+        {"role": "user", "content": json.dumps(Items, ensure_ascii=False, default=str)}
+    ]
+
+
+def ParsePackedResponse(Content: Optional[str], RowCount: int, UniqueLabels: List[str]) -> Optional[List[str]]:
+    """
+    Parse the JSON array returned for a packed request and validate it per row.
+
+    Args:
+        Content: Raw model output
+        RowCount: Number of rows in the pack
+        UniqueLabels: Valid labels
+
+    Returns:
+        One label per row ('' where the row's entry is not a valid label),
+        or None if the array is malformed or has the wrong length
+    """
+    if not Content:
+        return None
+
+    # Tolerate code fences or text around the array
+    Match = re.search(r'\[.*\]', Content, re.DOTALL)
+    if Match is None:
+        return None
+    try:
+        Entries = json.loads(Match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(Entries, list) or len(Entries) != RowCount:
+        return None
+
+    # Honor ids when every entry has a distinct, in-range one; otherwise rely on order
+    Ids = [Entry.get('id') if isinstance(Entry, dict) else None for Entry in Entries]
+    if sorted(Id for Id in Ids if isinstance(Id, int)) == list(range(RowCount)):
+        Entries = [Entries[Ids.index(Position)] for Position in range(RowCount)]
+
+    Extractor = GetLabelExtractor(UniqueLabels)
+    Labels = []
+    for Entry in Entries:
+        RawLabel = Entry.get('label') if isinstance(Entry, dict) else Entry
+        Labels.append(Extractor.ExtractLabel(str(RawLabel)) if RawLabel is not None else "")
+    return Labels
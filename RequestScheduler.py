@@ -0,0 +1,337 @@
+import time
+import random
+import asyncio
+import threading
+import email.utils
+import openai
+from ClientRegistry import GetClientConfig
+from Telemetry import GetCurrentJob
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# HTTP status codes worth retrying
+RetryableStatusCodes = {408, 409, 429, 500, 502, 503, 504}
+
+# Completion tokens assumed for requests that do not set max_tokens
+DefaultCompletionTokens = 256
+
+
+def EstimateTokens(Messages: List[Dict[str, Any]], MaxTokens: Optional[int] = None) -> int:
+    """
+    Estimate the tokens a chat request will be charged against the quota.
+
+    Uses roughly four characters per token plus a small per-message overhead,
+    and adds the completion allowance (max_tokens) as Azure does.
+
+    Args:
+        Messages: Chat messages to send
+        MaxTokens: Requested max_tokens, if any
+
+    Returns:
+        Estimated prompt plus completion tokens
+    """
+    PromptTokens = sum(len(str(Message.get("content", ""))) // 4 + 4 for Message in Messages) + 3
+    return PromptTokens + (MaxTokens if MaxTokens is not None else DefaultCompletionTokens)
+
+
+def GetRetryAfter(Error: Exception) -> Optional[float]:
+    """
+    Read the server-suggested wait from Retry-After headers of an API error.
+
+    Args:
+        Error: Exception raised by the OpenAI client
+
+    Returns:
+        Seconds to wait, or None if the response carried no hint
+    """
+    Response = getattr(Error, "response", None)
+    if Response is None:
+        return None
+    Headers = Response.headers
+
+    RetryAfterMs = Headers.get("retry-after-ms")
+    if RetryAfterMs:
+        try:
+            return float(RetryAfterMs) / 1000
+        except ValueError:
+            pass
+
+    RetryAfter = Headers.get("retry-after")
+    if RetryAfter:
+        try:
+            return float(RetryAfter)
+        except ValueError:
+            RetryDate = email.utils.parsedate_to_datetime(RetryAfter)
+            if RetryDate is not None:
+                return max(0.0, RetryDate.timestamp() - time.time())
+    return None
+
+
+def IsRetryable(Error: Exception) -> bool:
+    """Return whether an API error is transient and the request should be retried."""
+    if isinstance(Error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(Error, openai.APIStatusError):
+        return Error.status_code in RetryableStatusCodes
+    return False
+
+
+class TokenBucket:
+    """
+    Token bucket that refills continuously up to its capacity.
+
+    Acquiring reserves tokens immediately and sleeps off any deficit, so
+    waiters are served in arrival order and a request larger than the
+    capacity still goes through once the bucket has paid it back.
+    """
+
+    def __init__(self, Capacity: float, RefillPerSecond: float):
+        """
+        Args:
+            Capacity: Maximum number of tokens held
+            RefillPerSecond: Tokens added per second
+        """
+        self.Capacity = Capacity
+        self.RefillPerSecond = RefillPerSecond
+        self.Tokens = Capacity
+        self.UpdatedAt = time.monotonic()
+
+    def _Refill(self) -> None:
+        Now = time.monotonic()
+        self.Tokens = min(self.Capacity, self.Tokens + (Now - self.UpdatedAt) * self.RefillPerSecond)
+        self.UpdatedAt = Now
+
+    async def Acquire(self, Amount: float) -> None:
+        """Take Amount tokens, waiting until the bucket has refilled enough."""
+        self._Refill()
+        self.Tokens -= Amount
+        if self.Tokens < 0:
+            await asyncio.sleep(-self.Tokens / self.RefillPerSecond)
+
+    def GetAvailable(self) -> float:
+        """Return the tokens currently available (negative while waiters pay off a deficit)."""
+        self._Refill()
+        return self.Tokens
+
+    def Refund(self, Amount: float) -> None:
+        """Return unused tokens, e.g. when actual usage was below the estimate."""
+        self._Refill()
+        self.Tokens = min(self.Capacity, self.Tokens + Amount)
+
+
+class RequestScheduler:
+    """
+    Central gate for LLM requests that respects the deployment's RPM/TPM quota.
+
+    Each request waits for request and token budgets before it is sent,
+    retries transient failures with jittered exponential backoff and honors
+    Retry-After headers. A 429 pauses every caller until the suggested time
+    and halves the number of requests allowed in flight; the limit grows
+    back by one after each window of successful requests.
+
+    Requests from concurrent jobs (see Telemetry.UseJob) take in-flight slots
+    in weighted fair-share order: a free slot goes to the waiting job with the
+    least service relative to its priority, so a job that queues thousands of
+    requests cannot crowd out the others, and capacity an idle job leaves
+    unused goes to the rest. Slots are taken before the quota budgets so the
+    budgets are drawn in the same fair order.
+    """
+
+    def __init__(self, RequestsPerMinute: Optional[float] = None, TokensPerMinute: Optional[float] = None,
+                 MaxRetries: int = 6, BaseDelay: float = 1.0, MaxDelay: float = 60.0,
+                 MaxConcurrency: int = 64):
+        """
+        Args:
+            RequestsPerMinute: Request quota, or None for no request budget
+            TokensPerMinute: Token quota, or None for no token budget
+            MaxRetries: Retries per request before the error is raised
+            BaseDelay: Initial backoff delay in seconds
+            MaxDelay: Maximum backoff delay in seconds
+            MaxConcurrency: Upper bound for requests in flight
+        """
+        self.RequestBucket = TokenBucket(RequestsPerMinute, RequestsPerMinute / 60) if RequestsPerMinute else None
+        self.TokenBucket = TokenBucket(TokensPerMinute, TokensPerMinute / 60) if TokensPerMinute else None
+        self.MaxRetries = MaxRetries
+        self.BaseDelay = BaseDelay
+        self.MaxDelay = MaxDelay
+        self.MaxConcurrency = MaxConcurrency
+        self.ConcurrencyLimit = MaxConcurrency
+        self.InFlight = 0
+        self.PausedUntil = 0.0
+        self.Stats = {'Requests': 0, 'Retries': 0, 'Throttled': 0, 'Failures': 0}
+        self.JobStats: Dict[Optional[str], Dict[str, float]] = {}
+        self._SuccessesSinceIncrease = 0
+        # Fair-share state: waiting requests and virtual service time per job
+        self._Waiting: Dict[Optional[str], int] = {}
+        self._VirtualTime: Dict[Optional[str], float] = {}
+        self._VirtualClock = 0.0
+        self._Condition: Optional[asyncio.Condition] = None
+
+    def _GetCondition(self) -> asyncio.Condition:
+        if self._Condition is None:
+            self._Condition = asyncio.Condition()
+        return self._Condition
+
+    def GetBackoffDelay(self, Attempt: int) -> float:
+        """Return a full-jitter exponential backoff delay for the given attempt."""
+        return random.uniform(0, min(self.MaxDelay, self.BaseDelay * 2 ** Attempt))
+
+    def IsThrottled(self) -> bool:
+        """Return whether callers are currently held back by a 429 pause."""
+        return time.monotonic() < self.PausedUntil
+
+    def HasFreeSlot(self) -> bool:
+        """Return whether a new request would be sent right away instead of queueing for a slot."""
+        return not self.IsThrottled() and self.InFlight < self.ConcurrencyLimit and not self._Waiting
+
+    def _IsTurn(self, Job: Optional[str]) -> bool:
+        if self.InFlight >= self.ConcurrencyLimit:
+            return False
+        return min(self._Waiting, key=self._VirtualTime.__getitem__) == Job
+
+    async def _EnterSlot(self, Job: Optional[str] = None, Priority: float = 1.0) -> None:
+        Condition = self._GetCondition()
+        async with Condition:
+            if not self._Waiting.get(Job):
+                # A job becoming active starts at the current virtual time instead of cashing in idle time
+                self._VirtualTime[Job] = max(self._VirtualTime.get(Job, 0.0), self._VirtualClock)
+            self._Waiting[Job] = self._Waiting.get(Job, 0) + 1
+            WaitStart = time.monotonic()
+            Granted = False
+            try:
+                await Condition.wait_for(lambda: self._IsTurn(Job))
+                Granted = True
+            finally:
+                self._Waiting[Job] -= 1
+                if not self._Waiting[Job]:
+                    del self._Waiting[Job]
+                if Granted:
+                    self.InFlight += 1
+                    self._VirtualClock = self._VirtualTime[Job]
+                    self._VirtualTime[Job] += 1 / Priority
+                    Stats = self.JobStats.setdefault(Job, {'Requests': 0, 'WaitSeconds': 0.0})
+                    Stats['Requests'] += 1
+                    Stats['WaitSeconds'] += time.monotonic() - WaitStart
+                # The next turn may belong to a waiter of another job
+                Condition.notify_all()
+
+    async def _LeaveSlot(self, Throttled: bool) -> None:
+        Condition = self._GetCondition()
+        async with Condition:
+            self.InFlight -= 1
+            if Throttled:
+                self.ConcurrencyLimit = max(1, self.ConcurrencyLimit // 2)
+                self._SuccessesSinceIncrease = 0
+            else:
+                self._SuccessesSinceIncrease += 1
+                if self._SuccessesSinceIncrease >= self.ConcurrencyLimit and self.ConcurrencyLimit < self.MaxConcurrency:
+                    self.ConcurrencyLimit += 1
+                    self._SuccessesSinceIncrease = 0
+            Condition.notify_all()
+
+    async def Execute(self, RequestFunction: Callable[[], Awaitable[T]], EstimatedTokens: int = 0,
+                      CallStats: Optional[Dict[str, Any]] = None) -> T:
+        """
+        Send a request through the quota budgets, retrying transient failures.
+
+        Args:
+            RequestFunction: Zero-argument coroutine function performing the request
+            EstimatedTokens: Tokens the request is expected to consume
+            CallStats: Optional dictionary that receives 'Attempts', 'Throttled',
+                'AttemptSeconds' (duration of the last attempt) and 'AttemptStarted'
+                (time.monotonic() when the current attempt was sent, None while queued)
+
+        Returns:
+            The result of RequestFunction
+        """
+        if CallStats is None:
+            CallStats = {}
+        CallStats.update({'Attempts': 0, 'Throttled': 0, 'AttemptSeconds': 0.0, 'AttemptStarted': None})
+        Job, Priority = GetCurrentJob()
+
+        for Attempt in range(self.MaxRetries + 1):
+            # Wait out any server-imposed pause shared by all callers
+            while self.IsThrottled():
+                await asyncio.sleep(self.PausedUntil - time.monotonic())
+
+            await self._EnterSlot(Job, Priority)
+            Throttled = False
+            AttemptStart = time.monotonic()
+            try:
+                if self.RequestBucket is not None:
+                    await self.RequestBucket.Acquire(1)
+                if self.TokenBucket is not None:
+                    await self.TokenBucket.Acquire(EstimatedTokens)
+                AttemptStart = CallStats['AttemptStarted'] = time.monotonic()
+                self.Stats['Requests'] += 1
+                CallStats['Attempts'] += 1
+                Result = await RequestFunction()
+            except Exception as Error:
+                CallStats['AttemptSeconds'] = time.monotonic() - AttemptStart
+                Throttled = isinstance(Error, openai.RateLimitError)
+                if not IsRetryable(Error) or Attempt == self.MaxRetries:
+                    self.Stats['Failures'] += 1
+                    raise
+
+                Delay = GetRetryAfter(Error)
+                if Delay is None:
+                    Delay = self.GetBackoffDelay(Attempt)
+                if Throttled:
+                    self.Stats['Throttled'] += 1
+                    CallStats['Throttled'] += 1
+                    self.PausedUntil = max(self.PausedUntil, time.monotonic() + Delay)
+                self.Stats['Retries'] += 1
+            else:
+                CallStats['AttemptSeconds'] = time.monotonic() - AttemptStart
+                # Give back the part of the token estimate that was not used
+                Usage = getattr(Result, "usage", None)
+                if self.TokenBucket is not None and Usage is not None and Usage.total_tokens < EstimatedTokens:
+                    self.TokenBucket.Refund(EstimatedTokens - Usage.total_tokens)
+                return Result
+            finally:
+                CallStats['AttemptStarted'] = None
+                await self._LeaveSlot(Throttled)
+
+            await asyncio.sleep(Delay)
+
+
+_Schedulers: Dict[asyncio.AbstractEventLoop, RequestScheduler] = {}
+_SchedulerLock = threading.Lock()
+
+
+def GetRequestScheduler() -> RequestScheduler:
+    """
+    Return the shared request scheduler for the running event loop.
+
+    Quota settings come from the client configuration
+    (AZURE_OPENAI_REQUESTS_PER_MINUTE, AZURE_OPENAI_TOKENS_PER_MINUTE, ...).
+
+    Returns:
+        The RequestScheduler for the current event loop
+    """
+    Loop = asyncio.get_running_loop()
+    with _SchedulerLock:
+        Scheduler = _Schedulers.get(Loop)
+        if Scheduler is None:
+            Config = GetClientConfig()
+            Scheduler = RequestScheduler(
+                RequestsPerMinute=Config['RequestsPerMinute'],
+                TokensPerMinute=Config['TokensPerMinute'],
+                MaxRetries=Config['SchedulerMaxRetries'],
+                MaxConcurrency=Config['SchedulerMaxConcurrency']
+            )
+            _Schedulers[Loop] = Scheduler
+        return Scheduler
+
+
+def GetRequestSchedulers() -> List[RequestScheduler]:
+    """Return the shared schedulers created so far, one per event loop."""
+    with _SchedulerLock:
+        return list(_Schedulers.values())
+
+
+def ResetRequestSchedulers() -> None:
+    """Drop the shared schedulers so the next request picks up new configuration."""
+    with _SchedulerLock:
+        _Schedulers.clear()
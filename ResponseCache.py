@@ -0,0 +1,257 @@
+import os
+import json
+import atexit
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from typing import Any, Dict, List, Optional
+
+load_dotenv()
+
+
+class ResponseCache:
+    """
+    Disk-backed cache of LLM responses with LRU eviction.
+
+    Entries are keyed by deployment, messages and sampling parameters and
+    stored in SQLite, so identical requests are served locally across
+    iterations and across runs. Least recently used entries are evicted once
+    the cache exceeds MaxEntries or MaxBytes; entries older than TimeToLive
+    seconds are treated as misses and removed.
+
+    Lookups only read the database: access times of hits are kept in memory
+    and written in one batch every TouchFlushInterval hits and before
+    eviction. GetAsync and SetAsync run the SQLite work on a dedicated
+    thread so cache I/O never blocks the event loop.
+    """
+
+    # Evict at most once per this many writes to keep inserts cheap
+    EvictionInterval = 100
+
+    # Hits whose access times are buffered before they are written in one transaction
+    TouchFlushInterval = 500
+
+    def __init__(self, Path: str, MaxEntries: int = 100000, MaxBytes: Optional[int] = None,
+                 TimeToLive: Optional[float] = None):
+        """
+        Open (or create) a response cache.
+
+        Args:
+            Path: SQLite database file path
+            MaxEntries: Maximum number of cached responses
+            MaxBytes: Optional maximum total payload size in bytes
+            TimeToLive: Optional entry lifetime in seconds
+        """
+        Directory = os.path.dirname(Path)
+        if Directory:
+            os.makedirs(Directory, exist_ok=True)
+
+        self.Path = Path
+        self.MaxEntries = MaxEntries
+        self.MaxBytes = MaxBytes
+        self.TimeToLive = TimeToLive
+        self.Hits = 0
+        self.Misses = 0
+        self._WritesSinceEviction = 0
+        self._PendingTouches: Dict[str, float] = {}
+        self._Lock = threading.Lock()
+        self._Executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ResponseCache")
+        self._Connection = sqlite3.connect(Path, timeout=30, check_same_thread=False)
+        self._Connection.execute("PRAGMA journal_mode=WAL")
+        self._Connection.execute(
+            """CREATE TABLE IF NOT EXISTS Responses (
+                Key TEXT PRIMARY KEY,
+                Payload TEXT NOT NULL,
+                Size INTEGER NOT NULL,
+                CreatedAt REAL NOT NULL,
+                LastAccessed REAL NOT NULL
+            )"""
+        )
+        self._Connection.execute("CREATE INDEX IF NOT EXISTS ResponsesLastAccessed ON Responses (LastAccessed)")
+        self._Connection.commit()
+
+    @staticmethod
+    def MakeKey(Deployment: str, Messages: List[Dict[str, Any]], Parameters: Dict[str, Any]) -> str:
+        """
+        Build the cache key for a chat completion request.
+
+        Args:
+            Deployment: Deployment (model) name
+            Messages: Chat messages sent to the model
+            Parameters: Sampling parameters such as temperature and max_tokens
+
+        Returns:
+            Hex digest identifying the request
+        """
+        Serialized = json.dumps([Deployment, Messages, Parameters], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(Serialized.encode("utf-8")).hexdigest()
+
+    def Get(self, Key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached response and mark it as recently used.
+
+        Args:
+            Key: Cache key from MakeKey
+
+        Returns:
+            The cached payload, or None on a miss
+        """
+        Now = time.time()
+        with self._Lock:
+            Row = self._Connection.execute(
+                "SELECT Payload, CreatedAt FROM Responses WHERE Key = ?", (Key,)
+            ).fetchone()
+
+            # Expired entries are removed by the next eviction
+            if Row is None or (self.TimeToLive is not None and Now - Row[1] > self.TimeToLive):
+                self.Misses += 1
+                return None
+
+            self.Hits += 1
+            self._PendingTouches[Key] = Now
+            if len(self._PendingTouches) >= self.TouchFlushInterval:
+                self._FlushTouches()
+
+        return json.loads(Row[0])
+
+    async def GetAsync(self, Key: str) -> Optional[Dict[str, Any]]:
+        """Run Get on the cache thread without blocking the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self._Executor, self.Get, Key)
+
+    def _FlushTouches(self) -> None:
+        # Write buffered access times in one transaction; the caller holds the lock
+        if not self._PendingTouches:
+            return
+        self._Connection.executemany(
+            "UPDATE Responses SET LastAccessed = ? WHERE Key = ?",
+            [(Accessed, Key) for Key, Accessed in self._PendingTouches.items()]
+        )
+        self._Connection.commit()
+        self._PendingTouches.clear()
+
+    def Set(self, Key: str, Payload: Dict[str, Any]) -> None:
+        """
+        Store a response payload.
+
+        Args:
+            Key: Cache key from MakeKey
+            Payload: JSON-serializable response payload
+        """
+        Serialized = json.dumps(Payload, ensure_ascii=False)
+        Now = time.time()
+        with self._Lock:
+            self._Connection.execute(
+                "INSERT OR REPLACE INTO Responses (Key, Payload, Size, CreatedAt, LastAccessed) VALUES (?, ?, ?, ?, ?)",
+                (Key, Serialized, len(Serialized.encode("utf-8")), Now, Now)
+            )
+            self._Connection.commit()
+            self._WritesSinceEviction += 1
+            if self._WritesSinceEviction >= self.EvictionInterval:
+                self._Evict()
+
+    async def SetAsync(self, Key: str, Payload: Dict[str, Any]) -> None:
+        """Run Set on the cache thread without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(self._Executor, self.Set, Key, Payload)
+
+    def Flush(self) -> None:
+        """Write buffered access times of recent hits."""
+        with self._Lock:
+            self._FlushTouches()
+
+    def Evict(self) -> None:
+        """Remove expired entries, then least recently used entries until within size limits."""
+        with self._Lock:
+            self._Evict()
+
+    def _Evict(self) -> None:
+        self._WritesSinceEviction = 0
+        self._FlushTouches()
+
+        if self.TimeToLive is not None:
+            self._Connection.execute("DELETE FROM Responses WHERE CreatedAt < ?", (time.time() - self.TimeToLive,))
+
+        Count = self._Connection.execute("SELECT COUNT(*) FROM Responses").fetchone()[0]
+        if Count > self.MaxEntries:
+            self._Connection.execute(
+                "DELETE FROM Responses WHERE Key IN (SELECT Key FROM Responses ORDER BY LastAccessed LIMIT ?)",
+                (Count - self.MaxEntries,)
+            )
+
+        if self.MaxBytes is not None:
+            # Walk entries from most to least recently used and drop everything past the byte budget
+            Cursor = self._Connection.execute("SELECT Key, Size FROM Responses ORDER BY LastAccessed DESC")
+            TotalBytes = 0
+            ExpiredKeys = []
+            for Key, Size in Cursor:
+                TotalBytes += Size
+                if TotalBytes > self.MaxBytes:
+                    ExpiredKeys.append((Key,))
+            self._Connection.executemany("DELETE FROM Responses WHERE Key = ?", ExpiredKeys)
+
+        self._Connection.commit()
+
+    def GetStats(self) -> Dict[str, Any]:
+        """
+        Report hit/miss counts for this process and the current cache size.
+
+        Returns:
+            Dictionary with Hits, Misses, HitRate, Entries and Bytes
+        """
+        with self._Lock:
+            Entries, Bytes = self._Connection.execute("SELECT COUNT(*), COALESCE(SUM(Size), 0) FROM Responses").fetchone()
+        Lookups = self.Hits + self.Misses
+        return {
+            'Hits': self.Hits,
+            'Misses': self.Misses,
+            'HitRate': self.Hits / Lookups if Lookups > 0 else 0.0,
+            'Entries': Entries,
+            'Bytes': Bytes
+        }
+
+    def Clear(self) -> None:
+        """Delete every cached response."""
+        with self._Lock:
+            self._PendingTouches.clear()
+            self._Connection.execute("DELETE FROM Responses")
+            self._Connection.commit()
+
+    def Close(self) -> None:
+        """Write buffered access times and close the underlying database connection."""
+        self._Executor.shutdown(wait=True)
+        with self._Lock:
+            self._FlushTouches()
+            self._Connection.close()
+
+
+_Cache: Optional[ResponseCache] = None
+_CacheLock = threading.Lock()
+
+
+def GetResponseCache() -> Optional[ResponseCache]:
+    """
+    Return the process-wide response cache configured from the environment.
+
+    Returns:
+        The shared ResponseCache, or None when LLM_CACHE_ENABLED is false
+    """
+    global _Cache
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+
+    with _CacheLock:
+        if _Cache is None:
+            MaxBytes = os.getenv("LLM_CACHE_MAX_BYTES")
+            TimeToLive = os.getenv("LLM_CACHE_TTL_SECONDS")
+            _Cache = ResponseCache(
+                Path=os.getenv("LLM_CACHE_PATH", ".llm_cache/responses.sqlite"),
+                MaxEntries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000")),
+                MaxBytes=int(MaxBytes) if MaxBytes else None,
+                TimeToLive=float(TimeToLive) if TimeToLive else None
+            )
+            # Keep the recency of hits from the last batch for LRU eviction in later runs
+            atexit.register(_Cache.Flush)
+        return _Cache
@@ -0,0 +1,251 @@
+import os
+import asyncio
+import pandas as pd
+import pyarrow.parquet as pq
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from ClientRegistry import RunCoroutine
+from PromptEvaluation import DefaultMaxConcurrency, EvaluatePromptAsync, EvaluatePromptPackedAsync
+from PromptTemplate import CompilePrompt, DefaultPromptLayout
+
+# Rows read, evaluated and written per chunk
+DefaultChunkSize = int(os.getenv("EVALUATION_CHUNK_SIZE", "1000"))
+
+
+def ConvertExcelToParquet(ExcelPath: str, ParquetPath: Optional[str] = None, **ReadOptions: Any) -> str:
+    """
+    Convert an Excel workbook to Parquet once so later runs can stream it.
+
+    The conversion is skipped when the Parquet file is newer than the workbook.
+
+    Args:
+        ExcelPath: Path of the Excel workbook
+        ParquetPath: Output path (default: ExcelPath with a .parquet extension)
+        **ReadOptions: Options passed to pd.read_excel (sheet_name, usecols, ...)
+
+    Returns:
+        Path of the Parquet file
+    """
+    if ParquetPath is None:
+        ParquetPath = os.path.splitext(ExcelPath)[0] + '.parquet'
+
+    if os.path.exists(ParquetPath) and os.path.getmtime(ParquetPath) >= os.path.getmtime(ExcelPath):
+        return ParquetPath
+
+    print(f"Converting {ExcelPath} to {ParquetPath}")
+    DataFrame = pd.read_excel(ExcelPath, **ReadOptions)
+    # Object columns with mixed cell types cannot be written as Parquet, keep them as text
+    for Column in DataFrame.select_dtypes(include='object').columns:
+        DataFrame[Column] = DataFrame[Column].map(lambda Value: Value if pd.isna(Value) else str(Value))
+    DataFrame.to_parquet(ParquetPath, index=False)
+    return ParquetPath
+
+
+def IterDatasetChunks(Path: str, Columns: Optional[List[str]] = None,
+                      ChunkSize: int = DefaultChunkSize) -> Iterator[pd.DataFrame]:
+    """
+    Read a CSV, Parquet or Excel dataset in chunks.
+
+    Excel workbooks are converted to Parquet first (see ConvertExcelToParquet).
+    CSV columns are read as text so every chunk has the same schema.
+
+    Args:
+        Path: Dataset path (.csv, .parquet or .xlsx/.xls)
+        Columns: Columns to read (default: all)
+        ChunkSize: Rows per chunk
+
+    Yields:
+        DataFrames of at most ChunkSize rows, in file order
+    """
+    Extension = os.path.splitext(Path)[1].lower()
+    if Extension in ('.xlsx', '.xls'):
+        Path = ConvertExcelToParquet(Path)
+        Extension = '.parquet'
+
+    if Extension == '.csv':
+        yield from pd.read_csv(Path, usecols=Columns, dtype=str, keep_default_na=False, chunksize=ChunkSize)
+    elif Extension == '.parquet':
+        for Batch in pq.ParquetFile(Path).iter_batches(batch_size=ChunkSize, columns=Columns):
+            yield Batch.to_pandas()
+    else:
+        raise ValueError(f"Unsupported dataset format: {Path}")
+
+
+def ReadLabels(Path: str, LabelColumn: str, ChunkSize: int = DefaultChunkSize) -> List[str]:
+    """
+    Collect the distinct labels of a dataset by streaming only its label column.
+
+    Args:
+        Path: Dataset path
+        LabelColumn: The column name containing true labels
+        ChunkSize: Rows per chunk
+
+    Returns:
+        Labels in order of first appearance
+    """
+    Labels = {}
+    for Chunk in IterDatasetChunks(Path, [LabelColumn], ChunkSize):
+        for Label in Chunk[LabelColumn].dropna().astype(str).unique():
+            Labels.setdefault(Label, None)
+    return list(Labels)
+
+
+class IncrementalConfusion:
+    """Running accuracy and confusion counts, updated one chunk at a time."""
+
+    def __init__(self):
+        self.Counts = pd.Series(dtype='int64')
+        self.Total = 0
+        self.Correct = 0
+
+    def Update(self, TrueLabels: pd.Series, PredictedLabels: pd.Series) -> None:
+        """
+        Add the predictions of one chunk.
+
+        Args:
+            TrueLabels: True labels of the chunk
+            PredictedLabels: Extracted labels of the chunk, aligned with TrueLabels
+        """
+        Pairs = pd.DataFrame({
+            'TrueLabel': TrueLabels.astype(str).to_numpy(),
+            'PredictedLabel': PredictedLabels.astype(str).to_numpy()
+        })
+        self.Counts = self.Counts.add(Pairs.groupby(['TrueLabel', 'PredictedLabel']).size(), fill_value=0).astype('int64')
+        self.Total += len(Pairs)
+        self.Correct += int((Pairs['TrueLabel'] == Pairs['PredictedLabel']).sum())
+
+    @property
+    def Accuracy(self) -> float:
+        return self.Correct / self.Total if self.Total > 0 else 0.0
+
+    def GetConfusionMatrix(self) -> pd.DataFrame:
+        """Return the confusion matrix of true label (rows) by extracted label (columns)."""
+        if self.Counts.empty:
+            return pd.DataFrame()
+        Counts = self.Counts.copy()
+        Counts.index = pd.MultiIndex.from_tuples(Counts.index, names=['TrueLabel', 'PredictedLabel'])
+        return Counts.unstack(fill_value=0)
+
+
+def EvaluatePromptStreaming(
+    Prompt: str,
+    DataPath: str,
+    FeatureColumns: List[str],
+    LabelColumn: str,
+    OutputPath: str,
+    UniqueLabels: Optional[List[str]] = None,
+    ChunkSize: int = DefaultChunkSize,
+    MaxConcurrency: int = DefaultMaxConcurrency,
+    PackSize: int = 1,
+    MaxErrorSamples: int = 200,
+    ConstrainedOutput: bool = False,
+    Layout: str = DefaultPromptLayout
+) -> Tuple[float, Dict[str, Any]]:
+    """
+    Evaluate a prompt on a dataset file without loading it into memory.
+
+    This is a standalone scoring utility, e.g. for a final prompt on a large
+    holdout file. Main and the job orchestrator do not use it: the improvement
+    loop keeps per-row predictions of the current and best prompt in a
+    PredictionStore, which needs the training frame in memory.
+
+    Each chunk is classified, scored and written as its own Parquet part file
+    under OutputPath before the next chunk is read, so memory stays flat and
+    an interrupted run leaves every finished chunk readable with
+    pd.read_parquet(OutputPath).
+
+    Args:
+        Prompt: The prompt template with placeholders for features
+        DataPath: Dataset path (.csv, .parquet or .xlsx/.xls)
+        FeatureColumns: List of column names to use as features
+        LabelColumn: The column name containing true labels
+        OutputPath: Directory receiving the result part files
+        UniqueLabels: Labels to extract; read from the label column when omitted
+        ChunkSize: Rows per chunk
+        MaxConcurrency: Maximum number of concurrent requests
+        PackSize: Rows classified per request; values above 1 use packed requests
+        MaxErrorSamples: Misclassified rows kept in memory for prompt improvement
+        ConstrainedOutput: Request label-only answers with logprobs; part files get a 'Confidence' column
+        Layout: Message layout of per-row requests, one of 'Single', 'Split' or 'Reorder'
+
+    Returns:
+        Tuple containing:
+        - Accuracy score (float between 0 and 1)
+        - Dictionary with 'Total', 'Correct', 'Accuracy', 'ConfusionMatrix',
+          'Chunks', 'OutputPath', 'ErrorSample' (DataFrame of misclassified rows),
+          'PromptTokens', 'CachedTokens' and 'CachedTokenRate'
+
+    Raises:
+        PromptTemplateError: If the prompt placeholders do not match FeatureColumns
+    """
+    # Check the template before the label scan and before earlier results are removed
+    CompilePrompt(Prompt, FeatureColumns)
+    if PackSize > 1:
+        # Same limits as EvaluatePrompt: packed answers are JSON arrays with their own instructions
+        if ConstrainedOutput:
+            print("Warning: ConstrainedOutput is ignored for packed requests (PackSize > 1)")
+        if Layout != 'Single':
+            print(f"Warning: Layout {Layout!r} is ignored for packed requests (PackSize > 1)")
+
+    # Labels must be known up front so every chunk extracts against the same set
+    if UniqueLabels is None:
+        UniqueLabels = ReadLabels(DataPath, LabelColumn, ChunkSize)
+    UniqueLabels = [str(Label) for Label in UniqueLabels]
+
+    # Start from an empty result directory so parts of an earlier run are not mixed in
+    os.makedirs(OutputPath, exist_ok=True)
+    for FileName in os.listdir(OutputPath):
+        if FileName.startswith('part-') and FileName.endswith('.parquet'):
+            os.remove(os.path.join(OutputPath, FileName))
+
+    Confusion = IncrementalConfusion()
+    ErrorSample = []
+    ErrorSampleRows = 0
+    ChunkCount = 0
+    PromptTokens = CachedTokens = 0
+
+    for ChunkNumber, Chunk in enumerate(IterDatasetChunks(DataPath, FeatureColumns + [LabelColumn], ChunkSize)):
+        # Global row numbers identify rows across chunks
+        Chunk.index = pd.RangeIndex(Confusion.Total, Confusion.Total + len(Chunk), name='RowNumber')
+
+        async def EvaluateChunk():
+            Semaphore = asyncio.Semaphore(MaxConcurrency)
+            if PackSize > 1:
+                return await EvaluatePromptPackedAsync(
+                    Prompt, Chunk, FeatureColumns, LabelColumn, PackSize, MaxConcurrency,
+                    UniqueLabels=UniqueLabels, Semaphore=Semaphore
+                )
+            return await EvaluatePromptAsync(
+                Prompt, Chunk, FeatureColumns, LabelColumn, MaxConcurrency,
+                UniqueLabels=UniqueLabels, Semaphore=Semaphore, ConstrainedOutput=ConstrainedOutput, Layout=Layout
+            )
+
+        _, ChunkResults = RunCoroutine(EvaluateChunk())
+        PromptTokens += ChunkResults.attrs.get('PromptTokens', 0)
+        CachedTokens += ChunkResults.attrs.get('CachedTokens', 0)
+        ChunkResults.attrs = {}
+        ChunkResults.reset_index().to_parquet(os.path.join(OutputPath, f"part-{ChunkNumber:05d}.parquet"), index=False)
+
+        Confusion.Update(ChunkResults[LabelColumn], ChunkResults['ExtractedLabel'])
+        ChunkCount += 1
+
+        # Keep a bounded sample of misclassified rows
+        if ErrorSampleRows < MaxErrorSamples:
+            Misclassified = ChunkResults[ChunkResults['ExtractedLabel'] != ChunkResults[LabelColumn].astype(str)]
+            Misclassified = Misclassified.head(MaxErrorSamples - ErrorSampleRows)
+            ErrorSample.append(Misclassified)
+            ErrorSampleRows += len(Misclassified)
+
+        print(f"Chunk {ChunkNumber + 1}: {Confusion.Total} rows evaluated, running accuracy {Confusion.Accuracy:.2%}")
+
+    return Confusion.Accuracy, {
+        'Total': Confusion.Total,
+        'Correct': Confusion.Correct,
+        'Accuracy': Confusion.Accuracy,
+        'ConfusionMatrix': Confusion.GetConfusionMatrix(),
+        'Chunks': ChunkCount,
+        'OutputPath': OutputPath,
+        'ErrorSample': pd.concat(ErrorSample) if ErrorSample else pd.DataFrame(),
+        'PromptTokens': PromptTokens,
+        'CachedTokens': CachedTokens,
+        'CachedTokenRate': CachedTokens / PromptTokens if PromptTokens else 0.0
+    }
@@ -0,0 +1,472 @@
+import json
+import math
+import time
+import threading
+import contextlib
+import contextvars
+import collections
+import pandas as pd
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Stage and iteration of the code issuing LLM calls; propagated into async tasks
+_CurrentStage: contextvars.ContextVar = contextvars.ContextVar('TelemetryStage', default='Unspecified')
+_CurrentIteration: contextvars.ContextVar = contextvars.ContextVar('TelemetryIteration', default=None)
+
+# Usage totals of the enclosing TrackUsage blocks; nested blocks all receive every call
+_ActiveUsage: contextvars.ContextVar = contextvars.ContextVar('TelemetryUsage', default=())
+
+# Name and priority of the orchestrated job issuing LLM calls
+_CurrentJob: contextvars.ContextVar = contextvars.ContextVar('TelemetryJob', default=(None, 1.0))
+
+
+@contextlib.contextmanager
+def TelemetryStage(Stage: str, Iteration: Optional[int] = None) -> Iterator[None]:
+    """
+    Tag every LLM call made inside the block with a stage and iteration.
+
+    Args:
+        Stage: Stage name, e.g. 'Evaluation' or 'Improvement'
+        Iteration: Optional iteration number
+    """
+    StageToken = _CurrentStage.set(Stage)
+    IterationToken = _CurrentIteration.set(Iteration)
+    try:
+        yield
+    finally:
+        _CurrentStage.reset(StageToken)
+        _CurrentIteration.reset(IterationToken)
+
+
+@contextlib.contextmanager
+def UseJob(Name: str, Priority: float = 1.0) -> Iterator[None]:
+    """
+    Attribute every LLM call made inside the block to a job.
+
+    Calls are tagged with the job in telemetry, and request schedulers share
+    their capacity between concurrent jobs in proportion to their priorities.
+
+    Args:
+        Name: Job name
+        Priority: Relative share of the request queue (must be positive)
+
+    Raises:
+        ValueError: If Priority is not positive
+    """
+    if Priority <= 0:
+        raise ValueError(f"Priority must be positive, got {Priority}")
+    Token = _CurrentJob.set((Name, float(Priority)))
+    try:
+        yield
+    finally:
+        _CurrentJob.reset(Token)
+
+
+def GetCurrentJob() -> Tuple[Optional[str], float]:
+    """Return the name (None outside UseJob) and priority of the current job."""
+    return _CurrentJob.get()
+
+
+@contextlib.contextmanager
+def TrackUsage() -> Iterator[Dict[str, float]]:
+    """
+    Total the token usage and latency of every LLM call made inside the block.
+
+    The yielded dictionary is updated as calls complete and holds Calls,
+    PromptTokens, CachedTokens, CompletionTokens, plus CachedCalls with
+    CachedLatency (calls that reused a provider-cached prompt prefix) and
+    UncachedCalls with UncachedLatency (the remaining API calls). Calls served
+    from the response cache are only counted in Calls.
+    """
+    Totals = dict.fromkeys(('Calls', 'PromptTokens', 'CachedTokens', 'CompletionTokens',
+                            'CachedCalls', 'CachedLatency', 'UncachedCalls', 'UncachedLatency'), 0)
+    Token = _ActiveUsage.set(_ActiveUsage.get() + (Totals,))
+    try:
+        yield Totals
+    finally:
+        _ActiveUsage.reset(Token)
+
+
+def SummarizeUsage(Totals: Dict[str, float]) -> Dict[str, Any]:
+    """
+    Derive prompt-cache figures from TrackUsage totals.
+
+    Args:
+        Totals: Dictionary yielded by TrackUsage
+
+    Returns:
+        Dictionary with PromptTokens, CachedTokens, CompletionTokens, CachedTokenRate
+        and the mean latency of calls with and without a cached prefix (NaN without such calls)
+    """
+    return {
+        'PromptTokens': int(Totals['PromptTokens']),
+        'CachedTokens': int(Totals['CachedTokens']),
+        'CompletionTokens': int(Totals['CompletionTokens']),
+        'CachedTokenRate': Totals['CachedTokens'] / Totals['PromptTokens'] if Totals['PromptTokens'] else 0.0,
+        'LatencyWithCachedPrefix': Totals['CachedLatency'] / Totals['CachedCalls'] if Totals['CachedCalls'] else float('nan'),
+        'LatencyWithoutCachedPrefix': Totals['UncachedLatency'] / Totals['UncachedCalls'] if Totals['UncachedCalls'] else float('nan')
+    }
+
+
+class LatencySketch:
+    """
+    Fixed-size latency histogram with logarithmic buckets.
+
+    Quantiles are within RelativeAccuracy of the true value, memory depends
+    only on the latency range (a few hundred buckets at most), and sketches
+    of several groups merge by adding bucket counts.
+    """
+
+    def __init__(self, RelativeAccuracy: float = 0.01):
+        """
+        Args:
+            RelativeAccuracy: Maximum relative error of reported quantiles
+        """
+        self.Gamma = (1 + RelativeAccuracy) / (1 - RelativeAccuracy)
+        self.Buckets: Dict[int, int] = {}
+        self.Count = 0
+
+    def Add(self, Value: float) -> None:
+        """Count one observation."""
+        Bucket = math.ceil(math.log(max(Value, 1e-6), self.Gamma))
+        self.Buckets[Bucket] = self.Buckets.get(Bucket, 0) + 1
+        self.Count += 1
+
+    def Merge(self, Other: 'LatencySketch') -> None:
+        """Add the observations of another sketch with the same accuracy."""
+        for Bucket, Count in Other.Buckets.items():
+            self.Buckets[Bucket] = self.Buckets.get(Bucket, 0) + Count
+        self.Count += Other.Count
+
+    def Quantile(self, Fraction: float) -> float:
+        """Return the approximate quantile, or NaN without observations."""
+        if not self.Count:
+            return float('nan')
+        Rank = Fraction * (self.Count - 1)
+        Seen = 0
+        for Bucket in sorted(self.Buckets):
+            Seen += self.Buckets[Bucket]
+            if Seen > Rank:
+                return 2 * self.Gamma ** Bucket / (self.Gamma + 1)
+        return 2 * self.Gamma ** max(self.Buckets) / (self.Gamma + 1)
+
+
+# Counters summed per (Job, Stage, Iteration) group
+_Counters = ('Calls', 'CacheHits', 'Requests', 'Retries', 'Throttled', 'Errors', 'Hedges', 'HedgeWins',
+             'HedgeSavedSeconds', 'PromptTokens', 'CompletionTokens', 'CachedTokens', 'LatencySeconds')
+
+# Columns a summary can be grouped by
+_GroupColumns = ('Job', 'Stage', 'Iteration')
+
+
+def _MatchesJob(Name: Optional[str], Job: Optional[str]) -> bool:
+    # A job also owns its sub-jobs, e.g. '<Job>:Validation' for background validation
+    return Job is None or Name == Job or (Name is not None and Name.startswith(Job + ':'))
+
+
+class TelemetryRecorder:
+    """
+    Aggregates chat completion calls per job, stage and iteration.
+
+    Memory does not grow with the number of calls: each group keeps counters
+    and a latency sketch, and token usage of the last minute is kept in
+    per-second buckets. Raw per-call records are only written to the files
+    registered with StartStream.
+    """
+
+    def __init__(self):
+        self.Groups: Dict[Tuple[Optional[str], str, Optional[int]], Dict[str, Any]] = {}
+        self._RecentTokens: collections.deque = collections.deque()
+        self._Streams: Dict[str, Tuple[Any, Optional[str]]] = {}
+        self._Lock = threading.Lock()
+
+    def Record(self, Latency: float, Usage: Optional[Dict[str, Any]] = None, CacheHit: bool = False,
+               Attempts: int = 1, Throttled: int = 0, AttemptLatency: Optional[float] = None,
+               Error: Optional[str] = None, Hedged: bool = False, HedgeWon: bool = False,
+               HedgeSavedSeconds: float = 0.0, **Fields: Any) -> None:
+        """
+        Count one call, tagged with the current stage, iteration and job.
+
+        Args:
+            Latency: Seconds spent in the call, including queueing and retries
+            Usage: Token usage reported by the API
+            CacheHit: Whether the response came from the response cache
+            Attempts: Requests sent for this call
+            Throttled: Attempts rejected with 429
+            AttemptLatency: Seconds spent in the last request attempt
+            Error: Exception type name if the call failed
+            Hedged: Whether a duplicate request was sent for this call
+            HedgeWon: Whether the duplicate answered first
+            HedgeSavedSeconds: Estimated latency saved by a winning duplicate
+            **Fields: Extra fields written with the record to open streams
+        """
+        Usage = Usage or {}
+        PromptDetails = Usage.get('prompt_tokens_details') or {}
+        Record = {
+            'Timestamp': time.time(),
+            'Stage': _CurrentStage.get(),
+            'Iteration': _CurrentIteration.get(),
+            'Job': _CurrentJob.get()[0],
+            'Latency': Latency,
+            'AttemptLatency': AttemptLatency if AttemptLatency is not None else Latency,
+            'CacheHit': CacheHit,
+            'Attempts': Attempts,
+            'Retries': max(0, Attempts - 1),
+            'Throttled': Throttled,
+            'Error': Error,
+            'Hedged': Hedged,
+            'HedgeWon': HedgeWon,
+            'HedgeSavedSeconds': HedgeSavedSeconds,
+            'PromptTokens': 0 if CacheHit else Usage.get('prompt_tokens', 0) or 0,
+            'CompletionTokens': 0 if CacheHit else Usage.get('completion_tokens', 0) or 0,
+            'CachedTokens': 0 if CacheHit else PromptDetails.get('cached_tokens', 0) or 0,
+            **Fields
+        }
+        with self._Lock:
+            Key = (Record['Job'], Record['Stage'], Record['Iteration'])
+            Group = self.Groups.get(Key)
+            if Group is None:
+                Group = self.Groups[Key] = {**dict.fromkeys(_Counters, 0), 'Latency': LatencySketch(),
+                                            'FirstTimestamp': Record['Timestamp']}
+            for Name, Value in (('Calls', 1), ('CacheHits', CacheHit), ('Requests', Attempts),
+                                ('Retries', Record['Retries']), ('Throttled', Throttled),
+                                ('Errors', Error is not None), ('Hedges', Hedged), ('HedgeWins', HedgeWon),
+                                ('HedgeSavedSeconds', HedgeSavedSeconds), ('PromptTokens', Record['PromptTokens']),
+                                ('CompletionTokens', Record['CompletionTokens']),
+                                ('CachedTokens', Record['CachedTokens']), ('LatencySeconds', Latency)):
+                Group[Name] += Value
+            Group['Latency'].Add(Latency)
+            Group['LastTimestamp'] = Record['Timestamp']
+
+            # Token usage per second over the last minute, for quota reports
+            Second = int(Record['Timestamp'])
+            Tokens = Record['PromptTokens'] + Record['CompletionTokens']
+            if self._RecentTokens and self._RecentTokens[-1][0] == Second:
+                self._RecentTokens[-1][1] += Tokens
+            else:
+                self._RecentTokens.append([Second, Tokens])
+            while self._RecentTokens[0][0] < Second - 60:
+                self._RecentTokens.popleft()
+
+            for File, Job in self._Streams.values():
+                if _MatchesJob(Record['Job'], Job):
+                    File.write(json.dumps(Record, default=str) + "\n")
+
+            for Totals in _ActiveUsage.get():
+                Totals['Calls'] += 1
+                if CacheHit or Error is not None:
+                    continue
+                Totals['PromptTokens'] += Record['PromptTokens']
+                Totals['CachedTokens'] += Record['CachedTokens']
+                Totals['CompletionTokens'] += Record['CompletionTokens']
+                Prefix = 'Cached' if Record['CachedTokens'] else 'Uncached'
+                Totals[Prefix + 'Calls'] += 1
+                Totals[Prefix + 'Latency'] += Record['AttemptLatency']
+
+    def StartStream(self, Path: str, Job: Optional[str] = None) -> None:
+        """
+        Append every following call record to a JSON Lines file.
+
+        Args:
+            Path: File to append to
+            Job: Only write records of this job and its sub-jobs (default: all records)
+        """
+        File = open(Path, 'a', encoding='utf-8')
+        with self._Lock:
+            Previous = self._Streams.pop(Path, None)
+            self._Streams[Path] = (File, Job)
+        if Previous is not None:
+            Previous[0].close()
+
+    def StopStream(self, Path: str) -> None:
+        """Stop writing records to a file opened with StartStream."""
+        with self._Lock:
+            Stream = self._Streams.pop(Path, None)
+        if Stream is not None:
+            Stream[0].close()
+
+    def GetRecentTokens(self, Seconds: int = 60) -> int:
+        """Return the prompt and completion tokens of API calls completed in the last Seconds (at most 60)."""
+        Since = int(time.time()) - Seconds
+        with self._Lock:
+            return sum(Tokens for Second, Tokens in self._RecentTokens if Second > Since)
+
+    def GetTotals(self, Job: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Total the counters over all groups, or over the groups of one job.
+
+        Args:
+            Job: Optional job to restrict the totals to
+
+        Returns:
+            Dictionary with every counter, LatencyP50/P95/P99 and LastIteration
+            (highest iteration seen, or None)
+        """
+        Totals = dict.fromkeys(_Counters, 0)
+        Latency = LatencySketch()
+        Iterations = []
+        with self._Lock:
+            for (GroupJob, _, Iteration), Group in self.Groups.items():
+                if Job is not None and GroupJob != Job:
+                    continue
+                for Name in _Counters:
+                    Totals[Name] += Group[Name]
+                Latency.Merge(Group['Latency'])
+                if Iteration is not None:
+                    Iterations.append(Iteration)
+        Totals.update({
+            'LatencyP50': Latency.Quantile(0.50),
+            'LatencyP95': Latency.Quantile(0.95),
+            'LatencyP99': Latency.Quantile(0.99),
+            'LastIteration': max(Iterations) if Iterations else None
+        })
+        return Totals
+
+    def ToDataFrame(self) -> pd.DataFrame:
+        """Return one row per (Job, Stage, Iteration) group with its counters."""
+        with self._Lock:
+            Rows = [{'Job': Job, 'Stage': Stage, 'Iteration': Iteration,
+                     **{Name: Group[Name] for Name in _Counters},
+                     'FirstTimestamp': Group['FirstTimestamp'], 'LastTimestamp': Group['LastTimestamp']}
+                    for (Job, Stage, Iteration), Group in self.Groups.items()]
+        return pd.DataFrame(Rows)
+
+    def Summarize(self, GroupBy: Optional[List[str]] = None, Iteration: Optional[int] = None,
+                  Job: Optional[str] = None, SubJobs: bool = False) -> pd.DataFrame:
+        """
+        Aggregate calls, tokens, errors and latency percentiles.
+
+        Args:
+            GroupBy: Columns to group by, any of Job, Stage and Iteration (default: Stage and Iteration)
+            Iteration: Optional iteration to restrict the summary to
+            Job: Optional job to restrict the summary to
+            SubJobs: Also include the job's sub-jobs such as '<Job>:Validation'
+
+        Returns:
+            DataFrame with one row per group
+        """
+        GroupBy = GroupBy or ['Stage', 'Iteration']
+        Merged: Dict[tuple, Dict[str, Any]] = {}
+        with self._Lock:
+            for Key, Group in self.Groups.items():
+                Values = dict(zip(_GroupColumns, Key))
+                if Iteration is not None and Values['Iteration'] != Iteration:
+                    continue
+                if not (_MatchesJob(Values['Job'], Job) if SubJobs else Job is None or Values['Job'] == Job):
+                    continue
+                if Values['Iteration'] is None:
+                    Values['Iteration'] = '-'
+                Target = Merged.setdefault(tuple(Values[Column] for Column in GroupBy), {
+                    **dict.fromkeys(_Counters, 0), 'Latency': LatencySketch(),
+                    'FirstTimestamp': Group['FirstTimestamp'], 'LastTimestamp': Group['LastTimestamp']
+                })
+                for Name in _Counters:
+                    Target[Name] += Group[Name]
+                Target['Latency'].Merge(Group['Latency'])
+                Target['FirstTimestamp'] = min(Target['FirstTimestamp'], Group['FirstTimestamp'])
+                Target['LastTimestamp'] = max(Target['LastTimestamp'], Group['LastTimestamp'])
+        if not Merged:
+            return pd.DataFrame()
+
+        Rows = []
+        for Key, Group in Merged.items():
+            Rows.append({
+                **dict(zip(GroupBy, Key)),
+                **{Name: Group[Name] for Name in _Counters},
+                'LatencyP50': Group['Latency'].Quantile(0.50),
+                'LatencyP95': Group['Latency'].Quantile(0.95),
+                'LatencyP99': Group['Latency'].Quantile(0.99),
+                'WallSeconds': Group['LastTimestamp'] - Group['FirstTimestamp']
+            })
+        Summary = pd.DataFrame(Rows).set_index(GroupBy)
+        Summary['CachedTokenRate'] = (Summary['CachedTokens'] / Summary['PromptTokens']).where(Summary['PromptTokens'] > 0, 0.0)
+        return Summary
+
+    def FormatIterationSummary(self, Iteration: int) -> str:
+        """
+        Format a short per-stage report for one iteration of the current job.
+
+        Args:
+            Iteration: Iteration number
+
+        Returns:
+            Report lines, or an empty string if the iteration made no calls
+        """
+        Summary = self.Summarize(GroupBy=['Stage'], Iteration=Iteration, Job=_CurrentJob.get()[0])
+        Lines = []
+        for Row in Summary.itertuples():
+            Lines.append(
+                f"  {Row.Index}: {Row.Calls} calls ({Row.CacheHits} cached, {Row.Retries} retries, {Row.Errors} errors), "
+                f"{Row.PromptTokens} prompt / {Row.CompletionTokens} completion tokens "
+                f"({Row.CachedTokenRate:.0%} prompt-cached), "
+                f"latency p50 {Row.LatencyP50:.2f}s p95 {Row.LatencyP95:.2f}s p99 {Row.LatencyP99:.2f}s"
+                + (f", {Row.Hedges} hedged ({Row.HedgeWins} won, ~{Row.HedgeSavedSeconds:.1f}s saved)" if Row.Hedges else "")
+            )
+        return "\n".join(Lines)
+
+    def ExportCsv(self, Path: str, Job: Optional[str] = None) -> None:
+        """
+        Write the per-group summary (Job, Stage and Iteration) to a CSV file.
+
+        Args:
+            Path: CSV file to write
+            Job: Optional job to export, with its sub-jobs (default: all jobs)
+        """
+        self.Summarize(GroupBy=list(_GroupColumns), Job=Job, SubJobs=True).to_csv(Path)
+
+    def ExportPrometheus(self, Job: Optional[str] = None) -> str:
+        """
+        Render the summary in Prometheus text exposition format.
+
+        Args:
+            Job: Optional job to export, with its sub-jobs (default: all jobs)
+
+        Returns:
+            Metrics text with job, stage and iteration labels
+        """
+        Summary = self.Summarize(GroupBy=list(_GroupColumns), Job=Job, SubJobs=True)
+        Metrics = [
+            ('llm_calls_total', 'counter', 'Chat completion calls', 'Calls'),
+            ('llm_cache_hits_total', 'counter', 'Calls served from the response cache', 'CacheHits'),
+            ('llm_requests_total', 'counter', 'Requests sent to the API, including retries', 'Requests'),
+            ('llm_retries_total', 'counter', 'Retried requests', 'Retries'),
+            ('llm_throttled_total', 'counter', 'Requests rejected with 429', 'Throttled'),
+            ('llm_errors_total', 'counter', 'Calls that failed after all retries', 'Errors'),
+            ('llm_prompt_tokens_total', 'counter', 'Prompt tokens', 'PromptTokens'),
+            ('llm_completion_tokens_total', 'counter', 'Completion tokens', 'CompletionTokens'),
+            ('llm_cached_tokens_total', 'counter', 'Prompt tokens served from the provider prompt cache', 'CachedTokens'),
+            ('llm_hedges_total', 'counter', 'Calls that sent a duplicate request', 'Hedges'),
+            ('llm_hedge_wins_total', 'counter', 'Calls answered by the duplicate request', 'HedgeWins'),
+            ('llm_hedge_saved_seconds_total', 'counter', 'Estimated latency saved by duplicate requests', 'HedgeSavedSeconds')
+        ]
+
+        Lines = []
+        for Name, Type, Help, Column in Metrics:
+            Lines.append(f"# HELP {Name} {Help}")
+            Lines.append(f"# TYPE {Name} {Type}")
+            for (GroupJob, Stage, Iteration), Row in Summary.iterrows():
+                Labels = f'job="{GroupJob or ""}",stage="{Stage}",iteration="{Iteration}"'
+                Lines.append(f'{Name}{{{Labels}}} {Row[Column]:g}')
+
+        Lines.append("# HELP llm_call_latency_seconds Chat completion call latency")
+        Lines.append("# TYPE llm_call_latency_seconds summary")
+        for (GroupJob, Stage, Iteration), Row in Summary.iterrows():
+            Labels = f'job="{GroupJob or ""}",stage="{Stage}",iteration="{Iteration}"'
+            for Quantile, Column in (('0.5', 'LatencyP50'), ('0.95', 'LatencyP95'), ('0.99', 'LatencyP99')):
+                Lines.append(f'llm_call_latency_seconds{{{Labels},quantile="{Quantile}"}} {Row[Column]:g}')
+            Lines.append(f'llm_call_latency_seconds_sum{{{Labels}}} {Row["LatencySeconds"]:g}')
+            Lines.append(f'llm_call_latency_seconds_count{{{Labels}}} {Row["Calls"]:g}')
+        return "\n".join(Lines) + "\n"
+
+    def Clear(self) -> None:
+        """Drop all counters."""
+        with self._Lock:
+            self.Groups.clear()
+            self._RecentTokens.clear()
+
+
+_Telemetry = TelemetryRecorder()
+
+
+def GetTelemetry() -> TelemetryRecorder:
+    """Return the process-wide telemetry recorder."""
+    return _Telemetry
@@ -1,60 +1,384 @@
+import os
+import random
+import functools
 import pandas as pd
-from PromptEvaluation import EvaluatePrompt
+from PromptEvaluation import EvaluatePrompt, EvaluatePromptAsync
+from BatchEvaluation import EvaluatePromptBatch
+from RacingEvaluation import EvaluatePromptRacing, DescribeRacingResult
 from PromptEvolution import ImprovePrompt
 from HybridPromptEvolution import HybridImprovePrompt
+from PopulationEvolution import EvolvePopulation
+from StreamingEvaluation import ConvertExcelToParquet
+from ErrorAnalytics import ComputeErrorAnalytics, FormatPerLabelReport
+from ClientRegistry import CloseClients, SubmitCoroutine
+from ResponseCache import GetResponseCache
+from DeploymentRouter import GetDeploymentRouter
+from Checkpoint import RunCheckpoint, UsePredictionLog
+from PredictionStore import PredictionStore
+from CorrectnessIndex import CorrectnessIndex, FormatCorrectnessReport
+from PromptEnsemble import (DefaultEnsembleSize, EvaluateEnsemble, FormatEnsembleReport, GetEnsemblePath,
+                            LoadEnsemble, SaveEnsemble, ScoreEnsemble, SelectEnsembleMembers)
+from Telemetry import GetCurrentJob, GetTelemetry, TelemetryStage, UseJob
+from PromptTemplate import DefaultPromptLayout, PromptTemplateError
+from ConfidenceScoring import ComputeCalibration, FormatCalibrationReport
 from sklearn.model_selection import train_test_split
 import numpy as np
 
-def Main(DataFrame, FeatureColumns, LabelColumn, PromptTemplate, MaxIterations=5, AccuracyThreshold=0.95):
+# Default location of the saved best prompt; jobs run by JobOrchestrator each pass their own OutputPath
+DefaultOutputPath = os.getenv("BEST_PROMPT_PATH", '/dbfs/mnt/uat/Franky/RetrainingPipeline/BestPrompt.txt')
+
+# Share of the request queue given to background validation relative to the training job
+ValidationPriority = float(os.getenv("VALIDATION_PRIORITY", "0.25"))
+
+
+def SaveBestPrompt(BestPrompt, BestIteration, OutputPath=DefaultOutputPath):
+    # Save best prompt to file
+    with open(OutputPath, 'w') as File:
+        File.write(BestPrompt)
+    print(f"Best prompt saved (from iteration {BestIteration})")
+
+
+def StartTelemetryStream(Directory):
+    # Append per-call records of this run to a JSON Lines file as they happen
+    os.makedirs(Directory, exist_ok=True)
+    GetTelemetry().StartStream(os.path.join(Directory, 'Telemetry.jsonl'), Job=GetCurrentJob()[0])
+
+
+def ExportTelemetry(Directory):
+    # Close the per-call record stream and save the aggregated metrics
+    Telemetry = GetTelemetry()
+    os.makedirs(Directory, exist_ok=True)
+    Telemetry.StopStream(os.path.join(Directory, 'Telemetry.jsonl'))
+    # Under the job orchestrator, export only this job's calls (and its background validation)
+    Job = GetCurrentJob()[0]
+    Telemetry.ExportCsv(os.path.join(Directory, 'Telemetry.csv'), Job=Job)
+    with open(os.path.join(Directory, 'Telemetry.prom'), 'w') as File:
+        File.write(Telemetry.ExportPrometheus(Job=Job))
+    print(f"Telemetry exported to {Directory}")
+
+
+def ReportCalibration(ResultDataFrame, LabelColumn):
+    # Reliability of the logprob confidence; only constrained evaluations have a Confidence column
+    if 'Confidence' not in ResultDataFrame.columns:
+        return None
+    Calibration = ComputeCalibration(ResultDataFrame, LabelColumn)
+    print(FormatCalibrationReport(Calibration))
+    return Calibration['ECE'] if Calibration['Rows'] else None
+
+
+def ReportPromptCache(ResultDataFrame):
+    # Share of prompt tokens served from the provider's prompt cache, and whether it paid off in latency
+    if not ResultDataFrame.attrs.get('PromptTokens'):
+        return None
+    Attrs = ResultDataFrame.attrs
+    print(f"Prompt cache: {Attrs['CachedTokens']}/{Attrs['PromptTokens']} prompt tokens cached "
+          f"({Attrs['CachedTokenRate']:.0%}), mean latency {Attrs['LatencyWithCachedPrefix']:.2f}s with "
+          f"vs {Attrs['LatencyWithoutCachedPrefix']:.2f}s without a cached prefix")
+    return Attrs['CachedTokenRate']
+
+
+def StartBackgroundValidation(Prompt, ValidationData, FeatureColumns, LabelColumn, Iteration, ConstrainedOutput=False,
+                              Layout=DefaultPromptLayout):
+    # Evaluate a prompt on the validation split on the background loop while training continues;
+    # its requests queue as a separate, lower-priority job so training keeps most of the quota
+    Job, Priority = GetCurrentJob()
+    ValidationJob = f"{Job}:Validation" if Job is not None else 'Validation'
+    with TelemetryStage('Validation', Iteration), UseJob(ValidationJob, Priority * ValidationPriority):
+        return SubmitCoroutine(EvaluatePromptAsync(
+            Prompt, ValidationData, FeatureColumns, LabelColumn, ConstrainedOutput=ConstrainedOutput, Layout=Layout
+        ))
+
+
+def ReportRunAnalytics(Store, IterationHistory, BestAccuracy, EnsembleSize, OutputPath):
+    # Cross-iteration row stability, and a vote over the top prompts scored from stored predictions
+    ResultIds = list(dict.fromkeys(
+        Entry['ResultId'] for Entry in IterationHistory if Entry.get('ResultId') in Store
+    ))
+    if len(ResultIds) < 2:
+        return None
+    print("\nCross-iteration analytics:")
+    print(FormatCorrectnessReport(CorrectnessIndex(Store, ResultIds)))
     
-    # Evaluate the prompt
-    print("Evaluating Prompt on Training Data")
+    Members = SelectEnsembleMembers(Store, EnsembleSize)
+    if len(Members) < 2:
+        return None
+    Ensemble = ScoreEnsemble(Store, Members)
+    print(FormatEnsembleReport(Ensemble, Title="Training ensemble"))
+    EnsemblePath = GetEnsemblePath(OutputPath)
+    if Ensemble['Accuracy'] > BestAccuracy:
+        SaveEnsemble(EnsemblePath, [Store.Entries[ResultId]['Prompt'] for ResultId in Members], Ensemble)
+        print(f"Ensemble beats the best prompt ({Ensemble['Accuracy']:.2%} vs {BestAccuracy:.2%}); saved to {EnsemblePath}")
+    elif os.path.exists(EnsemblePath):
+        # An ensemble saved by an earlier run no longer applies
+        os.remove(EnsemblePath)
+    return Ensemble
+
+
+def MainPopulation(DataFrame, FeatureColumns, LabelColumn, PromptTemplate, MaxIterations, AccuracyThreshold,
+                   PopulationSize, ParentCount, ScreeningSize=None, PromoteCount=2, OutputPath=DefaultOutputPath,
+                   StoreDirectory=None, EnsembleSize=DefaultEnsembleSize, ConstrainedOutput=False,
+                   Layout=DefaultPromptLayout, TelemetryDirectory=None):
+    print("=" * 80)
+    print("POPULATION PROMPT EVOLUTION")
+    print("=" * 80)
     print(f"Number of samples: {len(DataFrame)}")
+    print(f"Population size: {PopulationSize}, parents kept: {ParentCount}")
+    print(f"Max generations: {MaxIterations}")
+    print(f"Target accuracy: {AccuracyThreshold:.2%}")
     
-    Accuracy, ResultDataFrame = EvaluatePrompt(
-        Prompt=PromptTemplate,
+    if TelemetryDirectory is not None:
+        StartTelemetryStream(TelemetryDirectory)
+    
+    Store = PredictionStore(DataFrame, FeatureColumns, LabelColumn, Directory=StoreDirectory,
+                            SpillText=StoreDirectory is not None)
+    BestPrompt, BestAccuracy, IterationHistory = EvolvePopulation(
         DataFrame=DataFrame,
         FeatureColumns=FeatureColumns,
-        LabelColumn=LabelColumn
+        LabelColumn=LabelColumn,
+        PromptTemplate=PromptTemplate,
+        PopulationSize=PopulationSize,
+        ParentCount=ParentCount,
+        MaxGenerations=MaxIterations,
+        AccuracyThreshold=AccuracyThreshold,
+        ScreeningSize=ScreeningSize,
+        PromoteCount=PromoteCount,
+        Store=Store,
+        ConstrainedOutput=ConstrainedOutput,
+        Layout=Layout
     )
     
-    # Display results
-    print(f"Accuracy: {Accuracy:.2%}")
-    print("\nDetailed Results:")
-    print("-" * 80)
+    # Display final summary
+    print("\n" + "=" * 80)
+    print("IMPROVEMENT SUMMARY")
+    print("=" * 80)
+    print("\nBest accuracy per generation:")
+    BestIteration = 0
+    for Generation in sorted({Entry['Generation'] for Entry in IterationHistory}):
+        GenerationEntries = [Entry for Entry in IterationHistory if Entry['Generation'] == Generation]
+        EvaluatedEntries = [Entry for Entry in GenerationEntries if Entry['Accuracy'] is not None]
+        if not EvaluatedEntries:
+            continue
+        GenerationBest = max(EvaluatedEntries, key=lambda Entry: Entry['Accuracy'])
+        if GenerationBest['Prompt'] == BestPrompt:
+            BestIteration = Generation
+        print(f"  Generation {Generation}: {GenerationBest['Accuracy']:.2%} "
+              f"({len(EvaluatedEntries)}/{len(GenerationEntries)} candidates fully evaluated)")
+    
+    print(f"\nTotal improvement: {(BestAccuracy - IterationHistory[0]['Accuracy']):.2%}")
+    print(f"Best accuracy: {BestAccuracy:.2%} (achieved at generation {BestIteration})")
+    
+    # Export per-call telemetry for offline analysis
+    if TelemetryDirectory is not None:
+        ExportTelemetry(TelemetryDirectory)
+    
+    ReportRunAnalytics(Store, IterationHistory, BestAccuracy, EnsembleSize, OutputPath)
+    Store.Close()
+    
+    SaveBestPrompt(BestPrompt, BestIteration, OutputPath)
+    
+    return BestPrompt, BestAccuracy
+
+
+def Main(DataFrame, FeatureColumns, LabelColumn, PromptTemplate, MaxIterations=5, AccuracyThreshold=0.95,
+         UseBatchEvaluation=False, UseRacing=False, RacingConfidence=0.95, PopulationSize=1, ParentCount=2,
+         ScreeningSize=None, PromoteCount=2, PackSize=1, TelemetryDirectory=None, RunDirectory=None,
+         Resume=False, OutputPath=DefaultOutputPath, ConstrainedOutput=False, Layout=DefaultPromptLayout,
+         StoreDirectory=None, EnsembleSize=DefaultEnsembleSize, ValidationData=None, SelectByValidation=False,
+         ValidationPatience=None, ValidationStore=None):
+    
+    # Sample and evaluate several candidates per iteration instead of a single chain
+    if PopulationSize > 1:
+        Unsupported = [Name for Name, IsSet in (
+            ('UseBatchEvaluation', UseBatchEvaluation), ('UseRacing', UseRacing), ('PackSize', PackSize > 1),
+            ('RunDirectory', RunDirectory is not None), ('Resume', Resume), ('ValidationData', ValidationData is not None),
+            ('SelectByValidation', SelectByValidation), ('ValidationPatience', ValidationPatience),
+            ('ValidationStore', ValidationStore is not None)
+        ) if IsSet]
+        if Unsupported:
+            raise ValueError(f"PopulationSize > 1 does not support {', '.join(Unsupported)}")
+        return MainPopulation(DataFrame, FeatureColumns, LabelColumn, PromptTemplate, MaxIterations,
+                              AccuracyThreshold, PopulationSize, ParentCount, ScreeningSize, PromoteCount, OutputPath,
+                              StoreDirectory, EnsembleSize, ConstrainedOutput, Layout, TelemetryDirectory)
+    
+    # Offline batch evaluation trades latency for batch pricing and quota;
+    # online evaluation can classify PackSize rows per request
+    if UseBatchEvaluation:
+        if ConstrainedOutput:
+            print("Warning: ConstrainedOutput is ignored for batch evaluation")
+        if Layout != 'Single':
+            print(f"Warning: Layout {Layout!r} is ignored for batch evaluation")
+        if PackSize > 1:
+            print("Warning: PackSize is ignored for batch evaluation")
+        Evaluate = EvaluatePromptBatch
+    else:
+        Evaluate = functools.partial(EvaluatePrompt, PackSize=PackSize, ConstrainedOutput=ConstrainedOutput,
+                                     Layout=Layout)
     
-    for Index, Row in ResultDataFrame.iterrows():
-        if str(Row['ExtractedLabel']) != str(Row[LabelColumn]):
+    if TelemetryDirectory is not None:
+        StartTelemetryStream(TelemetryDirectory)
+    
+    # Durable run state: loop checkpoint plus a per-row prediction log
+    Checkpoint = RunCheckpoint(RunDirectory) if RunDirectory is not None else None
+    Log = Checkpoint.PredictionLog if Checkpoint is not None else None
+    State = Checkpoint.Load() if Checkpoint is not None and Resume else None
+    
+    # Predictions of the current and best prompt, held as compact per-row arrays;
+    # with a StoreDirectory they are memory-mapped and raw outputs are spilled to disk
+    Store = PredictionStore(DataFrame, FeatureColumns, LabelColumn, Directory=StoreDirectory,
+                            SpillText=StoreDirectory is not None)
+    
+    if State is None:
+        # Evaluate the prompt
+        print("Evaluating Prompt on Training Data")
+        print(f"Number of samples: {len(DataFrame)}")
+        
+        with TelemetryStage('Evaluation', Iteration=0), UsePredictionLog(Log):
+            Accuracy, ResultDataFrame = Evaluate(
+                Prompt=PromptTemplate,
+                DataFrame=DataFrame,
+                FeatureColumns=FeatureColumns,
+                LabelColumn=LabelColumn
+            )
+        
+        # Display results
+        print(f"Accuracy: {Accuracy:.2%}")
+        print(GetTelemetry().FormatIterationSummary(0))
+        CalibrationError = ReportCalibration(ResultDataFrame, LabelColumn)
+        CachedTokenRate = ReportPromptCache(ResultDataFrame)
+        print("\nDetailed Results:")
+        print("-" * 80)
+        
+        Analytics = ComputeErrorAnalytics(ResultDataFrame, LabelColumn)
+        Misclassified = ResultDataFrame.loc[Analytics['MisclassifiedIndices']]
+        for Index, TrueLabel, Prediction, ExtractedLabel in zip(
+            Misclassified.index, Misclassified[LabelColumn], Misclassified['Prediction'], Misclassified['ExtractedLabel']
+        ):
             print(f"Sample {Index + 1}:")
-            print(f"  True Label: {Row[LabelColumn]}")
-            print(f"  Prediction: {Row['Prediction']}")
-            print(f"  Extracted Label: {Row['ExtractedLabel']}")
+            print(f"  True Label: {TrueLabel}")
+            print(f"  Prediction: {Prediction}")
+            print(f"  Extracted Label: {ExtractedLabel}")
+        
+        # Summary statistics
+        print("\nSummary Statistics:")
+        print("-" * 40)
+        print(f"Correct Predictions: {Analytics['Correct']}/{Analytics['Total']}")
+        print(f"Accuracy: {Accuracy:.2%}")
+        print("\nPer-Label Performance:")
+        print(FormatPerLabelReport(Analytics))
+        
+        # Iterative prompt improvement
+        CurrentPrompt = PromptTemplate
+        CurrentAccuracy = Accuracy
+        CurrentRun = Store.Add(CurrentPrompt, ResultDataFrame)
+        IterationHistory = []
+        
+        # Track the best prompt and its accuracy
+        BestPrompt = CurrentPrompt
+        BestAccuracy = CurrentAccuracy
+        BestRun = CurrentRun
+        BestIteration = 0
+        
+        # Store initial results
+        IterationHistory.append({
+            'Iteration': 0,
+            'Accuracy': CurrentAccuracy,
+            'Prompt': CurrentPrompt,
+            'ResultId': CurrentRun,
+            'CalibrationError': CalibrationError,
+            'CachedTokenRate': CachedTokenRate
+        })
+        StartIteration = 1
+        PendingPrompt = None
+        # Improvement calls are seeded per run and iteration, so the response cache never replays
+        # an earlier iteration's candidate and a new run samples new candidates
+        RunSeed = random.randrange(2 ** 31)
+        # Result files are committed with the state that lists them
+        ResultFiles = {}
+        if Checkpoint is not None:
+            ResultFiles['Current'] = ResultFiles['Best'] = Checkpoint.SaveResults('Iteration0', ResultDataFrame)
+        del ResultDataFrame
+    else:
+        # Continue from the last completed iteration of the checkpointed run
+        Accuracy = State['InitialAccuracy']
+        CurrentPrompt = State['CurrentPrompt']
+        CurrentAccuracy = State['CurrentAccuracy']
+        BestPrompt = State['BestPrompt']
+        BestAccuracy = State['BestAccuracy']
+        BestIteration = State['BestIteration']
+        IterationHistory = State['IterationHistory']
+        # Checkpoints written before result files were named per iteration use fixed names
+        ResultFiles = State.get('ResultFiles') or {'Current': 'CurrentResults.parquet', 'Best': 'BestResults.parquet'}
+        CurrentRun = Store.Add(CurrentPrompt, Checkpoint.LoadResults(ResultFiles['Current']))
+        BestRun = Store.Add(BestPrompt, Checkpoint.LoadResults(ResultFiles['Best']))
+        StartIteration = State['Iteration'] + 1
+        PendingPrompt = State['PendingPrompt']
+        RunSeed = State.get('RunSeed', 0)
+        print(f"Resuming run from {RunDirectory} after iteration {State['Iteration']} "
+              f"({Log.CountEntries()} logged row predictions)")
     
-    # Summary statistics
-    print("\nSummary Statistics:")
-    print("-" * 40)
-    CorrectCount = sum(ResultDataFrame['ExtractedLabel'] == ResultDataFrame[LabelColumn].astype(str))
-    print(f"Correct Predictions: {CorrectCount}/{len(ResultDataFrame)}")
-    print(f"Accuracy: {Accuracy:.2%}")
-    
-    # Iterative prompt improvement
-    CurrentPrompt = PromptTemplate
-    CurrentAccuracy = Accuracy
-    CurrentResults = ResultDataFrame
-    IterationHistory = []
-    
-    # Track the best prompt and its accuracy
-    BestPrompt = CurrentPrompt
-    BestAccuracy = CurrentAccuracy
-    BestResults = CurrentResults
-    BestIteration = 0
+    def SaveCheckpoint(Iteration, PendingPrompt=None):
+        # Record the last completed iteration and, if any, the prompt awaiting evaluation
+        if Checkpoint is None:
+            return
+        Checkpoint.Save({
+            'Iteration': Iteration,
+            'InitialAccuracy': Accuracy,
+            'CurrentPrompt': CurrentPrompt,
+            'CurrentAccuracy': CurrentAccuracy,
+            'BestPrompt': BestPrompt,
+            'BestAccuracy': BestAccuracy,
+            'BestIteration': BestIteration,
+            'IterationHistory': IterationHistory,
+            'PendingPrompt': PendingPrompt,
+            'RunSeed': RunSeed,
+            'ResultFiles': ResultFiles
+        })
+    
+    # Validate every new best prompt in the background, keyed by the iteration that found it
+    Validations = {}
+    
+    def StartValidation(Iteration, Prompt):
+        if ValidationData is not None:
+            Validations[Iteration] = Prompt, StartBackgroundValidation(
+                Prompt, ValidationData, FeatureColumns, LabelColumn, Iteration,
+                ConstrainedOutput=ConstrainedOutput, Layout=Layout
+            )
+    
+    def CollectValidations(Wait=False):
+        # Attach finished validation accuracies to the iteration history and keep the predictions for the caller
+        for Iteration, (Prompt, Future) in list(Validations.items()):
+            if not Wait and not Future.done():
+                continue
+            del Validations[Iteration]
+            try:
+                ValidationAccuracy, ValidationResults = Future.result()
+            except Exception as Error:
+                print(f"Warning: background validation of iteration {Iteration} failed: {Error}")
+                continue
+            if ValidationStore is not None:
+                ValidationStore.Add(Prompt, ValidationResults)
+            del ValidationResults
+            Entry = next(Entry for Entry in IterationHistory if Entry['Iteration'] == Iteration)
+            Entry['ValidationAccuracy'] = ValidationAccuracy
+            print(f"Validation accuracy of the iteration {Iteration} prompt: {ValidationAccuracy:.2%}")
+    
+    def IsValidationPlateau():
+        # True once ValidationPatience validated prompts in a row have not beaten the best validation accuracy
+        if not ValidationPatience:
+            return False
+        Scores = [Entry['ValidationAccuracy'] for Entry in IterationHistory if Entry.get('ValidationAccuracy') is not None]
+        if not Scores:
+            return False
+        return len(Scores) - 1 - Scores.index(max(Scores)) >= ValidationPatience
+    
+    if ValidationData is None and (SelectByValidation or ValidationPatience):
+        print("Warning: SelectByValidation and ValidationPatience need ValidationData and are ignored")
     
-    # Store initial results
-    IterationHistory.append({
-        'Iteration': 0,
-        'Accuracy': CurrentAccuracy,
-        'Prompt': CurrentPrompt
-    })
+    if State is None:
+        SaveCheckpoint(0)
+        StartValidation(0, BestPrompt)
+    elif not any(Entry['Iteration'] == BestIteration and 'ValidationAccuracy' in Entry for Entry in IterationHistory):
+        StartValidation(BestIteration, BestPrompt)
     
     print("\n" + "=" * 80)
     print("ITERATIVE PROMPT IMPROVEMENT")
@@ -64,7 +388,13 @@ def Main(DataFrame, FeatureColumns, LabelColumn, PromptTemplate, MaxIterations=5
     print(f"Initial accuracy: {CurrentAccuracy:.2%}")
     
     # Run improvement loop
-    for Iteration in range(1, MaxIterations + 1):
+    for Iteration in range(StartIteration, MaxIterations + 1):
+        # Stop once validation accuracy no longer improves, judged on the validations finished so far
+        CollectValidations()
+        if IsValidationPlateau():
+            print(f"\nValidation accuracy has not improved for {ValidationPatience} validated prompts; stopping.")
+            break
+        
         # Check if we've reached the accuracy threshold
         if CurrentAccuracy >= AccuracyThreshold:
             print(f"\nTarget accuracy of {AccuracyThreshold:.2%} achieved!")
@@ -77,67 +407,150 @@ def Main(DataFrame, FeatureColumns, LabelColumn, PromptTemplate, MaxIterations=5
         print(f"Best accuracy so far: {BestAccuracy:.2%}")
         
         # Decide which prompt to improve
-        if CurrentAccuracy < BestAccuracy:
-            print("Current prompt is worse than best. Using hybrid approach to learn from both prompts.")
-            # Use hybrid approach to combine feedback from both prompts
-            ImprovedPrompt = HybridImprovePrompt(
-                BestPrompt=BestPrompt,
-                BestAccuracy=BestAccuracy,
-                BestResults=BestResults,
-                CurrentPrompt=CurrentPrompt,
-                CurrentAccuracy=CurrentAccuracy,
-                CurrentResults=CurrentResults,
-                LabelColumn=LabelColumn
-            )
-        else:
-            print("Current prompt is performing well. Continuing to improve current prompt.")
-            # Use regular improvement for successful prompts
-            ImprovedPrompt = ImprovePrompt(
-                Prompt=CurrentPrompt,
-                Accuracy=CurrentAccuracy,
-                ResultsDataFrame=CurrentResults,
-                LabelColumn=LabelColumn
-            )
+        try:
+            if PendingPrompt is not None:
+                print("Reusing the improved prompt saved in the checkpoint.")
+                ImprovedPrompt = PendingPrompt
+                PendingPrompt = None
+            elif CurrentAccuracy < BestAccuracy:
+                print("Current prompt is worse than best. Using hybrid approach to learn from both prompts.")
+                # Use hybrid approach to combine feedback from both prompts
+                with TelemetryStage('Improvement', Iteration):
+                    ImprovedPrompt = HybridImprovePrompt(
+                        BestPrompt=BestPrompt,
+                        BestAccuracy=BestAccuracy,
+                        BestResults=Store.GetResults(BestRun),
+                        CurrentPrompt=CurrentPrompt,
+                        CurrentAccuracy=CurrentAccuracy,
+                        CurrentResults=Store.GetResults(CurrentRun),
+                        LabelColumn=LabelColumn,
+                        Seed=RunSeed + Iteration
+                    )
+            else:
+                print("Current prompt is performing well. Continuing to improve current prompt.")
+                # Use regular improvement for successful prompts
+                with TelemetryStage('Improvement', Iteration):
+                    ImprovedPrompt = ImprovePrompt(
+                        Prompt=CurrentPrompt,
+                        Accuracy=CurrentAccuracy,
+                        ResultsDataFrame=Store.GetResults(CurrentRun),
+                        LabelColumn=LabelColumn,
+                        Seed=RunSeed + Iteration
+                    )
+        except PromptTemplateError as Error:
+            # Keep the current prompt; the next iteration's seed draws a different response
+            print(f"\nSkipping iteration {Iteration}: the improved prompt is not a valid template ({Error})")
+            SaveCheckpoint(Iteration)
+            continue
         
         print("\nImproved Prompt:")
         print("-" * 40)
         print(ImprovedPrompt)
         print("-" * 40)
         
+        # Keep the new prompt so a restart does not request another improvement
+        SaveCheckpoint(Iteration - 1, PendingPrompt=ImprovedPrompt)
+        
+        # A prompt seen before keeps its full results; a race could only replace them with fewer rows
+        KnownRun = PredictionStore.MakeId(ImprovedPrompt)
+        Known = KnownRun in Store and Store.Entries[KnownRun]['Rows'] == Store.RowCount
+        
         # Evaluate the improved prompt
         print("\nEvaluating Improved Prompt")
-        ImprovedAccuracy, ImprovedResults = EvaluatePrompt(
-            Prompt=ImprovedPrompt,
-            DataFrame=DataFrame,
-            FeatureColumns=FeatureColumns,
-            LabelColumn=LabelColumn
-        )
+        with TelemetryStage('Evaluation', Iteration), UsePredictionLog(Log):
+            if Known and Store.HasCompleteResults(KnownRun):
+                print("This prompt was already evaluated on every row; reusing its stored results")
+                ImprovedAccuracy, ImprovedResults = Store.GetAccuracy(KnownRun), Store.GetResults(KnownRun)
+            elif UseRacing and not Known:
+                # Stop early once the candidate provably loses against the best prompt
+                ImprovedAccuracy, ImprovedResults = EvaluatePromptRacing(
+                    Prompt=ImprovedPrompt,
+                    DataFrame=DataFrame,
+                    FeatureColumns=FeatureColumns,
+                    LabelColumn=LabelColumn,
+                    TargetAccuracy=BestAccuracy,
+                    Confidence=RacingConfidence,
+                    ConstrainedOutput=ConstrainedOutput,
+                    Layout=Layout
+                )
+                Racing = DescribeRacingResult(ImprovedResults)
+                if Racing['IsPartial']:
+                    print(f"Racing stopped after {Racing['EvaluatedRows']}/{Racing['TotalRows']} rows: "
+                          f"candidate is {Racing['Decision'].lower()} than the best prompt")
+            else:
+                ImprovedAccuracy, ImprovedResults = Evaluate(
+                    Prompt=ImprovedPrompt,
+                    DataFrame=DataFrame,
+                    FeatureColumns=FeatureColumns,
+                    LabelColumn=LabelColumn
+                )
         
         # Display iteration results
         print(f"\nIteration {Iteration} Results:")
         print(f"  Previous Accuracy: {CurrentAccuracy:.2%}")
         print(f"  New Accuracy: {ImprovedAccuracy:.2%}")
         print(f"  Improvement: {(ImprovedAccuracy - CurrentAccuracy):.2%}")
+        print(GetTelemetry().FormatIterationSummary(Iteration))
+        CalibrationError = ReportCalibration(ImprovedResults, LabelColumn)
+        CachedTokenRate = ReportPromptCache(ImprovedResults)
+        ImprovedRun = Store.Add(ImprovedPrompt, ImprovedResults)
+        if ImprovedRun != BestRun:
+            Regressed = CorrectnessIndex(Store, [BestRun, ImprovedRun]).GetRegressedRows(BestRun, ImprovedRun)
+            print(f"  Rows regressed against the best prompt: {len(Regressed)}")
         
         # Store iteration results
         IterationHistory.append({
             'Iteration': Iteration,
             'Accuracy': ImprovedAccuracy,
-            'Prompt': ImprovedPrompt
+            'Prompt': ImprovedPrompt,
+            'ResultId': ImprovedRun,
+            'EvaluatedRows': len(ImprovedResults),
+            'CalibrationError': CalibrationError,
+            'CachedTokenRate': CachedTokenRate
         })
         
-        # Check if this is the best prompt so far
-        if ImprovedAccuracy > BestAccuracy:
+        # Check if this is the best prompt so far; a race stopped early never qualifies
+        if ImprovedAccuracy > BestAccuracy and not ImprovedResults.attrs.get('IsPartial', False):
             BestPrompt = ImprovedPrompt
             BestAccuracy = ImprovedAccuracy
-            BestResults = ImprovedResults
+            BestRun = ImprovedRun
             BestIteration = Iteration
             print(f"\nNew best prompt found! Accuracy: {BestAccuracy:.2%}")
+            StartValidation(Iteration, BestPrompt)
         
         # Update current values
         CurrentPrompt = ImprovedPrompt
         CurrentAccuracy = ImprovedAccuracy
-        CurrentResults = ImprovedResults
+        CurrentRun = ImprovedRun
+        
+        # The new result file is only used once SaveCheckpoint commits the state listing it
+        if Checkpoint is not None:
+            ResultFiles = {
+                'Current': Checkpoint.SaveResults(f"Iteration{Iteration}", ImprovedResults),
+                'Best': ResultFiles['Best']
+            }
+            if BestIteration == Iteration:
+                ResultFiles['Best'] = ResultFiles['Current']
+        SaveCheckpoint(Iteration)
+        
+        # Only the current and best predictions are needed in full; older prompts keep label codes and bitmaps
+        del ImprovedResults
+        Store.Retain([CurrentRun, BestRun])
+    
+    if Validations:
+        print(f"\nWaiting for {len(Validations)} background validation(s)")
+    CollectValidations(Wait=True)
+    
+    # Optionally prefer the prompt that generalizes best over the best training accuracy
+    Validated = [Entry for Entry in IterationHistory if Entry.get('ValidationAccuracy') is not None]
+    if SelectByValidation and Validated:
+        Selected = max(Validated, key=lambda Entry: Entry['ValidationAccuracy'])
+        if Selected['Iteration'] != BestIteration:
+            print(f"\nSelecting the iteration {Selected['Iteration']} prompt by validation accuracy "
+                  f"({Selected['ValidationAccuracy']:.2%}) over the iteration {BestIteration} prompt")
+            BestPrompt = Selected['Prompt']
+            BestAccuracy = Selected['Accuracy']
+            BestIteration = Selected['Iteration']
     
     # Display final summary
     print("\n" + "=" * 80)
@@ -146,30 +559,71 @@ def Main(DataFrame, FeatureColumns, LabelColumn, PromptTemplate, MaxIterations=5
     print(f"\nTotal iterations: {len(IterationHistory) - 1}")
     print("\nAccuracy progression:")
     for Entry in IterationHistory:
-        print(f"  Iteration {Entry['Iteration']}: {Entry['Accuracy']:.2%}")
+        Validation = f" (validation {Entry['ValidationAccuracy']:.2%})" if Entry.get('ValidationAccuracy') is not None else ""
+        print(f"  Iteration {Entry['Iteration']}: {Entry['Accuracy']:.2%}{Validation}")
     
     print(f"\nTotal improvement: {(BestAccuracy - Accuracy):.2%}")
     print(f"Final accuracy: {CurrentAccuracy:.2%}")
     print(f"Best accuracy: {BestAccuracy:.2%} (achieved at iteration {BestIteration})")
-
     
-    # Save best prompt to file
-    with open('/dbfs/mnt/uat/Franky/RetrainingPipeline/BestPrompt.txt', 'w') as File:
-        File.write(BestPrompt)
-    print(f"Best prompt saved (from iteration {BestIteration})")
+    # Report response cache effectiveness
+    Cache = GetResponseCache()
+    if Cache is not None:
+        CacheStats = Cache.GetStats()
+        print(f"Response cache: {CacheStats['Hits']} hits, {CacheStats['Misses']} misses "
+              f"({CacheStats['HitRate']:.2%} hit rate), {CacheStats['Entries']} entries")
+    
+    # Report how traffic was spread over the deployment pool
+    Router = GetDeploymentRouter()
+    if len(Router.Backends) > 1:
+        print("\nDeployment pool:")
+        print(Router.GetStats().to_string())
+    if Router.Hedging is not None:
+        HedgeStats = Router.Hedging.GetStats()
+        print(f"Hedging: {HedgeStats['Hedges']} duplicate requests for {HedgeStats['Calls']} calls "
+              f"({HedgeStats['HedgeRate']:.1%}), {HedgeStats['HedgeWins']} answered first, "
+              f"~{HedgeStats['SavedSeconds']:.1f}s latency saved, {HedgeStats['SkippedByRate']} skipped by the rate cap")
+    
+    # Export per-call telemetry for offline analysis
+    if TelemetryDirectory is not None:
+        ExportTelemetry(TelemetryDirectory)
+    
+    ReportRunAnalytics(Store, IterationHistory, BestAccuracy, EnsembleSize, OutputPath)
+    
+    # Report the memory held by the prediction store
+    StoreMemory = Store.GetMemoryUsage()
+    print(f"Prediction store: {len(Store.Entries)} prompts, {StoreMemory['Arrays'] / 2 ** 20:.1f} MB of per-row arrays "
+          f"and {StoreMemory['Texts'] / 2 ** 20:.1f} MB of outputs in memory")
+    
+    SaveBestPrompt(BestPrompt, BestIteration, OutputPath)
+    
+    # Validated prompts other than the returned one only need label codes, e.g. for ensembles
+    if ValidationStore is not None:
+        ValidationStore.Retain([PredictionStore.MakeId(BestPrompt)])
+    
+    Store.Close()
+    if Checkpoint is not None:
+        Checkpoint.Close()
     
     return BestPrompt, BestAccuracy
 
 
-def TestBestPromptOnValidation(BestPrompt, ValidationData, FeatureColumns, LabelColumn):
+def TestBestPromptOnValidation(BestPrompt, ValidationData, FeatureColumns, LabelColumn, ConstrainedOutput=False,
+                               Layout=DefaultPromptLayout, ValidationStore=None):
     """
     Test the best prompt on validation data and return accuracy and dataframe with predictions.
     
+    When ValidationStore already holds the prompt's predictions on every row,
+    e.g. from Main's background validation, they are reported without LLM calls.
+    
     Args:
         BestPrompt: The best prompt obtained from training
         ValidationData: The validation dataframe
         FeatureColumns: List of column names to use as features
         LabelColumn: The column name containing true labels
+        ConstrainedOutput: Request label-only answers with logprobs and report their calibration
+        Layout: Message layout of the requests, one of 'Single', 'Split' or 'Reorder'
+        ValidationStore: Optional PredictionStore over ValidationData passed to Main
     
     Returns:
         Tuple containing:
@@ -181,38 +635,69 @@ def TestBestPromptOnValidation(BestPrompt, ValidationData, FeatureColumns, Label
     print("=" * 80)
     print(f"Number of validation samples: {len(ValidationData)}")
     
-    # Evaluate the best prompt on validation data
-    Accuracy, ResultDataFrame = EvaluatePrompt(
-        Prompt=BestPrompt,
-        DataFrame=ValidationData,
-        FeatureColumns=FeatureColumns,
-        LabelColumn=LabelColumn
-    )
+    # Reuse the background validation of the prompt; evaluate it only if it was not validated
+    ResultId = PredictionStore.MakeId(BestPrompt)
+    if (ValidationStore is not None and ResultId in ValidationStore
+            and ValidationStore.Entries[ResultId]['Rows'] == ValidationStore.RowCount):
+        Accuracy, ResultDataFrame = ValidationStore.GetAccuracy(ResultId), ValidationStore.GetResults(ResultId)
+    else:
+        with TelemetryStage('Validation'):
+            Accuracy, ResultDataFrame = EvaluatePrompt(
+                Prompt=BestPrompt,
+                DataFrame=ValidationData,
+                FeatureColumns=FeatureColumns,
+                LabelColumn=LabelColumn,
+                ConstrainedOutput=ConstrainedOutput,
+                Layout=Layout
+            )
     
     # Display results
     print(f"\nValidation Accuracy: {Accuracy:.2%}")
+    ReportCalibration(ResultDataFrame, LabelColumn)
+    ReportPromptCache(ResultDataFrame)
     print("\nValidation Results Summary:")
     print("-" * 40)
     
-    CorrectCount = sum(ResultDataFrame['ExtractedLabel'] == ResultDataFrame[LabelColumn].astype(str))
-    print(f"Correct Predictions: {CorrectCount}/{len(ResultDataFrame)}")
+    Analytics = ComputeErrorAnalytics(ResultDataFrame, LabelColumn)
+    print(f"Correct Predictions: {Analytics['Correct']}/{Analytics['Total']}")
     
     # Display confusion matrix style summary
-    UniqueLabels = ResultDataFrame[LabelColumn].unique()
     print("\nPer-Label Performance:")
-    for Label in UniqueLabels:
-        LabelMask = ResultDataFrame[LabelColumn] == Label
-        LabelCorrect = sum((ResultDataFrame[LabelColumn] == Label) & 
-                          (ResultDataFrame['ExtractedLabel'] == str(Label)))
-        LabelTotal = sum(LabelMask)
-        LabelAccuracy = LabelCorrect / LabelTotal if LabelTotal > 0 else 0
-        print(f"  {Label}: {LabelCorrect}/{LabelTotal} ({LabelAccuracy:.2%})")
+    print(FormatPerLabelReport(Analytics))
+    print("\nConfusion Matrix (rows: true label, columns: extracted label):")
+    print(Analytics['ConfusionMatrix'].to_string())
     
     return Accuracy, ResultDataFrame
 
 
+def TestEnsembleOnValidation(Ensemble, ValidationStore):
+    """
+    Score a saved prompt ensemble on validation data from stored predictions, without LLM calls.
+    
+    Args:
+        Ensemble: Ensemble loaded with LoadEnsemble
+        ValidationStore: PredictionStore over the validation data filled by Main's background validation
+    
+    Returns:
+        Tuple of the ensemble accuracy and the ScoreEnsemble result, or None when no member was validated
+    """
+    print("\n" + "=" * 80)
+    print("TESTING PROMPT ENSEMBLE ON VALIDATION DATA")
+    print("=" * 80)
+    
+    Evaluation = EvaluateEnsemble(Ensemble, ValidationStore)
+    if Evaluation is None:
+        print("No ensemble member was validated; skipping the validation ensemble")
+        return None
+    print(FormatEnsembleReport(Evaluation[1], Title="Validation ensemble"))
+    
+    return Evaluation
+
+
 if __name__ == "__main__":
-    DataTA = pd.read_excel('/dbfs/mnt/uat/Franky/inputData/TA_RetrainingData.xlsx')
+    # Convert the workbook once; later runs read only the needed Parquet columns
+    DataPath = ConvertExcelToParquet('/dbfs/mnt/uat/Franky/inputData/TA_RetrainingData.xlsx')
+    DataTA = pd.read_parquet(DataPath, columns=['Validation', 'has_aspiration', 'talent_statement'])
     DataTA = DataTA.dropna(subset = ['Validation'])
 
     DataTA['GroundTruth'] = np.where(
@@ -231,6 +716,9 @@ if __name__ == "__main__":
     FeatureColumns = ['text']
     LabelColumn = 'label'
     
+    # Receives the background validation predictions of Main
+    ValidationStore = PredictionStore(ValidationData, FeatureColumns, LabelColumn)
+    
     # Create prompt template for talent aspiration detection
     PromptTemplate = """Analyze the following talent statement and determine if it expresses career aspiration.
 
@@ -244,13 +732,25 @@ Does this statement express career aspiration? Please respond with only: has_asp
         LabelColumn=LabelColumn,
         PromptTemplate=PromptTemplate,
         MaxIterations=5,
-        AccuracyThreshold=0.95
+        AccuracyThreshold=0.95,
+        ValidationData=ValidationData,
+        ValidationStore=ValidationStore
     )
     
-    # Test the best prompt on validation data
+    # Report the best prompt on validation data from its background validation
     ValidationAccuracy, ValidationResults = TestBestPromptOnValidation(
         BestPrompt=BestPrompt,
         ValidationData=ValidationData,
         FeatureColumns=FeatureColumns,
-        LabelColumn=LabelColumn
-    )
\ No newline at end of file
+        LabelColumn=LabelColumn,
+        ValidationStore=ValidationStore
+    )
+    
+    # Check a saved ensemble of the top prompts against the best prompt on the same split
+    EnsemblePath = GetEnsemblePath(DefaultOutputPath)
+    if os.path.exists(EnsemblePath):
+        TestEnsembleOnValidation(LoadEnsemble(EnsemblePath), ValidationStore)
+    ValidationStore.Close()
+
+    # Release pooled HTTP connections
+    CloseClients()
\ No newline at end of file